@@ -51,14 +51,72 @@ def create_yaw_rotation_matrix(yaw_angle_radians):
                      [0,  0, 1]])
 
 def rotate_pose(points, yaw_angle_degrees):
-  yaw_angle_radians = np.deg2rad(yaw_angle_degrees)
-  rotation_matrix = create_yaw_rotation_matrix(yaw_angle_radians)
-  res = []
-  for point in points[0]:
-    temp_point = [point[0], point[2], point[1]]
-    rotated_point = rotate_points(temp_point, rotation_matrix)[0]
-    res.append([rotated_point[0], rotated_point[2], rotated_point[1]])
-  return np.array([res])
+  """
+  Rotates the first pose of `points` (shape (1, 32, 3)) around the vertical
+  axis, see `rotate_poses`
+  """
+  return rotate_poses(points[:1], [yaw_angle_degrees])
+
+def get_yaws(poses):
+    """
+    Batched `get_yaw`: yaw angle of the hips (right hip -> left hip) of each
+    pose
+
+    Args:
+      poses: numpy array of shape (N, 32, 3)
+
+    Returns:
+      array of shape (N,) of yaw angles in degrees
+    """
+    poses = np.asarray(poses)
+    direction = (poses[:, HUMAN4D32.LHIP.value] -
+                 poses[:, HUMAN4D32.RHIP.value])
+    return np.degrees(np.arctan2(direction[:, 0], direction[:, 2]))
+
+# swaps the y and z axes
+_AXIS_SWAP = [0, 2, 1]
+
+def rotate_poses(poses, yaw_angles_degrees):
+    """
+    Rotates N poses around their vertical axis with a single matmul
+
+    The y/z axis swap done around the yaw rotation is folded into the
+    rotation matrices, so each pose is multiplied by one (3, 3) matrix.
+
+    Args:
+      poses: numpy array of shape (N, 32, 3)
+      yaw_angles_degrees: array of shape (N,) of rotation angles
+
+    Returns:
+      the rotated poses, of shape (N, 32, 3)
+    """
+    yaws = np.deg2rad(np.asarray(yaw_angles_degrees, dtype=np.float64))
+    c, s = np.cos(yaws), np.sin(yaws)
+    rotations = np.zeros((len(yaws), 3, 3))
+    rotations[:, 0, 0] = c
+    rotations[:, 0, 1] = -s
+    rotations[:, 1, 0] = s
+    rotations[:, 1, 1] = c
+    rotations[:, 2, 2] = 1
+    # row vectors are multiplied by (swap . R . swap)^T
+    transforms = np.swapaxes(rotations, 1, 2)[:, _AXIS_SWAP][:, :, _AXIS_SWAP]
+    return np.matmul(np.asarray(poses), transforms)
+
+def canonicalize_poses(poses, target_yaw=90.0):
+    """
+    Normalizes the view of N poses: each pose is rotated around its vertical
+    axis so its hips have the yaw `target_yaw` (90 puts the hips along the x
+    axis, i.e. facing the camera)
+
+    Args:
+      poses: numpy array of shape (N, 32, 3)
+      target_yaw: yaw angle (degrees) of the hips after rotation
+
+    Returns:
+      (canonical poses of shape (N, 32, 3), original yaws of shape (N,))
+    """
+    yaws = get_yaws(poses)
+    return rotate_poses(poses, yaws - target_yaw), yaws
 
 def rotate_points(points, rotation_matrix):
     points = np.atleast_2d(points)
@@ -0,0 +1,179 @@
+"""
+Asyncio serving mode of the aggregator: the same `/key`, `/` and `/publish`
+endpoints as main.py, with decryption and inference offloaded to a thread
+pool and the uplink to the server done with non-blocking HTTP. With
+`QUEUE_FRAMES` set, frames are handed to main.py's worker pipeline instead
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+import requests
+from aiohttp import web
+
+import main
+import metrics
+from frame import CONTENT_TYPE
+from log import get_logger
+from metrics import span
+
+logger = get_logger("aggregator")
+session_log = get_logger("session")
+
+# threads running the crypto and inference stages
+workers = int(os.environ.get("WORKERS", "8"))
+
+
+async def run(fn, *args):
+    """
+    Runs a blocking function in the executor
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+
+async def forward(http, job):
+    """
+    Forwards a job to the server, renegotiating the session once if the
+    server rejects its key
+
+    Returns:
+        the server result
+    """
+    with span("uplink", job["trace"]):
+        return await _forward(http, job)
+
+
+async def _forward(http, job):
+    args = await run(main.uplink_args, job)
+    for _ in range(2):
+        try:
+            session = await run(main.sessions.get, job["user"])
+        except (ConnectionError, requests.RequestException) as e:
+            raise main.RequestError(str(e), 502)
+        body = await run(session.pack, *args)
+        try:
+            async with http.post(session.client.publish_url, data=body,
+                                 headers={"Content-Type": CONTENT_TYPE}
+                                 ) as response:
+                if response.status == 401:
+                    session_log.warning("session of %s rejected by the "
+                                        "server, renegotiating", job["user"])
+                    main.sessions.invalidate(job["user"], session)
+                    continue
+                if response.status >= 400:
+                    main.record_uplink(job, None)
+                    raise main.RequestError("Server refused the frame", 502)
+                content = await response.read()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise main.RequestError(str(e), 502)
+        main.record_uplink(job, content)
+        return content
+    raise main.RequestError("Server refused the session", 502)
+
+
+async def announce(request):
+    return web.json_response(main.announce_key())
+
+
+async def establish(request):
+    body = await request.json()
+    # the Diffie-Hellman modexp is too slow to run on the event loop
+    return web.json_response(await run(main.establish_session, body))
+
+
+async def process(request):
+    start = time.perf_counter()
+    response = await handle(request)
+    metrics.requests_total.inc(status=response.status)
+    metrics.request_seconds.observe(time.perf_counter() - start)
+    return response
+
+
+async def handle(request):
+    data = await request.read()
+    if main.queue_frames:
+        try:
+            # only the envelope and the user token are checked here
+            body, status, _ = main.enqueue_frame(data)
+        except main.RequestError as e:
+            logger.warning("refused a frame (%d): %s", e.status, e)
+            return web.Response(text=str(e), status=e.status)
+        if status == 202:
+            return web.json_response(body, status=status)
+        return web.Response(text=body, status=status)
+
+    try:
+        job = await run(main.decode_frame, data)
+        if job is None:
+            return web.Response(text="OK")
+        await run(main.run_inference, job)
+
+        headers = {}
+        if main.motion_gated(job):
+            # nothing moved, the server republishes its last results
+            job["repeat"] = True
+            headers["X-Motion-Gated"] = "1"
+        content = await forward(request.app["http"], job)
+    except main.RequestError as e:
+        logger.warning("refused a frame (%d): %s", e.status, e)
+        return web.Response(text=str(e), status=e.status)
+    if not content:
+        # the server detected nobody
+        return web.Response(status=204)
+    return web.Response(body=content, content_type="application/json",
+                        headers=headers)
+
+
+async def trace(request):
+    body, status = main.trace_report(request.match_info["trace"])
+    return web.json_response(body, status=status)
+
+
+async def readiness(request):
+    body, status = main.readiness()
+    return web.json_response(body, status=status)
+
+
+async def metrics_endpoint(request):
+    return web.Response(body=metrics.registry.render(),
+                        headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
+async def stats(request):
+    return web.json_response(main.collect_stats())
+
+
+async def on_startup(app):
+    asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=workers))
+    app["http"] = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=main.uplink_timeout))
+
+
+async def on_cleanup(app):
+    await app["http"].close()
+
+
+def make_app():
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_get('/key', announce)
+    app.router.add_route('*', '/', establish)
+    app.router.add_route('*', '/publish', process)
+    app.router.add_get('/ready', readiness)
+    app.router.add_get('/stats', stats)
+    app.router.add_get('/metrics', metrics_endpoint)
+    app.router.add_get('/trace/{trace}', trace)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+if __name__ == '__main__':
+    print("""
+    Asyncio version of main.py, meant to run on the raspberry pi to recive
+    info form other devices and send them to the cloud
+    """)
+    main.setup()
+    web.run_app(make_app(), port=8081, host='0.0.0.0')
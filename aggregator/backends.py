@@ -0,0 +1,235 @@
+"""
+Registry of the model backends of the aggregator, selected by name in the
+configuration
+
+A MoveNet backend is called like the `serving_default` signature of the
+SavedModel: int32 images of shape [N, input_size, input_size, 3] in,
+{'output_0': [N, 1, 17, 3]} out. A classifier backend has the
+`predict` / `predict_on_batch` methods of the Keras model, taking the
+(N, 34) output of `preprocess_batch`.
+"""
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from classifier import load_numpy_classifier
+from movenet import TFLiteMoveNet, load_classifier, load_movenet
+
+MOVENET_BACKENDS = {}
+CLASSIFIER_BACKENDS = {}
+
+
+def register(registry, name):
+    """
+    Decorator registering a loader `fn(path, **options)` under `name`
+    """
+    def decorator(fn):
+        registry[name] = fn
+        return fn
+    return decorator
+
+
+def _load(registry, kind, name, path, **options):
+    loader = registry.get(name)
+    if loader is None:
+        raise ValueError("Unknown " + kind + " backend " + repr(name) +
+                         ", available: " + ", ".join(sorted(registry)))
+    return loader(path, **options)
+
+
+def load_movenet_backend(name, path, **options):
+    """
+    Loads MoveNet with the backend registered as `name`
+
+    Params:
+        name: one of `MOVENET_BACKENDS`
+        path: path to the model, as expected by the backend
+        options: backend options (e.g. `threads`)
+    """
+    return _load(MOVENET_BACKENDS, "movenet", name, path, **options)
+
+
+def load_classifier_backend(name, path, **options):
+    """
+    Loads the pose classifier with the backend registered as `name`
+    """
+    return _load(CLASSIFIER_BACKENDS, "classifier", name, path, **options)
+
+
+def _onnx_session(path, threads):
+    # optional dependency, only needed for the onnx backends
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    options.intra_op_num_threads = threads
+    return onnxruntime.InferenceSession(path, options,
+                                        providers=["CPUExecutionProvider"])
+
+
+_ONNX_DTYPES = {
+    "tensor(int32)": np.int32,
+    "tensor(uint8)": np.uint8,
+    "tensor(float)": np.float32,
+}
+
+
+class OnnxMoveNet:
+    """
+    MoveNet exported to ONNX (e.g. with tf2onnx), run by ONNX Runtime
+    """
+
+    def __init__(self, path, threads=4):
+        self.session = _onnx_session(path, threads)
+        self.input = self.session.get_inputs()[0]
+        self.dtype = _ONNX_DTYPES[self.input.type]
+        self.input_size = int(self.input.shape[1])
+        # exports with a fixed batch of 1 are run image by image
+        self.batched = not isinstance(self.input.shape[0], int) \
+            or self.input.shape[0] != 1
+
+    def __call__(self, images):
+        images = np.asarray(images).astype(self.dtype)
+        if self.batched:
+            outputs = self.session.run(None, {self.input.name: images})[0]
+        else:
+            outputs = np.concatenate([
+                self.session.run(None, {self.input.name: image[np.newaxis]})[0]
+                for image in images])
+        return {'output_0': tf.convert_to_tensor(outputs)}
+
+
+class OnnxClassifier:
+    """
+    The pose classifier exported to ONNX, run by ONNX Runtime
+    """
+
+    def __init__(self, path, threads=1):
+        self.session = _onnx_session(path, threads)
+        self.input = self.session.get_inputs()[0]
+
+    def predict_on_batch(self, points):
+        points = np.asarray(points, dtype=np.float32)
+        return self.session.run(None, {self.input.name: points})[0]
+
+    def predict(self, points, **kwargs):
+        return self.predict_on_batch(points)
+
+
+# standing pose (y, x) in the normalized coordinates of the MoveNet input
+_STUB_POSE = np.array([
+    [0.20, 0.50], [0.18, 0.52], [0.18, 0.48], [0.19, 0.54], [0.19, 0.46],
+    [0.30, 0.58], [0.30, 0.42], [0.42, 0.62], [0.42, 0.38], [0.53, 0.63],
+    [0.53, 0.37], [0.55, 0.55], [0.55, 0.45], [0.70, 0.55], [0.70, 0.45],
+    [0.85, 0.55], [0.85, 0.45],
+], dtype=np.float32)
+
+
+class StubMoveNet:
+    """
+    Deterministic MoveNet stand-in for performance tests: a standing pose
+    slightly shifted by the mean of each image, after `delay` seconds
+
+    Params:
+        input_size: side of the (square) input
+        delay: seconds spent per call, to emulate the model cost
+    """
+
+    def __init__(self, input_size=256, delay=0.0):
+        self.input_size = input_size
+        self.delay = delay
+        self.lock = threading.Lock()
+
+    def __call__(self, images):
+        images = np.asarray(images)
+        shift = images.reshape(images.shape[0], -1).mean(axis=1) / 255 * 0.05
+        keypoints = np.empty((images.shape[0], 1, 17, 3), dtype=np.float32)
+        keypoints[:, 0, :, :2] = _STUB_POSE + shift[:, np.newaxis, np.newaxis]
+        keypoints[:, 0, :, 2] = 0.9
+        if self.delay:
+            # one model call at a time, like a real interpreter
+            with self.lock:
+                time.sleep(self.delay)
+        return {'output_0': tf.convert_to_tensor(keypoints)}
+
+
+class StubClassifier:
+    """
+    Deterministic classifier stand-in: the class is picked from the sum of
+    the pose coordinates
+
+    Params:
+        classes: number of classes
+        delay: seconds spent per call
+    """
+
+    def __init__(self, classes=8, delay=0.0):
+        self.classes = classes
+        self.delay = delay
+
+    def predict_on_batch(self, points):
+        points = np.asarray(points, dtype=np.float32)
+        points = points.reshape(points.shape[0], -1)
+        picked = (np.abs(points.sum(axis=1)) * 1000).astype(np.int64) \
+            % self.classes
+        result = np.full((points.shape[0], self.classes),
+                         0.02 / (self.classes - 1), dtype=np.float32)
+        result[np.arange(points.shape[0]), picked] = 0.98
+        if self.delay:
+            time.sleep(self.delay)
+        return result
+
+    def predict(self, points, **kwargs):
+        return self.predict_on_batch(points)
+
+
+@register(MOVENET_BACKENDS, "savedmodel")
+def _savedmodel_movenet(path, threads=4, delay=0.0):
+    return load_movenet(path)
+
+
+@register(MOVENET_BACKENDS, "tflite")
+def _tflite_movenet(path, threads=4, delay=0.0):
+    return TFLiteMoveNet(path, threads)
+
+
+@register(MOVENET_BACKENDS, "onnx")
+def _onnx_movenet(path, threads=4, delay=0.0):
+    return OnnxMoveNet(path, threads)
+
+
+@register(MOVENET_BACKENDS, "stub")
+def _stub_movenet(path, threads=4, delay=0.0):
+    return StubMoveNet(delay=delay)
+
+
+@register(CLASSIFIER_BACKENDS, "keras")
+def _keras_classifier(path, threads=1, delay=0.0):
+    return load_classifier(path)
+
+
+@register(CLASSIFIER_BACKENDS, "numpy")
+def _numpy_classifier(path, threads=1, delay=0.0):
+    return load_numpy_classifier(path)
+
+
+@register(CLASSIFIER_BACKENDS, "onnx")
+def _onnx_classifier(path, threads=1, delay=0.0):
+    return OnnxClassifier(path, threads)
+
+
+@register(CLASSIFIER_BACKENDS, "stub")
+def _stub_classifier(path, threads=1, delay=0.0):
+    return StubClassifier(delay=delay)
+
+
+def default_movenet_backend(path):
+    """
+    Guesses the MoveNet backend from the model path
+    """
+    if path.endswith(".tflite"):
+        return "tflite"
+    if path.endswith(".onnx"):
+        return "onnx"
+    return "savedmodel"
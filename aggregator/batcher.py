@@ -0,0 +1,108 @@
+"""
+Dynamic micro-batching: concurrent callers submit single items, a worker
+thread groups them and runs them through one batched call
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class Batcher:
+    """
+    Groups items submitted from several threads into batches
+
+    Params:
+        fn: function taking a list of items and returning the list of their
+            results (in the same order)
+        max_batch_size: maximum number of items per batch
+        max_wait: maximum time (seconds) the first item of a batch waits for
+            more items to come
+    """
+
+    def __init__(self, fn, max_batch_size=8, max_wait=0.01):
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.batches = 0
+        self.items = 0
+
+    def start(self):
+        self.worker.start()
+        return self
+
+    def stop(self):
+        self.queue.put(None)
+        self.worker.join()
+
+    def submit(self, item):
+        """
+        Queues an item
+
+        Returns:
+            a `Future` resolved with the item's result
+        """
+        future = Future()
+        self.queue.put((item, future))
+        return future
+
+    def __call__(self, item):
+        """
+        Queues an item and waits for its result
+        """
+        return self.submit(item).result()
+
+    def _collect(self):
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                # let the next `_collect` see the stop marker
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            if batch is None:
+                return
+            items = [item for item, _ in batch]
+            futures = [future for _, future in batch]
+            try:
+                results = self.fn(items)
+            except Exception as e:
+                if len(batch) == 1:
+                    futures[0].set_exception(e)
+                else:
+                    # one bad item must not fail the others
+                    self._run_alone(batch)
+                continue
+            self.batches += 1
+            self.items += len(items)
+            for future, result in zip(futures, results):
+                future.set_result(result)
+
+    def _run_alone(self, batch):
+        for item, future in batch:
+            try:
+                result = self.fn([item])[0]
+            except Exception as e:
+                future.set_exception(e)
+                continue
+            self.batches += 1
+            self.items += 1
+            future.set_result(result)
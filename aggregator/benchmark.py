@@ -1,5 +1,29 @@
-from movenet import (use_movenet, use_classifier, load_movenet, load_classifier)
+from movenet import (use_movenet, use_classifier, load_movenet, load_classifier,
+                     preprocess, extract_keypoints, preprocess_batch,
+                     use_movenet_batch, decode_image)
+from classifier import load_numpy_classifier
+from backends import (load_movenet_backend, load_classifier_backend,
+                      default_movenet_backend)
+from timing import main, synthetic_image
+from cryptography.fernet import Fernet
 import tensorflow as tf
+import numpy as np
+import functools
+import gzip
+import os
+import sys
+import time
+
+movenet_path = os.environ.get("MOVENET_MODEL", "./venv/models/movenet/thunder/")
+movenet_backend = os.environ.get("MOVENET_BACKEND",
+                                 default_movenet_backend(movenet_path))
+classifier_path = os.environ.get("CLASSIFIER_MODEL",
+                                 "./venv/models/classifier/model.keras")
+# classifier backends timed side by side by the suite
+classifier_backends = os.environ.get("CLASSIFIER_BACKENDS",
+                                     "keras numpy").split()
+
+
 def my_func():
     model = load_movenet("./venv/models/movenet/thunder/")
     classifier = load_classifier("./venv/models/classifier/model.keras")
@@ -13,5 +37,152 @@ def my_func():
         result = use_movenet(image, model)
         use_classifier(result, classifier)
 
+
+def compare_movenet(paths, threads=4, runs=20):
+    """
+    Compares the MoveNet latency of several models side by side
+
+    Params:
+        paths: SavedModel directories or .tflite files
+        threads: number of threads of the TFLite interpreter
+        runs: timed runs per image, after one warm-up run
+    """
+    images = [tf.image.decode_jpeg(tf.io.read_file('venv/data/' + image))
+              for image in ['1.jpeg', '2.jpeg', '3.jpeg', '4.jpeg']]
+    print(f"{'model':50} {'mean ms':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for path in paths:
+        model = load_movenet_backend(default_movenet_backend(path), path,
+                                     threads=threads)
+        timings = []
+        for image in images:
+            use_movenet(image, model)
+            for _ in range(runs):
+                start = time.perf_counter()
+                use_movenet(image, model)
+                timings.append((time.perf_counter() - start) * 1000)
+        print(f"{path:50} {np.mean(timings):8.1f} "
+              f"{np.percentile(timings, 50):8.1f} "
+              f"{np.percentile(timings, 95):8.1f}")
+
+
+def compare_classifier(path="./venv/models/classifier/model.keras",
+                       batch=16, runs=100):
+    """
+    Compares the outputs and the latency of the Keras and the NumPy
+    classifiers on random poses
+    """
+    keras_classifier = load_classifier(path)
+    numpy_classifier = load_numpy_classifier(path)
+    points = np.random.default_rng(0).normal(
+            size=(batch, 34)).astype(np.float32)
+    expected = keras_classifier.predict_on_batch(points)
+    result = numpy_classifier.predict_on_batch(points)
+    print("max abs difference:", np.max(np.abs(expected - result)))
+    for name, classifier in (("keras", keras_classifier),
+                             ("numpy", numpy_classifier)):
+        start = time.perf_counter()
+        for _ in range(runs):
+            classifier.predict_on_batch(points)
+        print(f"{name}: {(time.perf_counter() - start) / runs * 1000:.3f} ms "
+              f"per batch of {batch}")
+
+
+def compare_preprocess(batch=16, runs=100):
+    """
+    Compares the TF and the NumPy keypoint post-processing on random movenet
+    outputs
+    """
+    keypoints = np.random.default_rng(0).random(
+            (batch, 1, 1, 17, 3)).astype(np.float32)
+    expected = np.concatenate([preprocess(extract_keypoints(k)).numpy()
+                               for k in keypoints])
+    result = preprocess_batch(keypoints)
+    print("max abs difference:", np.max(np.abs(expected - result)))
+    start = time.perf_counter()
+    for _ in range(runs):
+        for k in keypoints:
+            preprocess(extract_keypoints(k))
+    print(f"tf: {(time.perf_counter() - start) / runs * 1000:.3f} ms "
+          f"per batch of {batch}")
+    start = time.perf_counter()
+    for _ in range(runs):
+        preprocess_batch(keypoints)
+    print(f"numpy: {(time.perf_counter() - start) / runs * 1000:.3f} ms "
+          f"per batch of {batch}")
+
+
+@functools.lru_cache(maxsize=None)
+def load_movenet_model():
+    return load_movenet_backend(movenet_backend, movenet_path)
+
+
+@functools.lru_cache(maxsize=None)
+def load_classifier_model(backend):
+    return load_classifier_backend(backend, classifier_path)
+
+
+def build_stages(sizes, batches):
+    """
+    Stages of the aggregator for the benchmark suite (see timing.py)
+
+    Returns:
+        list of (name, fn, items) stages
+    """
+    stages = []
+    fernet = Fernet(Fernet.generate_key())
+    for height, width in sizes:
+        size = f"{height}x{width}"
+        image = synthetic_image(height, width)
+        jpeg = tf.io.encode_jpeg(image).numpy()
+        raw = image.tobytes()
+        compressed = gzip.compress(raw)
+        token = fernet.encrypt(compressed)
+        stages += [
+            (f"decode/{size}", lambda jpeg=jpeg: decode_image(jpeg), 1),
+            (f"encode/{size}",
+             lambda image=image: tf.io.encode_jpeg(image).numpy(), 1),
+            (f"gzip/{size}", lambda raw=raw: gzip.compress(raw), 1),
+            (f"gunzip/{size}",
+             lambda compressed=compressed: gzip.decompress(compressed), 1),
+            (f"fernet_encrypt/{size}",
+             lambda compressed=compressed: fernet.encrypt(compressed), 1),
+            (f"fernet_decrypt/{size}",
+             lambda token=token: fernet.decrypt(token), 1),
+        ]
+        for batch in batches:
+            images = [image] * batch
+            stages.append((f"movenet/{size}/b{batch}",
+                           lambda images=images: use_movenet_batch(
+                               images, load_movenet_model()), batch))
+
+    for batch in batches:
+        keypoints = np.random.default_rng(0).random(
+                (batch, 1, 1, 17, 3)).astype(np.float32)
+        points = preprocess_batch(keypoints)
+        stages.append((f"postprocess/b{batch}",
+                       lambda keypoints=keypoints: preprocess_batch(keypoints),
+                       batch))
+        for backend in classifier_backends:
+            stages.append((f"classifier_{backend}/b{batch}",
+                           lambda points=points, backend=backend:
+                           load_classifier_model(backend).predict_on_batch(
+                               points),
+                           batch))
+    return stages
+
+
 if __name__ == '__main__':
-    my_func()
+    if sys.argv[1:2] == ['suite']:
+        # e.g. python benchmark.py suite --output report.json
+        #      python benchmark.py suite --baseline report.json
+        sys.exit(main(build_stages, sys.argv[2:]))
+    elif sys.argv[1:] == ['classifier']:
+        compare_classifier()
+    elif sys.argv[1:] == ['preprocess']:
+        compare_preprocess()
+    elif len(sys.argv) > 1:
+        # e.g. python benchmark.py ./venv/models/movenet/thunder/
+        #      ./venv/models/movenet/thunder.tflite
+        compare_movenet(sys.argv[1:])
+    else:
+        my_func()
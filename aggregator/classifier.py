@@ -0,0 +1,235 @@
+"""
+NumPy forward pass of the pose classifier (a small dense network), avoiding
+the Keras predict loop and Keras itself
+
+The weights are read from any of the exported formats found under
+venv/models/classifier: the Keras v3 zip (model.keras), a legacy HDF5 file
+(weights.best.hdf5) or the TensorFlow.js export (model.json + shards).
+"""
+import io
+import json
+import os
+import re
+import zipfile
+
+import numpy as np
+
+
+def _relu6(x):
+    return np.clip(x, 0.0, 6.0)
+
+
+def _softmax(x):
+    e = np.exp(x - np.max(x, axis=-1, keepdims=True))
+    return e / np.sum(e, axis=-1, keepdims=True)
+
+
+ACTIVATIONS = {
+    "linear": lambda x: x,
+    "relu": lambda x: np.maximum(x, 0.0),
+    "relu6": _relu6,
+    "sigmoid": lambda x: 1.0 / (1.0 + np.exp(-x)),
+    "tanh": np.tanh,
+    "softmax": _softmax,
+}
+
+
+class NumpyClassifier:
+    """
+    Sequential stack of Dense layers, with the same `predict` /
+    `predict_on_batch` methods as the Keras model
+
+    Params:
+        layers: list of (kernel, bias, activation name), in order
+    """
+
+    def __init__(self, layers):
+        self.layers = [(np.asarray(kernel, dtype=np.float32),
+                        np.asarray(bias, dtype=np.float32),
+                        ACTIVATIONS[activation])
+                       for kernel, bias, activation in layers]
+
+    def predict_on_batch(self, points):
+        """
+        Params:
+            points: array of shape (N, number of features)
+
+        Returns:
+            array of shape (N, number of classes)
+        """
+        x = np.asarray(points, dtype=np.float32)
+        x = x.reshape(x.shape[0], -1)
+        for kernel, bias, activation in self.layers:
+            x = activation(x @ kernel + bias)
+        return x
+
+    def predict(self, points, **kwargs):
+        return self.predict_on_batch(points)
+
+
+def _dense_layers(config, weights):
+    """
+    Pairs the layers of a Keras model config with their weights
+
+    Params:
+        config: the model config (the dict with "class_name" and "config")
+        weights: layer name -> list of arrays (kernel, bias)
+
+    Returns:
+        list of (kernel, bias, activation name)
+    """
+    layers = []
+    for layer in config["config"]["layers"]:
+        kind = layer["class_name"]
+        name = layer["config"]["name"]
+        if kind in ("InputLayer", "Dropout", "Flatten"):
+            # dropout is a no-op at inference, the input is flattened by
+            # `predict_on_batch`
+            continue
+        if kind == "Dense":
+            kernel = weights[name][0]
+            if layer["config"]["use_bias"]:
+                bias = weights[name][1]
+            else:
+                bias = np.zeros(kernel.shape[1], dtype=np.float32)
+            layers.append((kernel, bias, layer["config"]["activation"]))
+        elif kind == "Activation":
+            units = layers[-1][0].shape[1]
+            layers.append((np.eye(units, dtype=np.float32),
+                           np.zeros(units, dtype=np.float32),
+                           layer["config"]["activation"]))
+        else:
+            raise ValueError("Unsupported layer " + kind + " (" + name + ")")
+    return layers
+
+
+def _snake_case(name):
+    # same conversion as keras.src.utils.naming.to_snake_case
+    name = re.sub(r"\W+", "", name)
+    name = re.sub("(.)([A-Z][a-z]+)", r"\1_\2", name)
+    return re.sub("([a-z])([A-Z])", r"\1_\2", name).lower()
+
+
+def _keras_names(config, weights):
+    """
+    Keys the weights of a Keras v3 model by the layer names of its config
+
+    Keras v3 saves a layer under the snake_case name of its class, numbered
+    in the order of the model's layers (dense, dense_1, ...), not under the
+    layer's own name; older exports keyed by the layer name are kept as is
+
+    Params:
+        config: the model config
+        weights: h5 layer path -> list of arrays, from `_keras_weights`
+
+    Returns:
+        layer name -> list of arrays
+    """
+    named = {}
+    used = {}
+    for layer in config["config"]["layers"]:
+        name = layer["config"]["name"]
+        path = _snake_case(layer["class_name"])
+        if path in used:
+            used[path] += 1
+            path += "_%d" % used[path]
+        else:
+            used[path] = 0
+        if name in weights:
+            named[name] = weights[name]
+        elif path in weights:
+            named[name] = weights[path]
+    return named
+
+
+def _keras_weights(data):
+    """
+    Reads the weights of a Keras v3 model.weights.h5, stored as
+    layers/<layer path>/vars/<index> (the optimizer and metrics variables
+    are skipped)
+    """
+    import h5py
+
+    weights = {}
+
+    def visit(path, item):
+        parts = path.split("/")
+        if (isinstance(item, h5py.Dataset) and len(parts) == 4
+                and parts[0] in ("layers", "_layer_checkpoint_dependencies")
+                and parts[2] == "vars"):
+            weights.setdefault(parts[1], {})[int(parts[3])] = item[()]
+
+    with h5py.File(io.BytesIO(data), "r") as f:
+        f.visititems(visit)
+    return {name: [arrays[i] for i in sorted(arrays)]
+            for name, arrays in weights.items()}
+
+
+def _hdf5_model(path):
+    """
+    Reads the config and the weights of a legacy HDF5 model
+    """
+    import h5py
+
+    with h5py.File(path, "r") as f:
+        if "model_config" not in f.attrs:
+            raise ValueError(path + " only holds weights, no model config")
+        config = json.loads(f.attrs["model_config"])
+        group = f["model_weights"] if "model_weights" in f else f
+        weights = {}
+        for name in group.attrs["layer_names"]:
+            name = name.decode() if isinstance(name, bytes) else name
+            layer = group[name]
+            weights[name] = [
+                    layer[w.decode() if isinstance(w, bytes) else w][()]
+                    for w in layer.attrs["weight_names"]]
+    return config, weights
+
+
+def _tfjs_model(path):
+    """
+    Reads the config and the weights of a TensorFlow.js export (model.json
+    and its binary shards)
+    """
+    with open(path) as f:
+        model = json.load(f)
+    config = model["modelTopology"]["model_config"]
+    weights = {}
+    directory = os.path.dirname(path)
+    for group in model["weightsManifest"]:
+        data = b"".join(open(os.path.join(directory, shard), "rb").read()
+                        for shard in group["paths"])
+        offset = 0
+        for spec in group["weights"]:
+            if spec["dtype"] != "float32" or "quantization" in spec:
+                raise ValueError("Unsupported weight " + spec["name"])
+            count = int(np.prod(spec["shape"]))
+            array = np.frombuffer(data, dtype="<f4", count=count,
+                                  offset=offset).reshape(spec["shape"])
+            offset += count * 4
+            layer = spec["name"].split("/")[0]
+            weights.setdefault(layer, []).append(array)
+    return config, weights
+
+
+def load_numpy_classifier(path):
+    """
+    Loads the classifier weights into a `NumpyClassifier`
+
+    Params:
+        path: path to model.keras, to a legacy .h5/.hdf5 model or to the
+            TensorFlow.js model.json
+
+    Returns:
+        the classifier
+    """
+    if path.endswith(".keras"):
+        with zipfile.ZipFile(path) as archive:
+            config = json.loads(archive.read("config.json"))
+            weights = _keras_names(
+                    config, _keras_weights(archive.read("model.weights.h5")))
+    elif path.endswith(".json"):
+        config, weights = _tfjs_model(path)
+    else:
+        config, weights = _hdf5_model(path)
+    return NumpyClassifier(_dense_layers(config, weights))
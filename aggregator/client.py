@@ -1,6 +1,3 @@
-import tensorflow as tf
-import gzip
-import numpy as np
 import gzip
 
 from cryptography.fernet import Fernet
@@ -9,20 +6,32 @@ import base64
 
 import requests
 
+from frame import pack_frame, CONTENT_TYPE
+from log import get_logger, summarize
+
+logger = get_logger("uplink")
+
 
 class Client:
 
-    def __init__(self, server_ip: str, server_port: str, id: str):
+    def __init__(self, server_ip: str, server_port: str, id: str,
+                 timeout=10):
         self.server_ip = server_ip
         self.server_port = server_port
         self.id = id
+        # seconds to wait for the server, so a hung server fails the uplink
+        # instead of blocking its workers
+        self.timeout = timeout
+        # keep-alive connection reused by every request of this client
+        self.http = requests.Session()
 
     def gen_credintals(self):
         self.dh = DiffieHellman()
         self.pub_key = self.dh.gen_public_key()
 
-        response = requests.get(
-                url="http://"+self.server_ip+":"+self.server_port+"/key"
+        response = self.http.get(
+                url="http://"+self.server_ip+":"+self.server_port+"/key",
+                timeout=self.timeout
                 )
         if response.ok:
             json_rsp = response.json()
@@ -35,54 +44,114 @@ class Client:
                     )
             self.id = self.fernet.encrypt(self.id)
         else:
-            print("Failed to establish credintals!")
-            exit(1)
+            raise ConnectionError("Failed to establish credintals!")
 
     def share_secret(self):
-        response = requests.get(
+        response = self.http.get(
                 url="http://"+self.server_ip+":"+self.server_port+"/",
                 json={
                     "pubkey": self.pub_key,
                     "user": self.id.__str__()
-                    }
+                    },
+                timeout=self.timeout
                 )
         if response.ok:
             # json_rsp = response.json()
             # self.server_pubkey = int(json_rsp.get("pubkey"))
             # self.secret = self.dh.gen_shared_key(self.server_pubkey)
             # self.fernet = Fernet(base64.b64encode(self.secret[:32].encode()))
-            print("secret shared!")
+            logger.info("secret shared with %s", self.server_ip)
         else:
-            exit(1)
+            raise ConnectionError("Failed to share the secret!")
 
-    def read_data(self, img_array, shape, img_movenet, img_category, device):
+    def read_data(self, img_array, shape, img_movenet, img_category, device,
+                  stream=None, content_type=None, crop=None, trace=None,
+                  repeat=False):
+        """
+        Reads data to send
+
+        Params:
+            img_array: the image pixels, or the encoded image bytes when
+                `content_type` is given
+            content_type: content type of an encoded image
+            crop: (full height, full width, x offset, y offset, scale) when
+                the image is a person crop
+            trace: trace id of the frame
+            repeat: ask the server to republish the device's last results
+                instead of sending an image (`img_array` is ignored)
+        """
         img = img_array
         self.shape = shape
-        print("img:", img)
-        print("shape:", self.shape)
-        img = gzip.compress(img.flatten())
+        logger.debug("read %s of shape %s", summarize(img), self.shape,
+                     extra={"trace": trace})
+        if repeat:
+            # the encrypted empty payload proves the session key
+            img = b""
+        elif content_type is None:
+            img = gzip.compress(img.flatten())
         self.encrypted_data = self.fernet.encrypt(img)
+        self.content_type = content_type
+        self.crop = crop
         self.movenet_data = img_movenet
         self.category = img_category
         self.device = device
-        print("done!")
+        self.stream = stream
+        self.trace = trace
+        self.repeat = repeat
+
+    @property
+    def publish_url(self):
+        return "http://"+self.server_ip+":"+self.server_port+"/publish"
+
+    def pack_data(self):
+        """
+        Returns:
+            the frame envelope of the data read by `read_data`
+        """
+        return pack_frame(
+                self.encrypted_data,
+                self.shape,
+                self.id,
+                self.device,
+                movenet=self.movenet_data,
+                category=self.category,
+                stream=self.stream,
+                content_type=self.content_type,
+                crop=self.crop,
+                trace=self.trace,
+                repeat=self.repeat,
+                )
 
     def send_data(self):
-        print("sending...")
-        status = requests.post(
-                url="http://"+self.server_ip+":"+self.server_port+"/publish",
-                json={
-                    "data": self.encrypted_data.__str__(),
-                    "shape": self.shape.__str__(),
-                    "user": self.id.__str__(),
-                    "device": self.device.__str__(),
-                    "movenet": self.movenet_data.__str__(),
-                    "category": np.array2string(self.category, separator=", "),
-                    },
-                timeout=1000000
+        """
+        Sends the data read by `read_data` to the server
+
+        Returns:
+            the server response
+        """
+        return self.post(self.pack_data(), self.trace)
+
+    def post(self, body, trace=None):
+        """
+        Sends a frame envelope (from `pack_data`) to the server, safe to
+        call from several threads
+
+        Params:
+            body: the frame envelope
+            trace: trace id of the frame, for the logs
+
+        Returns:
+            the server response
+        """
+        status = self.http.post(
+                url=self.publish_url,
+                data=body,
+                headers={"Content-Type": CONTENT_TYPE},
+                timeout=self.timeout
                 )
         if not status.ok:
-            print("Error occured while sending the data")
-            exit(1)
+            logger.warning("the server refused the data (%d)",
+                           status.status_code, extra={"trace": trace})
         else:
-            print("data sent sucessfully!")
+            logger.debug("data sent", extra={"trace": trace})
+        return status
@@ -0,0 +1,65 @@
+"""
+Micro-batched MoveNet + classifier inference for the frames of several
+devices feeding the same aggregator
+"""
+from batcher import Batcher
+from log import get_logger
+from movenet import (use_movenet, use_movenet_batch, use_classifier_batch,
+                     supports_batches)
+
+logger = get_logger("inference")
+
+
+class InferenceEngine:
+    """
+    Groups pending frames into one MoveNet batch and one classifier call and
+    dispatches the results back to each request, a batch that fails is run
+    again frame by frame so only the bad frame fails
+
+    Params:
+        movenet: the movenet model (output of load_movenet)
+        classifier: the keras classifier (output of load_classifier)
+        max_batch_size: maximum number of frames per batch
+        max_wait: maximum time (seconds) a frame waits for a batch to fill
+    """
+
+    def __init__(self, movenet, classifier, max_batch_size=4, max_wait=0.01):
+        self.movenet = movenet
+        self.classifier = classifier
+        # the single pose MoveNet signatures may be exported with a fixed
+        # batch of 1, in which case frames are run one by one
+        self.batched_movenet = supports_batches(movenet)
+        if not self.batched_movenet:
+            logger.info("movenet does not support batches, frames are run "
+                        "one by one")
+        self.batcher = Batcher(self._infer_batch, max_batch_size, max_wait)
+
+    def start(self):
+        self.batcher.start()
+        return self
+
+    def stop(self):
+        self.batcher.stop()
+
+    def infer(self, img):
+        """
+        Runs MoveNet and the classifier on an image
+
+        Params:
+            img: the image array
+
+        Returns:
+            (keypoints_with_scores of shape [1, 1, 17, 3],
+             classifier output of shape [1, number of classes])
+        """
+        return self.batcher(img)
+
+    def _movenet_batch(self, imgs):
+        if self.batched_movenet and len(imgs) > 1:
+            return use_movenet_batch(imgs, self.movenet)
+        return [use_movenet(img, self.movenet) for img in imgs]
+
+    def _infer_batch(self, imgs):
+        poses = self._movenet_batch(imgs)
+        categories = use_classifier_batch(poses, self.classifier)
+        return [(pose, categories[i:i + 1]) for i, pose in enumerate(poses)]
@@ -0,0 +1,90 @@
+"""
+Motion gating: frames whose MoveNet keypoints barely moved since the last
+forwarded frame of the same device are not sent to the server, which only
+gets a repeat request to republish its last results
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class MotionGate:
+    """
+    Per-device gate comparing new keypoints to the last forwarded ones
+
+    Params:
+        threshold: mean keypoint displacement (in normalized image
+            coordinates) above which a frame is forwarded
+        min_score: keypoints below this confidence score are ignored
+        max_hold: seconds after which a frame is forwarded even if nothing
+            moved, so the published results stay fresh
+        max_devices: maximum number of devices tracked, the least recently
+            forwarded ones are dropped first
+    """
+
+    def __init__(self, threshold=0.02, min_score=0.3, max_hold=5.0,
+                 max_devices=4096):
+        self.threshold = threshold
+        self.min_score = min_score
+        self.max_hold = max_hold
+        self.max_devices = max_devices
+        # device -> (keypoints, forwarded at) of its last forwarded frame,
+        # oldest first; the device ids come from the clients, so the entries
+        # are bounded and dropped after `max_hold`, when they no longer gate
+        self.devices = OrderedDict()
+        self.lock = threading.Lock()
+        self.skipped = 0
+
+    def displacement(self, previous, keypoints):
+        """
+        Mean displacement of the keypoints confidently detected in both
+        movenet outputs (shape [1, 1, 17, 3] of y, x, score)
+
+        Returns:
+            the displacement, or None if no keypoint is common to both
+        """
+        previous = np.reshape(previous, (17, 3))
+        keypoints = np.reshape(keypoints, (17, 3))
+        visible = ((previous[:, 2] >= self.min_score) &
+                   (keypoints[:, 2] >= self.min_score))
+        if not visible.any():
+            return None
+        moves = keypoints[visible, :2] - previous[visible, :2]
+        return float(np.mean(np.linalg.norm(moves, axis=1)))
+
+    def check(self, device, keypoints):
+        """
+        Checks whether a frame has to be forwarded, a forwarded frame is
+        recorded at once so the frames following it are compared to it even
+        before the server answered
+
+        Params:
+            device: the device key (e.g. (user, device id))
+            keypoints: the movenet output of the frame
+
+        Returns:
+            False if the frame has to be forwarded, True if the server is
+            asked to repeat the device's last results instead
+        """
+        now = time.monotonic()
+        with self.lock:
+            last = self.devices.get(device)
+            if last is not None and now - last[1] <= self.max_hold:
+                moved = self.displacement(last[0], keypoints)
+                if moved is not None and moved <= self.threshold:
+                    self.skipped += 1
+                    return True
+            self.devices[device] = (keypoints, now)
+            self.devices.move_to_end(device)
+            while self.devices and (
+                    len(self.devices) > self.max_devices or
+                    now - next(iter(self.devices.values()))[1] >
+                    self.max_hold):
+                self.devices.popitem(last=False)
+            return False
+
+    def reset(self, device):
+        with self.lock:
+            self.devices.pop(device, None)
@@ -1,22 +1,82 @@
 from flask import Flask, request
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken
 import base64
+import os
+import threading
+import time
 import gzip
+import zlib
 from pyDH import DiffieHellman
+import requests
 import numpy as np
 from addons import (get_yaw, rotate_pose, collect_angles)
-from movenet import (use_movenet, use_classifier, load_movenet, load_classifier)
-from client import Client
-import tensorflow_hub as hub
+from movenet import decode_image, person_box, square_crop
+from backends import (load_movenet_backend, load_classifier_backend,
+                      default_movenet_backend)
+from session import SessionCache
+from tokens import TokenTable
+from engine import InferenceEngine
+from gate import MotionGate
+from pipeline import Pipeline
+from frame import unpack_frame, new_trace_id, FrameError
+from metrics import span
+from log import get_logger, summarize
+import log
+import metrics
+import tensorflow as tf
 
 
 keypoints_name = 'human4d_32'
 ground_truth_angle = 90
 
 app = Flask(__name__)
-model = load_movenet("./venv/models/movenet/thunder/")
-classifier = load_classifier("./venv/models/classifier/model.keras")
+logger = get_logger("aggregator")
+session_log = get_logger("session")
+decrypt_log = get_logger("decrypt")
+# the models are loaded in the background by `setup`, frames are refused
+# until `ready` is set
+ready = threading.Event()
+load_error = None
+# shapes of the frames the models are run on once before `ready` is set, so
+# the first requests don't pay the tracing cost
+warmup_shapes = [(480, 640, 3), (720, 1280, 3)]
+# SavedModel directory, .tflite or .onnx file; the backend (one of
+# `MOVENET_BACKENDS`) is guessed from the path unless set, the TFLite and
+# ONNX Runtime backends run on `MOVENET_THREADS` threads
+movenet_path = os.environ.get("MOVENET_MODEL",
+                              "./venv/models/movenet/thunder/")
+movenet_backend = os.environ.get("MOVENET_BACKEND",
+                                 default_movenet_backend(movenet_path))
+movenet_threads = int(os.environ.get("MOVENET_THREADS", "4"))
+# model.keras, a legacy .hdf5 model or the TensorFlow.js model.json (or a
+# .onnx file for the onnx backend), run with one of `CLASSIFIER_BACKENDS`
+classifier_path = os.environ.get("CLASSIFIER_MODEL",
+                                 "./venv/models/classifier/model.keras")
+classifier_backend = os.environ.get("CLASSIFIER_BACKEND", "numpy")
+# seconds spent per call by the stub backends
+stub_delay = float(os.environ.get("STUB_DELAY", "0"))
+# seconds the uplink waits for the server before answering 502
+uplink_timeout = float(os.environ.get("UPLINK_TIMEOUT", "10"))
+sessions = SessionCache("51.138.72.242", "8080", ttl=600, max_sessions=64,
+                        timeout=uplink_timeout)
+# frames whose keypoints moved less than `threshold` (normalized image
+# coordinates) since the last forwarded one are not sent to the server
+gate = MotionGate(threshold=0.02, min_score=0.3, max_hold=5.0)
+# forward only a square around the person, of one of the `crop_sides` so
+# MeTRAbs can batch the crops of several frames (larger persons are scaled
+# down to the largest side)
+crop_person = os.environ.get("CROP_PERSON", "1") == "1"
+crop_sides = [int(side) for side in
+              os.environ.get("CROP_SIDES", "256 384 512").split()]
+# answer /publish with 202 once the frame is queued, inference and uplink
+# run on a worker pipeline; a full queue is answered with 429
+queue_frames = os.environ.get("QUEUE_FRAMES", "1") == "1"
+ingest_queue_size = int(os.environ.get("INGEST_QUEUE_SIZE", "32"))
 
+# encrypted user id (as sent by the devices) -> (user id, secret), each
+# device keeps its own secret even when several share a user id
+devices = TokenTable(int(os.environ.get("MAX_SESSIONS", "1024")),
+                     float(os.environ.get("SESSION_TTL", "3600")))
 # Example user credentials
 users = {
     "user_name": "password_hash"
@@ -50,62 +110,457 @@ def process_img(img):
 def send_processed(processed):
     pass
 
-@app.route('/key', methods=['GET'])
-def announce():
+class RequestError(Exception):
+    """
+    Error answered to the sender of a request with the given HTTP status
+    """
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def check_ready():
+    """
+    Refuses the frames while the models are loading
+    """
+    if not ready.is_set():
+        raise RequestError("Models are loading", 503)
+
+
+def readiness():
+    """
+    Returns:
+        (body, status) of the `/ready` endpoint
+    """
+    if ready.is_set():
+        return ({"ready": True}, 200)
+    body = {"ready": False}
+    if load_error is not None:
+        body["error"] = load_error
+    return (body, 503)
+
+
+def announce_key():
     return {"pubkey": pubkey.__str__()}
 
-@app.route('/', methods=['GET', 'POST'])
-def establish():
-    json_body_request = request.get_json()
-    print("values: ", request.get_json())
+
+def establish_session(json_body_request):
+    """
+    Derives the shared secret of a device from its public key
+    """
+    session_log.debug("key exchange request: %s", json_body_request)
     end_pubkey = json_body_request.get("pubkey")
     end_name = json_body_request.get("user")
-    global shared_secret
     shared_secret = d1.gen_shared_key(int(end_pubkey))
     f = Fernet(
             base64.b64encode(
                 shared_secret[:32].encode()
                 )
             )
-    end_name = f.decrypt(end_name[2:-1].encode())
-    users[end_name] = shared_secret
-    print("shared secret: ", shared_secret)
+    token = end_name[2:-1].encode()
+    end_name = f.decrypt(token)
+    devices.add(token, end_name, shared_secret)
+    session_log.info("session established for %s", end_name)
     return {"pubkey": pubkey.__str__()}
 
 
+def parse_frame(data):
+    """
+    Parses a received frame and identifies its user
+
+    Params:
+        data: the request body (a frame envelope)
+
+    Returns:
+        the job of the frame as a dict, or None for the stream markers
+    """
+    try:
+        frame = unpack_frame(data)
+    except FrameError as e:
+        raise RequestError("Malformed frame: " + str(e), 400)
+    device = frame.device
+    if frame.marker:
+        logger.info("stream %s marker %s from device %s", frame.stream[0],
+                    frame.stream[2], device, extra={"trace": frame.trace})
+        return None
+
+    check_ready()
+    # several devices negotiate their own secret, so the user is looked up
+    # by its token instead of the last negotiated secret
+    session = devices.get(frame.user)
+    if session is None:
+        raise RequestError("Unknown session", 401)
+    user, secret = session
+    return {
+            "frame": frame,
+            "user": user,
+            "secret": secret,
+            "device": device,
+            # frames from older clients get their trace here
+            "trace": frame.trace or new_trace_id(),
+            }
+
+
+def decrypt_frame(job):
+    """
+    Decrypts and decodes the image of a job
+    """
+    frame = job["frame"]
+    shape = frame.shape
+    fernet = Fernet(base64.b64encode(job["secret"][:32].encode()))
+    with span("decrypt", job["trace"]):
+        try:
+            decrypted_data = fernet.decrypt(frame.data)
+        except InvalidToken:
+            raise RequestError("Invalid session key", 401)
+        try:
+            if frame.content_type is not None:
+                # the encoded image is decoded for MoveNet and forwarded as
+                # is
+                image = decode_image(decrypted_data)
+                data_array = decrypted_data
+                shape = image.shape
+            else:
+                decompressed = gzip.decompress(decrypted_data)
+                data_array = np.frombuffer(decompressed, dtype=frame.dtype)
+                image = np.reshape(data_array, shape)
+        except tf.errors.InvalidArgumentError:
+            raise RequestError("Malformed frame: undecodable image", 400)
+        except (OSError, EOFError, zlib.error):
+            raise RequestError("Malformed frame: bad gzip body", 400)
+        except ValueError:
+            raise RequestError("Malformed frame: image does not match the "
+                               "frame shape", 400)
+    # checked here rather than in MoveNet, where a bad frame would fail the
+    # other frames of its batch
+    if image.dtype != np.uint8 or image.ndim != 3 or image.shape[2] != 3 \
+            or image.size == 0:
+        raise RequestError("Image must be a uint8 array of shape "
+                           "(height, width, 3)", 400)
+    decrypt_log.debug("decrypted %s into %s", summarize(data_array),
+                      summarize(image), extra={"trace": job["trace"]})
+    job["image"] = image
+    job["data"] = data_array
+    job["shape"] = shape
+    return job
+
+
+def decode_frame(data):
+    """
+    Parses and decrypts a received frame
+
+    Returns:
+        the job of the frame as a dict, or None for the stream markers
+    """
+    job = parse_frame(data)
+    if job is None:
+        return None
+    return decrypt_frame(job)
+
+
+def run_inference(job):
+    """
+    Runs MoveNet and the classifier on the job's image
+    """
+    with span("inference", job["trace"]):
+        job["pose"], job["category"] = engine.infer(job["image"])
+    return job
+
+
+def motion_gated(job):
+    """
+    Returns:
+        True if nothing moved since the last forwarded frame of the job's
+        device, whose results the server is then asked to repeat
+    """
+    return gate.check((job["user"], job["device"]), job["pose"])
+
+
+def uplink_args(job):
+    """
+    Returns:
+        the arguments of `Client.read_data` to forward the job, or to ask
+        the server to republish the last results of a gated job
+    """
+    frame = job["frame"]
+    if job.get("repeat"):
+        return (None, (), None, None, job["device"], frame.stream, None, None,
+                job["trace"], True)
+    image = job["image"]
+    data_array = job["data"]
+    shape = job["shape"]
+    content_type = frame.content_type
+    crop = None
+    box = person_box(job["pose"], image.shape) if crop_person else None
+    if box is not None:
+        # only the person is forwarded, with what the server needs to map
+        # its results back to the full frame
+        cropped, x0, y0, scale = square_crop(image, box, crop_sides)
+        crop = (image.shape[0], image.shape[1], x0, y0, scale)
+        shape = cropped.shape
+        if content_type is not None:
+            data_array = tf.io.encode_jpeg(cropped).numpy()
+            content_type = "image/jpeg"
+        else:
+            data_array = cropped
+    return (data_array, shape, job["pose"], job["category"], job["device"],
+            frame.stream, content_type, crop, job["trace"])
+
+
+def forward(job):
+    """
+    Forwards the job to the server
+
+    Returns:
+        the server result
+    """
+    with span("uplink", job["trace"]):
+        try:
+            response = sessions.send(job["user"], *uplink_args(job))
+        except (ConnectionError, requests.RequestException) as e:
+            # the handshake raises ConnectionError, the requests to the
+            # server their own exceptions
+            raise RequestError(str(e), 502)
+        if not response.ok:
+            record_uplink(job, None)
+            raise RequestError("Server refused the frame", 502)
+    record_uplink(job, response.content)
+    return response.content
+
+
+def record_uplink(job, content):
+    """
+    Resets the motion gate of the job's device when the server has no
+    result to repeat
+
+    Params:
+        job: the forwarded job
+        content: the server result, None if the server refused the frame
+            and empty if it detected nobody
+    """
+    if not content:
+        # the frame was refused, nobody was detected or nothing was left to
+        # repeat (e.g. the server restarted): the next frame is forwarded
+        gate.reset((job["user"], job["device"]))
+
+
+def publish_frame(data):
+    """
+    Handles a received frame from end to end
+
+    Returns:
+        (body, status, headers), 204 if the server detected nobody
+    """
+    job = decode_frame(data)
+    if job is None:
+        return ("OK", 200, {})
+    run_inference(job)
+
+    headers = {"Content-Type": "application/json"}
+    if motion_gated(job):
+        # nothing moved, the server republishes its last results
+        job["repeat"] = True
+        headers["X-Motion-Gated"] = "1"
+    content = forward(job)
+    if not content:
+        return ("", 204, {})
+    return (content, 200, headers)
+
+
+def inference_stage(job):
+    """
+    First pipeline stage: decryption, MoveNet, classifier and motion gate
+    """
+    decrypt_frame(job)
+    run_inference(job)
+    if motion_gated(job):
+        # nothing moved, only a repeat of the last results is sent
+        job["repeat"] = True
+    return job
+
+
+def uplink_stage(job):
+    """
+    Second pipeline stage: forward to the server
+    """
+    forward(job)
+    return None
+
+
+def enqueue_frame(data):
+    """
+    Validates a received frame and queues it on the pipeline
+
+    Returns:
+        (body, status, headers), 202 once queued
+    """
+    job = parse_frame(data)
+    if job is None:
+        return ("OK", 200, {})
+    if not pipeline.submit(job):
+        raise RequestError("Too many frames queued", 429)
+    return ({"queued": pipeline.depth(), "trace": job["trace"]}, 202, {})
+
+
+def handle_frame(data):
+    """
+    Handles a received frame in the configured mode
+    """
+    if queue_frames:
+        return enqueue_frame(data)
+    return publish_frame(data)
+
+
+def register_gauges():
+    """
+    Exposes the queue depths and the component counters on `/metrics`
+    """
+    if queue_frames:
+        metrics.registry.gauge(
+                "queue_depth", "Frames waiting in each pipeline queue",
+                ("queue",), fn=lambda: {(stage.name,): stage.qsize()
+                                        for stage in pipeline.stages})
+        metrics.registry.gauge(
+                "rejected_frames", "Frames refused with 429",
+                fn=lambda: pipeline.rejected)
+    metrics.registry.gauge("gated_frames", "Frames not forwarded (no motion)",
+                           fn=lambda: gate.skipped)
+    metrics.registry.gauge("sessions", "Cached sessions with the server",
+                           fn=lambda: len(sessions.sessions))
+
+
+def collect_stats():
+    """
+    Returns:
+        queue depths and stage timings as a dict
+    """
+    stats = {"gated": gate.skipped}
+    if queue_frames:
+        stats["pipeline"] = pipeline.stats()
+    return stats
+
+
+@app.route('/key', methods=['GET'])
+def announce():
+    return announce_key()
+
+@app.route('/', methods=['GET', 'POST'])
+def establish():
+    return establish_session(request.get_json())
+
+
 @app.route('/publish', methods=['GET', 'POST'])
 def process():
-    json_body_request = request.get_json()
-    data = json_body_request.get("data")
-    user = json_body_request.get("user")
-    shape = eval(json_body_request.get("shape"))
-    device = eval(json_body_request.get("device"))
-
-    if shared_secret == b'':
-        exit(1)
-    else:
-        f = Fernet(
-                base64.b64encode(
-                    shared_secret[:32].encode()
-                    )
-                )
-        user = f.decrypt(user[2:-1].encode())
+    start = time.perf_counter()
+    try:
+        response = handle_frame(request.get_data())
+    except RequestError as e:
+        logger.warning("refused a frame (%d): %s", e.status, e)
+        response = (str(e), e.status)
+    metrics.requests_total.inc(status=response[1])
+    metrics.request_seconds.observe(time.perf_counter() - start)
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return (metrics.registry.render(), 200,
+            {"Content-Type": metrics.CONTENT_TYPE})
+
 
-    secret = users.get(user)
-    fernet = Fernet(base64.b64encode(secret[:32].encode()))
-    decrypted_data = fernet.decrypt(data[2:-1].encode())
-    decompressed = gzip.decompress(decrypted_data)
-    data_array = np.frombuffer(decompressed, dtype=np.uint8)
-    print("data array:", data_array)
-    pose = use_movenet(np.reshape(data_array, shape), model)
-    category = use_classifier(pose, classifier)
+def trace_report(trace):
+    """
+    Returns:
+        (body, status) of the `/trace/<trace id>` endpoint: the stages
+        recorded for the frame, 404 if none is left
+    """
+    recorded = metrics.trace_spans(trace)
+    if not recorded:
+        return ({"trace": trace, "error": "Unknown trace"}, 404)
+    return ({"trace": trace, "spans": recorded}, 200)
+
+
+@app.route('/trace/<trace>', methods=['GET'])
+def trace_endpoint(trace):
+    return trace_report(trace)
 
-    client = Client("51.138.72.242", "8080", user)
-    client.gen_credintals()
-    client.share_secret()
-    client.read_data(data_array, shape, pose, category, device)
-    client.send_data()
-    return "Hi"
+
+@app.route('/ready', methods=['GET'])
+def readiness_probe():
+    return readiness()
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return collect_stats()
+
+
+def warm_up():
+    """
+    Runs the models through the engine, as the frames are, on blank frames
+    of the `warmup_shapes` one by one then as a full batch
+    """
+    for shape in warmup_shapes:
+        engine.infer(np.zeros(shape, dtype=np.uint8))
+    blank = np.zeros(warmup_shapes[0], dtype=np.uint8)
+    futures = [engine.batcher.submit(blank)
+               for _ in range(engine.batcher.max_batch_size)]
+    try:
+        for future in futures:
+            future.result()
+    except Exception:
+        # single frames work, so the models are usable without batches
+        logger.warning("batched inference failed, frames are run one by "
+                       "one", exc_info=True)
+        engine.batched_movenet = False
+
+
+def load_models():
+    """
+    Loads and warms up MoveNet and the classifier, then sets `ready`
+    """
+    global model, classifier, engine, load_error
+    try:
+        model = load_movenet_backend(movenet_backend, movenet_path,
+                                     threads=movenet_threads,
+                                     delay=stub_delay)
+        classifier = load_classifier_backend(classifier_backend,
+                                             classifier_path,
+                                             delay=stub_delay)
+        logger.info("movenet backend: %s, classifier backend: %s",
+                    movenet_backend, classifier_backend)
+        engine = InferenceEngine(model, classifier, max_batch_size=4,
+                                 max_wait=0.01).start()
+        warm_up()
+    except Exception as e:
+        load_error = repr(e)
+        logger.exception("failed to load the models")
+        return
+    logger.info("models loaded")
+    ready.set()
+
+
+def setup():
+    """
+    Generates the key pair devices derive their secret from and starts
+    loading the models in the background
+    """
+    global d1, pubkey, pipeline
+    log.setup()
+    d1 = DiffieHellman()
+    pubkey = d1.gen_public_key()
+    register_gauges()
+    threading.Thread(target=load_models, daemon=True).start()
+    if queue_frames:
+        # the frames of a device stay on one worker of each stage, so they
+        # are gated and forwarded in order
+        pipeline = (Pipeline(key=lambda job: (job["user"], job["device"]))
+                    .add_stage("inference", inference_stage, workers=2,
+                               queue_size=ingest_queue_size)
+                    .add_stage("uplink", uplink_stage, workers=4,
+                               queue_size=ingest_queue_size)
+                    .start())
 
 
 # This script will run under the raspberry
@@ -115,6 +570,5 @@ if __name__ == '__main__':
     This File is meant to run on the raspberry pi to recive info form other
     devices and send them to the cloud
     """)
-    d1 = DiffieHellman()
-    pubkey = d1.gen_public_key()
+    setup()
     app.run(debug=False, port=8081, host='0.0.0.0')
@@ -3,10 +3,14 @@ import tensorflow_hub as hub
 import numpy as np
 
 import enum
+import threading
+from log import get_logger
 """
 This file is meant to test the movenet and pose classifier on the raspberry pi
 """
 
+logger = get_logger("movenet")
+
 
 class BodyPart(enum.Enum):
     """
@@ -30,16 +34,79 @@ class BodyPart(enum.Enum):
     LEFT_ANKLE = 15
     RIGHT_ANKLE = 16
 
-def load_movenet(path):
+def decode_image(data):
+    """
+    Decodes an encoded (jpeg, png) image
+
+    Params:
+        data: the encoded image bytes
+
+    Returns:
+        uint8 array of shape (height, width, 3)
+    """
+    return tf.io.decode_image(data, channels=3, expand_animations=False).numpy()
+
+
+class TFLiteMoveNet:
+    """
+    MoveNet run by the TFLite interpreter (XNNPACK for the float models),
+    called like the `serving_default` signature of the SavedModel
+
+    Params:
+        path: path to the .tflite model (thunder or lightning, float16 or
+            int8)
+        threads: number of threads of the interpreter
+    """
+
+    def __init__(self, path, threads=4):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            Interpreter = tf.lite.Interpreter
+        self.interpreter = Interpreter(model_path=path, num_threads=threads)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        # 256 for thunder, 192 for lightning
+        self.input_size = int(self.input['shape'][1])
+        # the interpreter is not thread safe
+        self.lock = threading.Lock()
+
+    def __call__(self, images):
+        """
+        Params:
+            images: int32 tensor of shape [N, input_size, input_size, 3]
+
+        Returns:
+            {'output_0': tensor of shape [N, 1, 17, 3]}
+        """
+        images = np.asarray(images).astype(self.input['dtype'])
+        outputs = []
+        with self.lock:
+            # the models are exported with a batch of 1
+            for image in images:
+                self.interpreter.set_tensor(self.input['index'],
+                                            image[np.newaxis])
+                self.interpreter.invoke()
+                outputs.append(
+                        self.interpreter.get_tensor(self.output['index']))
+        return {'output_0': tf.convert_to_tensor(np.concatenate(outputs))}
+
+
+def load_movenet(path, threads=4):
     """
     Loads the movenet model from local files
 
     Params:
-        path: path to the movenet model (directory)
+        path: path to the movenet model (SavedModel directory, or .tflite
+            file for the TFLite interpreter)
+        threads: number of threads of the TFLite interpreter
 
     Returns:
         the movenet model
     """
+    if path.endswith('.tflite'):
+        return TFLiteMoveNet(path, threads)
     model = hub.load(path)
     movenet = model.signatures['serving_default']
     return movenet
@@ -56,7 +123,7 @@ def use_movenet(img, movenet):
     Returns:
         estimated pose
     """
-    input_size = 256
+    input_size = getattr(movenet, 'input_size', 256)
     image = tf.expand_dims(img, axis=0)
     image = tf.image.resize_with_pad(image, input_size, input_size)
     image = tf.cast(image, dtype=tf.int32)
@@ -64,10 +131,132 @@ def use_movenet(img, movenet):
     outputs = movenet(image)
     # Output is a [1, 1, 17, 3] tensor.
     keypoints_with_scores = outputs['output_0'].numpy()
-    print("keypoints_with_scores: ", keypoints_with_scores)
+    logger.debug("keypoints with scores: %s", keypoints_with_scores)
     return keypoints_with_scores
 
 
+def supports_batches(movenet):
+    """
+    Checks whether a movenet model can be called on several images at once,
+    the single pose SavedModel signatures are exported with a batch of 1
+
+    Params:
+        movenet: the movenet model (output of load_movenet)
+
+    Returns:
+        True if the model takes a batch of any size
+    """
+    signature = getattr(movenet, 'structured_input_signature', None)
+    if signature is None:
+        # the TFLite, ONNX Runtime and stub models split the batches
+        # themselves when their input is fixed
+        return True
+    args, kwargs = signature
+    return all(spec.shape.rank and spec.shape[0] != 1
+               for spec in list(args) + list(kwargs.values()))
+
+
+def use_movenet_batch(imgs, movenet):
+    """
+    Uses the movenet model to make pose estimation on several images with a
+    single call, or one call per image if the model does not support batches
+
+    Params:
+        imgs: list of input images (may have different sizes)
+        movenet: the movenet model (output of load_movenet)
+
+    Returns:
+        list of estimated poses, each a [1, 1, 17, 3] array like the output
+        of `use_movenet`
+    """
+    if not supports_batches(movenet):
+        return [use_movenet(img, movenet) for img in imgs]
+    input_size = getattr(movenet, 'input_size', 256)
+    images = tf.stack([
+        tf.image.resize_with_pad(img, input_size, input_size) for img in imgs
+        ])
+    images = tf.cast(images, dtype=tf.int32)
+
+    outputs = movenet(images)
+    # Output is a [N, 1, 17, 3] tensor.
+    keypoints_with_scores = outputs['output_0'].numpy()
+    return [keypoints_with_scores[i:i + 1]
+            for i in range(keypoints_with_scores.shape[0])]
+
+
+def person_box(keypoints_with_scores, shape, min_score=0.3, padding=0.2):
+    """
+    Computes a padded box around the person from the keypoint extents
+
+    Params:
+        keypoints_with_scores: output of `use_movenet`, in the coordinates
+            of the padded square movenet input
+        shape: shape of the image given to `use_movenet`
+        min_score: keypoints below this confidence score are ignored
+        padding: margin added on each side, relative to the box size
+
+    Returns:
+        (x0, y0, x1, y1) in image pixels, or None if no keypoint is confident
+    """
+    height, width = shape[0], shape[1]
+    keypoints = np.reshape(keypoints_with_scores, (17, 3))
+    keypoints = keypoints[keypoints[:, 2] >= min_score]
+    if keypoints.shape[0] == 0:
+        return None
+    # undo `resize_with_pad`: the image is centered in a square of its
+    # larger side
+    side = max(height, width)
+    ys = keypoints[:, 0] * side - (side - height) / 2
+    xs = keypoints[:, 1] * side - (side - width) / 2
+    pad_x = (xs.max() - xs.min()) * padding
+    pad_y = (ys.max() - ys.min()) * padding
+    x0 = int(max(0, np.floor(xs.min() - pad_x)))
+    y0 = int(max(0, np.floor(ys.min() - pad_y)))
+    x1 = int(min(width, np.ceil(xs.max() + pad_x)))
+    y1 = int(min(height, np.ceil(ys.max() + pad_y)))
+    if x1 <= x0 or y1 <= y0:
+        return None
+    return (x0, y0, x1, y1)
+
+
+def square_crop(img, box, sizes):
+    """
+    Crops an image to a square around a box, snapped to one of a few sides so
+    the crops of different frames can be stacked into one MeTRAbs batch
+
+    The square is centered on the box and kept inside the image when
+    possible, else padded with black on the right and bottom. Its side is
+    the smallest of `sizes` fitting the box; a box larger than all of them
+    is cropped at its size then scaled down to the largest.
+
+    Params:
+        img: the image array
+        box: (x0, y0, x1, y1) in image pixels (output of `person_box`)
+        sizes: the allowed sides of the crop, in pixels
+
+    Returns:
+        (crop of shape [side, side, 3], x offset, y offset, scale of the
+         crop relative to the image)
+    """
+    x0, y0, x1, y1 = box
+    extent = max(x1 - x0, y1 - y0)
+    fitting = [size for size in sorted(sizes) if size >= extent]
+    side = fitting[0] if fitting else max(sizes)
+    region = max(extent, side)
+    height, width = img.shape[0], img.shape[1]
+    left = int(max(0, min((x0 + x1 - region) // 2, width - region)))
+    top = int(max(0, min((y0 + y1 - region) // 2, height - region)))
+    crop = img[top:top + region, left:left + region]
+    if crop.shape[0] != region or crop.shape[1] != region:
+        padded = np.zeros((region, region) + crop.shape[2:], dtype=crop.dtype)
+        padded[:crop.shape[0], :crop.shape[1]] = crop
+        crop = padded
+    scale = side / region
+    if region != side:
+        crop = tf.cast(tf.image.resize(crop, (side, side)), tf.uint8).numpy()
+    return (np.ascontiguousarray(crop), left, top, scale)
+
+
 def person_from_keypoint(keypoints_with_scores, image_width, image_height):
     """
     Converts the output to a reasonable [[x, y, score]] where the x and y
@@ -189,6 +378,77 @@ def preprocess(keypoints):
     return tf.keras.layers.Flatten()(new_points)
 
 
+def landmarks_from_keypoints(keypoints_with_scores, image_width=256,
+                             image_height=256):
+    """
+    Vectorized `person_from_keypoint` + `extract_keypoints`: converts
+    movenet outputs to the (x, y) keypoints in image coordinates, truncated
+    to integers like `int()` does
+
+    Args:
+        keypoints_with_scores: movenet outputs, any shape holding N * 17
+            (y, x, score) triplets (e.g. [N, 1, 17, 3])
+        image_width: image width
+        image_height: image height
+
+    Returns:
+        float32 array of shape (N, 17, 2)
+    """
+    keypoints = np.reshape(
+            np.asarray(keypoints_with_scores, dtype=np.float32), (-1, 17, 3))
+    xs = np.trunc(keypoints[:, :, 1] * np.float32(image_width))
+    ys = np.trunc(keypoints[:, :, 0] * np.float32(image_height))
+    return np.stack([xs, ys], axis=-1)
+
+
+def normalize_landmarks(landmarks, torso_size_multiplier=2.5):
+    """
+    Vectorized `normalize_pose_landmarks` on a batch of poses
+
+    The pose size is computed per pose, with the same definition as
+    `get_pose_size` (whose maximum distance is the norm of each coordinate
+    over the keypoints, not the distance of each keypoint).
+
+    Args:
+        landmarks: array of shape (N, 17, 2)
+        torso_size_multiplier: see `get_pose_size`
+
+    Returns:
+        float32 array of shape (N, 17, 2)
+    """
+    landmarks = np.asarray(landmarks, dtype=np.float32)
+    left_hip = BodyPart.LEFT_HIP.value
+    right_hip = BodyPart.RIGHT_HIP.value
+    # Move landmarks so that the pose center becomes (0,0)
+    pose_center = landmarks[:, left_hip] * 0.5 + landmarks[:, right_hip] * 0.5
+    landmarks = landmarks - pose_center[:, np.newaxis]
+
+    hips_center = landmarks[:, left_hip] * 0.5 + landmarks[:, right_hip] * 0.5
+    shoulders_center = (landmarks[:, BodyPart.LEFT_SHOULDER.value] * 0.5 +
+                        landmarks[:, BodyPart.RIGHT_SHOULDER.value] * 0.5)
+    torso_size = np.sqrt(np.sum(np.square(shoulders_center - hips_center),
+                                axis=-1))
+    d = landmarks - hips_center[:, np.newaxis]
+    max_dist = np.max(np.sqrt(np.sum(np.square(d), axis=1)), axis=-1)
+    pose_size = np.maximum(torso_size * torso_size_multiplier, max_dist)
+    return landmarks / pose_size[:, np.newaxis, np.newaxis]
+
+
+def preprocess_batch(keypoints_with_scores):
+    """
+    NumPy version of `preprocess(extract_keypoints(...))` on a batch
+
+    Args:
+        keypoints_with_scores: movenet outputs holding N poses
+
+    Returns:
+        float32 array of shape (N, 34), the classifier input
+    """
+    landmarks = normalize_landmarks(
+            landmarks_from_keypoints(keypoints_with_scores))
+    return landmarks.reshape(landmarks.shape[0], 34)
+
+
 def classify(points, classifier):
     """
     Classify a pose to one of eight pre-defined poses using the classifier
@@ -213,11 +473,29 @@ def load_classifier(path):
     Returns:
         the classifier
     """
-    return tf.keras.models.load_model('./venv/models/classifier/model.keras')
+    return tf.keras.models.load_model(path)
 
 def use_classifier(keypoints_with_scores, classifier):
     # person_from_keypoint(keypoints_with_scores, 256, 256)
-    keypoints = extract_keypoints(keypoints_with_scores)
-    preprocesed = preprocess(keypoints)
-    print("using classifier")
+    preprocesed = preprocess_batch(keypoints_with_scores)
+    logger.debug("using classifier")
     return classify(preprocesed, classifier)
+
+
+def use_classifier_batch(keypoints_with_scores, classifier):
+    """
+    Classifies several poses with a single classifier call
+
+    Params:
+        keypoints_with_scores: list of movenet outputs
+        classifier: the keras classifer
+
+    Returns:
+        array of shape (N, number of classes)
+    """
+    points = preprocess_batch(np.concatenate([
+        np.reshape(keypoints, (1, 17, 3))
+        for keypoints in keypoints_with_scores
+        ]))
+    # `predict_on_batch` skips the per-call setup of the `predict` loop
+    return classifier.predict_on_batch(points)
@@ -0,0 +1,163 @@
+"""
+Staged worker pipeline decoupling the aggregator's `/publish` handler from
+inference and the uplink to the server
+"""
+import queue
+import threading
+import time
+
+from log import get_logger
+
+logger = get_logger("pipeline")
+
+
+class Stage:
+    """
+    A pipeline stage: bounded queues drained by worker threads, one queue
+    per worker
+
+    Items with the same key always go to the same worker, so the items of
+    a key (e.g. the frames of a device) are processed in order.
+
+    Params:
+        name: name of the stage (used in the stats)
+        fn: function called on each item, returning the item to hand to the
+            next stage or None to stop there
+        workers: number of worker threads
+        queue_size: capacity of the stage, split between the workers'
+            queues
+        key: function giving the key of an item
+    """
+
+    def __init__(self, name, fn, workers=1, queue_size=64, key=None):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.key = key
+        self.queues = [queue.Queue(maxsize=max(1, queue_size // workers))
+                       for _ in range(workers)]
+        self.next = None
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.errors = 0
+        self.time_total = 0.0
+        self.time_max = 0.0
+
+    def shard(self, item):
+        """
+        Returns:
+            the queue of the worker processing the item
+        """
+        if self.workers == 1:
+            return self.queues[0]
+        key = self.key(item) if self.key is not None else id(item)
+        return self.queues[hash(key) % self.workers]
+
+    def qsize(self):
+        return sum(shard.qsize() for shard in self.queues)
+
+    def _run(self, index):
+        while True:
+            item = self.queues[index].get()
+            if item is None:
+                return
+            start = time.monotonic()
+            try:
+                item = self.fn(item)
+            except Exception as e:
+                if getattr(e, "status", 500) < 500:
+                    # a frame refused for its content, not a failure
+                    logger.warning("stage %s refused a frame (%d): %s",
+                                   self.name, e.status, e)
+                else:
+                    logger.exception("stage %s failed: %s", self.name, e)
+                item = None
+                with self.lock:
+                    self.errors += 1
+            elapsed = time.monotonic() - start
+            with self.lock:
+                self.processed += 1
+                self.time_total += elapsed
+                self.time_max = max(self.time_max, elapsed)
+            if item is not None and self.next is not None:
+                # blocks when the next stage is full, which in turn fills
+                # this stage's queue up to the handler
+                self.next.shard(item).put(item)
+
+    def stats(self):
+        with self.lock:
+            return {
+                "queued": self.qsize(),
+                "capacity": sum(shard.maxsize for shard in self.queues),
+                "processed": self.processed,
+                "errors": self.errors,
+                "time_avg": (self.time_total / self.processed
+                             if self.processed else 0.0),
+                "time_max": self.time_max,
+            }
+
+
+class Pipeline:
+    """
+    Chain of stages running concurrently, fed by `submit`
+
+    Params:
+        key: function giving the key of an item, the items of a key keep
+            their order through the stages (None for no order)
+    """
+
+    def __init__(self, key=None):
+        self.key = key
+        self.stages = []
+        self.threads = []
+        self.rejected = 0
+
+    def add_stage(self, name, fn, workers=1, queue_size=64):
+        stage = Stage(name, fn, workers, queue_size, self.key)
+        if self.stages:
+            self.stages[-1].next = stage
+        self.stages.append(stage)
+        return self
+
+    def start(self):
+        for stage in self.stages:
+            for index in range(stage.workers):
+                thread = threading.Thread(target=stage._run, args=(index,),
+                                          daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        return self
+
+    def stop(self):
+        for stage in self.stages:
+            for shard in stage.queues:
+                shard.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def submit(self, item):
+        """
+        Enqueues an item on the first stage without blocking
+
+        Returns:
+            False if the item's queue in the first stage is full
+        """
+        try:
+            self.stages[0].shard(item).put_nowait(item)
+        except queue.Full:
+            self.rejected += 1
+            return False
+        return True
+
+    def depth(self):
+        """
+        Returns:
+            number of items waiting in the first stage's queues
+        """
+        return self.stages[0].qsize()
+
+    def stats(self):
+        return {
+            "rejected": self.rejected,
+            "stages": {stage.name: stage.stats() for stage in self.stages},
+        }
@@ -0,0 +1,165 @@
+"""
+Cache of the aggregator -> server sessions, so the Diffie-Hellman handshake
+is done once per user instead of once per frame
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from client import Client
+from log import get_logger
+
+logger = get_logger("session")
+
+
+class Session:
+    """
+    An established session with the server
+
+    Attributes:
+        client: the `Client` holding the shared secret
+        created: time (monotonic) at which the handshake was done
+        lock: serializes the use of the client's `read_data` buffers, held
+            while a frame is encrypted but not while it is sent
+    """
+
+    def __init__(self, client: Client):
+        self.client = client
+        self.created = time.monotonic()
+        self.lock = threading.Lock()
+
+    def pack(self, *args, **kwargs):
+        """
+        Encrypts a frame with this session's key
+
+        Params:
+            args, kwargs: the arguments of `Client.read_data`
+
+        Returns:
+            the frame envelope to post to `client.publish_url`
+        """
+        with self.lock:
+            self.client.read_data(*args, **kwargs)
+            return self.client.pack_data()
+
+    def send(self, *args, **kwargs):
+        """
+        Encrypts a frame with this session's key and sends it, the lock is
+        released before the request so frames of the same user are sent
+        concurrently
+
+        Params:
+            args, kwargs: the arguments of `Client.read_data`
+
+        Returns:
+            the server response
+        """
+        with self.lock:
+            self.client.read_data(*args, **kwargs)
+            body = self.client.pack_data()
+            trace = self.client.trace
+        return self.client.post(body, trace)
+
+
+class SessionCache:
+    """
+    Per-user sessions with a time to live and LRU eviction
+
+    Params:
+        server_ip: the server ip
+        server_port: the server port
+        ttl: seconds after which a session is renegotiated
+        max_sessions: maximum number of cached sessions
+        timeout: seconds the clients wait for the server
+    """
+
+    def __init__(self, server_ip: str, server_port: str, ttl=600,
+                 max_sessions=64, timeout=10):
+        self.server_ip = server_ip
+        self.server_port = server_port
+        self.timeout = timeout
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+        # user -> lock held during its handshake, so concurrent frames of a
+        # user wait for one handshake instead of each starting their own
+        self.handshakes = {}
+
+    def _handshake(self, user):
+        client = Client(self.server_ip, self.server_port, user, self.timeout)
+        client.gen_credintals()
+        client.share_secret()
+        return Session(client)
+
+    def _cached(self, user):
+        # called with `lock` held
+        session = self.sessions.get(user)
+        if session is not None:
+            if time.monotonic() - session.created < self.ttl:
+                self.sessions.move_to_end(user)
+                return session
+            del self.sessions[user]
+        return None
+
+    def get(self, user):
+        """
+        Returns a live session for the given user, doing the handshake
+        only if there is none or it expired
+        """
+        with self.lock:
+            session = self._cached(user)
+            if session is not None:
+                return session
+            handshake = self.handshakes.setdefault(user, threading.Lock())
+
+        # the handshake is done outside the cache lock so other users don't
+        # wait, and under the user's lock so it is done once
+        with handshake:
+            with self.lock:
+                session = self._cached(user)
+            if session is not None:
+                # negotiated by a concurrent frame
+                return session
+            session = self._handshake(user)
+            with self.lock:
+                self.sessions[user] = session
+                self.sessions.move_to_end(user)
+                while len(self.sessions) > self.max_sessions:
+                    evicted, _ = self.sessions.popitem(last=False)
+                    self.handshakes.pop(evicted, None)
+        return session
+
+    def invalidate(self, user, session=None):
+        """
+        Drops the session of the given user (only if it is still `session`
+        when given)
+        """
+        with self.lock:
+            current = self.sessions.get(user)
+            if current is not None and (session is None or
+                                        current is session):
+                del self.sessions[user]
+
+    def send(self, user, *args, **kwargs):
+        """
+        Sends a frame to the server over the user's session, renegotiating
+        once if the server rejects the session key
+
+        Params:
+            user: the user id
+            args, kwargs: the arguments of `Client.read_data`
+
+        Returns:
+            the server response
+        """
+        session = self.get(user)
+        response = session.send(*args, **kwargs)
+        if response.status_code != 401:
+            return response
+
+        logger.warning("session of %s rejected by the server, renegotiating",
+                       user)
+        self.invalidate(user, session)
+        session = self.get(user)
+        return session.send(*args, **kwargs)
@@ -33,7 +33,7 @@ pkgs.mkShell {
         )
 
     source ./venv/bin/activate
-    pip install 'keras==2.15' pyDH 'tensorflow==2.15' tensorflow_hub --upgrade
+    pip install 'keras==2.15' pyDH 'tensorflow==2.15' tensorflow_hub aiohttp h5py --upgrade
     ./venv/bin/python main.py
 
     '';
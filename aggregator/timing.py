@@ -0,0 +1,160 @@
+"""
+Timing helpers of the benchmark suites: latency percentiles and throughput
+of each stage, reported as JSON and compared to a stored baseline
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+
+import numpy as np
+
+
+def measure(fn, runs=50, warmup=3, items=1):
+    """
+    Times a stage
+
+    Params:
+        fn: function running the stage once
+        runs: number of timed runs
+        warmup: untimed runs done first
+        items: number of items (frames, poses) processed per run
+
+    Returns:
+        dict of the p50/p95/p99/mean latencies (ms) and the throughput
+        (items per second)
+    """
+    for _ in range(warmup):
+        fn()
+    timings = np.empty(runs)
+    for i in range(runs):
+        start = time.perf_counter()
+        fn()
+        timings[i] = time.perf_counter() - start
+    return {
+        "runs": runs,
+        "items": items,
+        "p50_ms": float(np.percentile(timings, 50) * 1000),
+        "p95_ms": float(np.percentile(timings, 95) * 1000),
+        "p99_ms": float(np.percentile(timings, 99) * 1000),
+        "mean_ms": float(np.mean(timings) * 1000),
+        "throughput": float(items * runs / np.sum(timings)),
+    }
+
+
+def synthetic_image(height, width, seed=0):
+    """
+    Smooth gradient with some noise, compressing like a camera frame would
+    rather than like pure noise
+    """
+    rng = np.random.default_rng(seed)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, np.newaxis]
+    x = np.linspace(0, 255, width, dtype=np.float32)[np.newaxis, :]
+    image = np.stack([y + 0 * x, x + 0 * y, (x + y) / 2], axis=-1)
+    image += rng.normal(0, 8, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def compare_reports(report, baseline, tolerance=0.10,
+                    metrics=("p50_ms", "p95_ms")):
+    """
+    Finds the stages that got slower than in the baseline
+
+    Params:
+        report: the current report (output of `run_suite`)
+        baseline: a stored report
+        tolerance: relative slowdown allowed before flagging a stage
+        metrics: latency metrics compared
+
+    Returns:
+        list of (stage, metric, baseline value, current value)
+    """
+    regressions = []
+    for stage, stats in report["stages"].items():
+        base = baseline["stages"].get(stage)
+        if base is None:
+            continue
+        for metric in metrics:
+            if stats[metric] > base[metric] * (1 + tolerance):
+                regressions.append((stage, metric, base[metric],
+                                    stats[metric]))
+    return regressions
+
+
+def run_suite(stages, runs=50, warmup=3):
+    """
+    Times each stage
+
+    Params:
+        stages: iterable of (name, fn, items)
+
+    Returns:
+        the report as a dict
+    """
+    report = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "runs": runs,
+        "stages": {},
+    }
+    for name, fn, items in stages:
+        stats = measure(fn, runs, warmup, items)
+        report["stages"][name] = stats
+        print(f"{name:40} p50 {stats['p50_ms']:9.3f} ms  "
+              f"p95 {stats['p95_ms']:9.3f} ms  "
+              f"p99 {stats['p99_ms']:9.3f} ms  "
+              f"{stats['throughput']:10.1f}/s", file=sys.stderr)
+    return report
+
+
+def main(build_stages, argv=None):
+    """
+    Command line of a benchmark suite
+
+    Params:
+        build_stages: function taking (image sizes, batch sizes) and
+            returning the (name, fn, items) stages
+        argv: the arguments (defaults to sys.argv)
+
+    Returns:
+        the exit status, 1 if a stage regressed against the baseline
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--sizes", nargs="+", default=["480x640", "720x1280",
+                                                       "1080x1920"],
+                        help="image sizes as HEIGHTxWIDTH")
+    parser.add_argument("--batches", nargs="+", type=int, default=[1, 4, 8])
+    parser.add_argument("--only", nargs="+", default=None,
+                        help="run only the stages starting with these names")
+    parser.add_argument("--output", help="write the JSON report to a file")
+    parser.add_argument("--baseline", help="JSON report to compare to")
+    parser.add_argument("--tolerance", type=float, default=0.10)
+    args = parser.parse_args(argv)
+
+    sizes = [tuple(int(v) for v in size.split("x")) for size in args.sizes]
+    stages = build_stages(sizes, args.batches)
+    if args.only:
+        stages = [stage for stage in stages
+                  if stage[0].split("/")[0] in args.only]
+    report = run_suite(stages, args.runs, args.warmup)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_reports(report, baseline, args.tolerance)
+        for stage, metric, base, current in regressions:
+            print(f"REGRESSION {stage} {metric}: {base:.3f} -> "
+                  f"{current:.3f} ms", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
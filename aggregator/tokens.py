@@ -0,0 +1,62 @@
+"""
+Sessions negotiated by the peers of this tier, looked up by the encrypted
+user id (token) sent with each frame, so several sessions of the same user
+each keep their own secret
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenTable:
+    """
+    token -> (user id, shared secret), with LRU eviction and an idle
+    timeout; a peer whose session was dropped gets a 401 and renegotiates
+
+    Params:
+        max_sessions: maximum number of sessions kept
+        ttl: seconds after which an unused session is dropped
+    """
+
+    def __init__(self, max_sessions=1024, ttl=3600):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        # token -> (user, secret, last use)
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def add(self, token, user, secret):
+        now = time.monotonic()
+        with self.lock:
+            self.sessions[token] = (user, secret, now)
+            self.sessions.move_to_end(token)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+            # the oldest entries come first, stop at the first live one
+            while self.sessions:
+                oldest = next(iter(self.sessions.values()))
+                if now - oldest[2] < self.ttl:
+                    break
+                self.sessions.popitem(last=False)
+
+    def get(self, token):
+        """
+        Returns:
+            (user id, shared secret) of the token, or None if unknown or
+            expired
+        """
+        now = time.monotonic()
+        with self.lock:
+            session = self.sessions.get(token)
+            if session is None:
+                return None
+            user, secret, last = session
+            if now - last >= self.ttl:
+                del self.sessions[token]
+                return None
+            self.sessions[token] = (user, secret, now)
+            self.sessions.move_to_end(token)
+            return user, secret
+
+    def __len__(self):
+        return len(self.sessions)
@@ -1,15 +1,24 @@
+import os
 import sys
 import tensorflow as tf
 import gzip
-import numpy as np
-import gzip
 
 from cryptography.fernet import Fernet
 from pyDH import DiffieHellman
 import base64
 
+import random
+import time
 import requests
 
+from frame import (pack_frame, new_trace_id, CONTENT_TYPE, STREAM_FRAME,
+                   STREAM_START, STREAM_END)
+from stream import video_frames
+from log import get_logger, summarize
+
+logger = get_logger("client")
+
+
 def capture_photo():
     """
     TODO
@@ -30,14 +39,34 @@ def get_photo(path):
     """
     img = tf.image.decode_image(tf.io.read_file(path))
     shape = img.shape
-    print(shape)
     img = img.numpy().flatten()
-    print(img)
+    logger.debug("read %s of shape %s", summarize(img), shape)
     return (img, shape)
 
+# content types of the image files sent without being decoded
+CONTENT_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+}
+
+def get_encoded_photo(path):
+    """
+    Reads an encoded photo (jpeg, png) from the disk without decoding it
+
+    Returns:
+        (encoded bytes, content type), or None if the file format is not
+        one of `CONTENT_TYPES`
+    """
+    content_type = CONTENT_TYPES.get(os.path.splitext(path)[1].lower())
+    if content_type is None:
+        return None
+    with open(path, "rb") as f:
+        return (f.read(), content_type)
+
 class Client:
 
-    def __init__(self, server_ip: str, server_port: str, id: str, device: str, parse_ip = False):
+    def __init__(self, server_ip: str, server_port: str, id: str, device: str, parse_ip = False, encoded = False):
         if parse_ip:
             self.server_ip = sys.argv[2]
         else:
@@ -46,12 +75,26 @@ class Client:
         self.server_port = server_port
         self.id = id
         self.device = device
+        # send the encoded image instead of its gzip compressed pixels
+        self.encoded = encoded
+        self.content_type = None
+        # MoveNet and classifier outputs sent along the frame, as an
+        # aggregator does, when talking to the server directly
+        self.movenet = None
+        self.category = None
+        # set while a video stream is being sent
+        self.stream_id = None
+        self.seq = 0
+        # keep-alive connection reused by every request of this client
+        self.http = requests.Session()
+        # seconds to wait for the answer to a frame
+        self.timeout = 1000000
 
     def gen_credintals(self):
         self.dh = DiffieHellman()
         self.pub_key = self.dh.gen_public_key()
 
-        response = requests.get(
+        response = self.http.get(
                 url="http://"+self.server_ip+":"+self.server_port+"/key"
                 )
         if response.ok:
@@ -65,11 +108,10 @@ class Client:
                     )
             self.id = self.fernet.encrypt(str.encode(self.id))
         else:
-            print("Failed to establish credintals!")
-            exit(1)
+            raise ConnectionError("Failed to establish credintals!")
 
     def share_secret(self):
-        response = requests.get(
+        response = self.http.get(
                 url="http://"+self.server_ip+":"+self.server_port+"/",
                 json={
                     "pubkey": self.pub_key,
@@ -81,44 +123,140 @@ class Client:
             # self.server_pubkey = int(json_rsp.get("pubkey"))
             # self.secret = self.dh.gen_shared_key(self.server_pubkey)
             # self.fernet = Fernet(base64.b64encode(self.secret[:32].encode()))
-            print("secret shared!")
+            logger.info("secret shared with %s", self.server_ip)
         else:
-            exit(1)
+            raise ConnectionError("Failed to share the secret!")
 
-    def read_data(self, capture=False, parse_path=False, path=""):
+    def read_data(self, capture=False, parse_path=False, path="", frame=None):
         """
         Reads data to send
 
         Params:
             capture: either to capture the photo live or to get 
             it from disk
+            frame: an already decoded frame (e.g. from `video_frames`)
         """
         if capture:
             pass
         if parse_path:
             path = sys.argv[1]
-            (img, self.shape) = get_photo(path)
-            img = gzip.compress(img)
-            self.encrypted_data = self.fernet.encrypt(img)
+        self.content_type = None
+        if frame is not None:
+            self.shape = frame.shape
+            if self.encoded:
+                img = tf.io.encode_jpeg(frame).numpy()
+                self.content_type = "image/jpeg"
+            else:
+                img = gzip.compress(frame.tobytes())
         else:
-            (img, self.shape) = get_photo(path)
-            img = gzip.compress(img)
-            self.encrypted_data = self.fernet.encrypt(img)
+            encoded = get_encoded_photo(path) if self.encoded else None
+            if encoded is not None:
+                # the receiver gets the shape when decoding the image
+                (img, self.content_type) = encoded
+                self.shape = ()
+            else:
+                (img, self.shape) = get_photo(path)
+                img = gzip.compress(img)
+        self.encrypted_data = self.fernet.encrypt(img)
 
-    def send_data(self):
-        print("sending...")
-        status = requests.post(
-                url="http://"+self.server_ip+":"+self.server_port+"/publish",
-                json={
-                    "data": self.encrypted_data.__str__(),
-                    "shape": self.shape.__str__(),
-                    "user": self.id.__str__(),
-                    "device": self.device.__str__(),
-                    },
-                timeout=1000000
+    def send_data(self, retries=0, backoff=0.1):
+        """
+        Sends the data read by `read_data`
+
+        Params:
+            retries: number of times the frame is sent again while the
+                aggregator answers 429 (its queue is full)
+            backoff: first wait (seconds) before sending again, doubled on
+                each retry
+
+        Returns:
+            the response of the aggregator
+        """
+        stream = None
+        if self.stream_id is not None:
+            stream = (self.stream_id, self.seq, STREAM_FRAME)
+            self.seq += 1
+        # followed through the aggregator and the server into the MQTT
+        # payloads of the frame
+        self.trace = new_trace_id()
+        data = pack_frame(
+                self.encrypted_data,
+                self.shape,
+                self.id,
+                self.device,
+                movenet=self.movenet,
+                category=self.category,
+                stream=stream,
+                content_type=self.content_type,
+                trace=self.trace,
                 )
+        url = "http://"+self.server_ip+":"+self.server_port+"/publish"
+        for attempt in range(retries + 1):
+            status = self.http.post(
+                    url=url,
+                    data=data,
+                    headers={"Content-Type": CONTENT_TYPE},
+                    timeout=self.timeout
+                    )
+            if status.status_code != 429 or attempt == retries:
+                break
+            delay = min(backoff * 2 ** attempt, 2.0)
+            logger.debug("aggregator busy, sending again in %.2fs", delay,
+                         extra={"trace": self.trace})
+            time.sleep(delay)
         if not status.ok:
-            print("Error occured while sending the data")
-            exit(1)
+            logger.warning("the aggregator refused the data (%d)",
+                           status.status_code, extra={"trace": self.trace})
         else:
-            print("data sent sucessfully!")
+            logger.debug("data sent", extra={"trace": self.trace})
+        return status
+
+    def send_marker(self, marker):
+        """
+        Sends a stream start/end marker (a frame without image)
+        """
+        status = self.http.post(
+                url="http://"+self.server_ip+":"+self.server_port+"/publish",
+                data=pack_frame(
+                    b"",
+                    (),
+                    self.id,
+                    self.device,
+                    stream=(self.stream_id, self.seq, marker),
+                    ),
+                headers={"Content-Type": CONTENT_TYPE},
+                timeout=self.timeout
+                )
+        if not status.ok:
+            logger.warning("the aggregator refused the stream marker (%d)",
+                           status.status_code)
+        return status
+
+    def send_video(self, path, fps=5, retries=5):
+        """
+        Streams a video file, frame by frame, between a start and an end
+        marker
+
+        Params:
+            path: path to the video file
+            fps: number of frames per second of video to send
+            retries: number of times a frame is sent again while the
+                aggregator is busy (429)
+
+        Returns:
+            True if every frame was accepted
+        """
+        self.stream_id = random.getrandbits(32)
+        self.seq = 0
+        if not self.send_marker(STREAM_START).ok:
+            self.stream_id = None
+            return False
+        try:
+            for frame in video_frames(path, fps):
+                self.read_data(frame=frame)
+                if not self.send_data(retries).ok:
+                    return False
+        finally:
+            self.send_marker(STREAM_END)
+            self.stream_id = None
+        return True
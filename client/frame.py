@@ -0,0 +1,288 @@
+"""
+Binary frame envelope exchanged on the `/publish` routes.
+
+Layout (network byte order):
+
+    header   magic "PF", version, flags, dtype code, ndim,
+             number of tensors, user length, device length, body length
+    shape    ndim * uint32
+    user     the Fernet encrypted user id (raw token bytes)
+    device   utf-8 device id
+    tensors  tag, dtype code, ndim, ndim * uint32, raw tensor bytes
+    stream   (only with FLAG_STREAM) stream id, sequence number, marker
+    encoding (only with FLAG_ENCODED) length and content type of the body
+             when it is an encoded image (jpeg, png) instead of gzip pixels
+    crop     (only with FLAG_CROP) full frame height and width, offset (x, y)
+             and scale of the person crop carried by the body
+    trace    (only with FLAG_TRACE) the 16 bytes trace id given to the frame
+             by the client, followed across the tiers
+    body     the Fernet ciphertext (base64 decoded token), empty for the
+             stream start/end markers
+
+A frame with FLAG_REPEAT carries no image (its body is the encryption of an
+empty payload): the device did not move, the server republishes its last
+results for it without running the models.
+"""
+import struct
+import base64
+import os
+import numpy as np
+
+MAGIC = b"PF"
+VERSION = 1
+CONTENT_TYPE = "application/x-pose-frame"
+
+# tags of the optional tensors carried after the header
+TENSOR_MOVENET = 1
+TENSOR_CATEGORY = 2
+
+# bits of the header flags, each announcing an extension after the tensors
+FLAG_STREAM = 0x01
+FLAG_ENCODED = 0x02
+FLAG_CROP = 0x04
+FLAG_TRACE = 0x08
+FLAG_REPEAT = 0x10
+_KNOWN_FLAGS = (FLAG_STREAM | FLAG_ENCODED | FLAG_CROP | FLAG_TRACE
+                | FLAG_REPEAT)
+
+# stream markers
+STREAM_FRAME = 0
+STREAM_START = 1
+STREAM_END = 2
+
+DTYPES = {
+    0: np.dtype(np.uint8),
+    1: np.dtype(np.float32),
+    2: np.dtype(np.float64),
+    3: np.dtype(np.int32),
+    4: np.dtype(np.int64),
+}
+DTYPE_CODES = {dtype: code for code, dtype in DTYPES.items()}
+
+_HEADER = struct.Struct("!2sBBBBBHHI")
+_TENSOR = struct.Struct("!BBB")
+_STREAM = struct.Struct("!IIB")
+_ENCODING = struct.Struct("!B")
+_CROP = struct.Struct("!IIIIf")
+_TRACE = struct.Struct("!16s")
+
+
+class FrameError(ValueError):
+    """
+    Raised when a received buffer is not a valid frame envelope
+    """
+    pass
+
+
+class Frame:
+    """
+    A decoded frame envelope
+
+    Attributes:
+        data: the Fernet token of the (compressed) image
+        shape: shape of the image as a tuple
+        dtype: numpy dtype of the image
+        user: the encrypted user id
+        device: the device id as a str
+        tensors: dict of tag -> numpy array (movenet, category)
+        stream: (stream id, sequence number, marker) or None
+        content_type: content type of an encoded image body, None when the
+            body holds gzip compressed pixels
+        crop: (full height, full width, x offset, y offset, scale) when the
+            image is a crop of the full frame, else None
+        trace: the trace id as a hex str, or None
+        repeat: True when the last results of the device are to be
+            republished instead of evaluating an image
+    """
+
+    def __init__(self, data, shape, dtype, user, device, tensors,
+                 stream=None, content_type=None, crop=None, trace=None,
+                 repeat=False):
+        self.data = data
+        self.shape = shape
+        self.dtype = dtype
+        self.user = user
+        self.device = device
+        self.tensors = tensors
+        self.stream = stream
+        self.content_type = content_type
+        self.crop = crop
+        self.trace = trace
+        self.repeat = repeat
+
+    @property
+    def marker(self):
+        """
+        True for the stream start/end markers, which carry no image
+        """
+        return self.stream is not None and self.stream[2] != STREAM_FRAME
+
+    @property
+    def movenet(self):
+        return self.tensors.get(TENSOR_MOVENET)
+
+    @property
+    def category(self):
+        return self.tensors.get(TENSOR_CATEGORY)
+
+
+def new_trace_id():
+    """
+    Returns:
+        a random trace id as a hex str (16 bytes)
+    """
+    return os.urandom(_TRACE.size).hex()
+
+
+def _dims(shape):
+    return struct.pack("!%dI" % len(shape), *[int(d) for d in shape])
+
+
+def _dtype_code(dtype):
+    code = DTYPE_CODES.get(np.dtype(dtype))
+    if code is None:
+        raise FrameError("unsupported dtype: " + str(dtype))
+    return code
+
+
+def pack_frame(data, shape, user, device, dtype=np.uint8, movenet=None,
+               category=None, stream=None, content_type=None, crop=None,
+               trace=None, repeat=False):
+    """
+    Packs a frame into the binary envelope
+
+    Params:
+        data: the Fernet token (bytes) of the image
+        shape: the image shape
+        user: the Fernet token (bytes) of the user id
+        device: the device id
+        dtype: dtype of the image
+        movenet: optional movenet output
+        category: optional classifier output
+        stream: optional (stream id, sequence number, marker)
+        content_type: content type when `data` is an encoded image
+        crop: optional (full height, full width, x offset, y offset, scale)
+        trace: optional trace id (hex str, output of `new_trace_id`)
+        repeat: republish the last results of the device, `data` is then
+            the token of an empty payload
+
+    Returns:
+        the envelope as bytes
+    """
+    tensors = []
+    for tag, tensor in ((TENSOR_MOVENET, movenet),
+                        (TENSOR_CATEGORY, category)):
+        if tensor is None:
+            continue
+        tensor = np.ascontiguousarray(tensor)
+        tensors.append(_TENSOR.pack(tag, _dtype_code(tensor.dtype),
+                                    tensor.ndim))
+        tensors.append(_dims(tensor.shape))
+        tensors.append(tensor.tobytes())
+
+    flags = 0
+    extensions = []
+    if stream is not None:
+        flags |= FLAG_STREAM
+        extensions.append(_STREAM.pack(*stream))
+    if content_type is not None:
+        flags |= FLAG_ENCODED
+        content_type = content_type.encode()
+        extensions.append(_ENCODING.pack(len(content_type)))
+        extensions.append(content_type)
+    if crop is not None:
+        flags |= FLAG_CROP
+        extensions.append(_CROP.pack(*crop))
+    if trace is not None:
+        flags |= FLAG_TRACE
+        extensions.append(_TRACE.pack(bytes.fromhex(trace)))
+    if repeat:
+        flags |= FLAG_REPEAT
+
+    body = base64.urlsafe_b64decode(data)
+    device = str(device).encode()
+    header = _HEADER.pack(MAGIC, VERSION, flags, _dtype_code(dtype),
+                          len(shape), len(tensors) // 3, len(user),
+                          len(device), len(body))
+    return b"".join([header, _dims(shape), user, device, *tensors,
+                     *extensions, body])
+
+
+def unpack_frame(buffer):
+    """
+    Parses a binary envelope
+
+    Params:
+        buffer: the received bytes
+
+    Returns:
+        the decoded `Frame`
+    """
+    view = memoryview(buffer)
+    if len(view) < _HEADER.size:
+        raise FrameError("truncated header")
+    (magic, version, flags, dtype, ndim, ntensors, user_len, device_len,
+     body_len) = _HEADER.unpack_from(view)
+    if magic != MAGIC:
+        raise FrameError("bad magic")
+    if version != VERSION:
+        raise FrameError("unsupported version: " + str(version))
+    if dtype not in DTYPES:
+        raise FrameError("unsupported dtype code: " + str(dtype))
+    if flags & ~_KNOWN_FLAGS:
+        # an extension this version cannot skip, its bytes would be read as
+        # the body
+        raise FrameError("unsupported flags: %#x" % (flags & ~_KNOWN_FLAGS))
+    offset = _HEADER.size
+
+    try:
+        shape = struct.unpack_from("!%dI" % ndim, view, offset)
+        offset += 4 * ndim
+        user = bytes(view[offset:offset + user_len])
+        offset += user_len
+        device = bytes(view[offset:offset + device_len]).decode()
+        offset += device_len
+
+        tensors = {}
+        for _ in range(ntensors):
+            tag, code, tndim = _TENSOR.unpack_from(view, offset)
+            offset += _TENSOR.size
+            tshape = struct.unpack_from("!%dI" % tndim, view, offset)
+            offset += 4 * tndim
+            tdtype = DTYPES[code]
+            size = int(np.prod(tshape)) * tdtype.itemsize
+            tensors[tag] = np.frombuffer(
+                    view[offset:offset + size], dtype=tdtype
+                    ).reshape(tshape)
+            offset += size
+
+        stream = None
+        if flags & FLAG_STREAM:
+            stream = _STREAM.unpack_from(view, offset)
+            offset += _STREAM.size
+
+        content_type = None
+        if flags & FLAG_ENCODED:
+            (length,) = _ENCODING.unpack_from(view, offset)
+            offset += _ENCODING.size
+            content_type = bytes(view[offset:offset + length]).decode()
+            offset += length
+
+        crop = None
+        if flags & FLAG_CROP:
+            crop = _CROP.unpack_from(view, offset)
+            offset += _CROP.size
+
+        trace = None
+        if flags & FLAG_TRACE:
+            (trace,) = _TRACE.unpack_from(view, offset)
+            trace = trace.hex()
+            offset += _TRACE.size
+    except (struct.error, KeyError, ValueError) as e:
+        raise FrameError("malformed frame") from e
+
+    if len(view) - offset != body_len:
+        raise FrameError("body length mismatch")
+    data = base64.urlsafe_b64encode(view[offset:])
+    return Frame(data, shape, DTYPES[dtype], user, device, tensors, stream,
+                 content_type, crop, trace, bool(flags & FLAG_REPEAT))
@@ -0,0 +1,307 @@
+"""
+Load generator simulating many devices sending frames to an aggregator (or
+a server) with the `Client` handshake and `send_data` protocol
+
+Each device runs in its own thread, negotiates its own secret and sends a
+synthetic frame at a fixed rate (plus a random think time). The achieved
+throughput, latency percentiles and error rates are reported as JSON.
+
+An aggregator queuing the frames (`QUEUE_FRAMES=1`, its default) answers 202
+once a frame is queued, so the latency is then only the ingest time. The
+frames processed and failed by its pipeline during the run are read from its
+`/stats` and added to the report; run it with `QUEUE_FRAMES=0` to measure
+the end-to-end latency.
+
+    python loadgen.py --host 192.168.1.212 --devices 8 --fps 5
+    python loadgen.py --stub --devices 32 --fps 10 --duration 60
+    python loadgen.py --host <server> --port 8080 --server --devices 8
+"""
+import argparse
+import collections
+import json
+import random
+import sys
+import threading
+import time
+
+import numpy as np
+import requests
+
+from client import Client
+import log
+
+
+def synthetic_image(height, width, seed=0):
+    """
+    Smooth gradient with some noise, compressing like a camera frame would
+    rather than like pure noise
+    """
+    rng = np.random.default_rng(seed)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, np.newaxis]
+    x = np.linspace(0, 255, width, dtype=np.float32)[np.newaxis, :]
+    image = np.stack([y + 0 * x, x + 0 * y, (x + y) / 2], axis=-1)
+    image += rng.normal(0, 8, image.shape)
+    return np.clip(image, 0, 255).astype(np.uint8)
+
+
+class Results:
+    """
+    Latencies and outcomes of the frames sent by all the devices
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.outcomes = collections.Counter()
+        self.handshake_failures = 0
+        self.late = 0
+
+    def record(self, latency, outcome):
+        with self.lock:
+            self.latencies.append(latency)
+            self.outcomes[outcome] += 1
+
+    def report(self, duration):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            outcomes = dict(self.outcomes)
+        sent = int(sum(outcomes.values()))
+        ok = sum(count for outcome, count in outcomes.items()
+                 if isinstance(outcome, int) and outcome < 400)
+        report = {
+            "duration": duration,
+            "sent": sent,
+            "ok": ok,
+            "outcomes": {str(outcome): count
+                         for outcome, count in outcomes.items()},
+            "error_rate": (sent - ok) / sent if sent else 0.0,
+            "throughput": ok / duration if duration else 0.0,
+            "handshake_failures": self.handshake_failures,
+            "late": self.late,
+        }
+        if len(latencies):
+            report["latency_ms"] = {
+                "p50": float(np.percentile(latencies, 50)),
+                "p95": float(np.percentile(latencies, 95)),
+                "p99": float(np.percentile(latencies, 99)),
+                "mean": float(np.mean(latencies)),
+                "max": float(np.max(latencies)),
+            }
+        return report
+
+
+def synthetic_outputs(seed=0, classes=8):
+    """
+    MoveNet and classifier outputs of a standing person, sent along the
+    frames when the target is the server, which expects them from the
+    aggregator
+
+    Returns:
+        (keypoints_with_scores of shape [1, 1, 17, 3], category of shape
+         [1, classes])
+    """
+    rng = np.random.default_rng(seed)
+    keypoints = np.empty((1, 1, 17, 3), dtype=np.float32)
+    keypoints[..., 0] = np.linspace(0.2, 0.9, 17) + rng.normal(0, 0.01, 17)
+    keypoints[..., 1] = 0.5 + rng.normal(0, 0.05, 17)
+    keypoints[..., 2] = 0.9
+    category = np.zeros((1, classes), dtype=np.float32)
+    category[0, seed % classes] = 1.0
+    return keypoints, category
+
+
+def fetch_stats(args):
+    """
+    Returns:
+        the aggregator's `/stats`, or None if it does not answer them
+    """
+    try:
+        response = requests.get("http://%s:%s/stats" % (args.host, args.port),
+                                timeout=args.timeout)
+    except requests.RequestException:
+        return None
+    return response.json() if response.ok else None
+
+
+def pipeline_report(before, after, drained):
+    """
+    Frames processed and failed by each stage of the aggregator's pipeline
+    between two `/stats`
+
+    Returns:
+        dict of stage -> counts and mean time, or None without a pipeline
+    """
+    if not before or not after or "pipeline" not in after:
+        return None
+    stages = {}
+    for name, stage in after["pipeline"]["stages"].items():
+        previous = before.get("pipeline", {}).get("stages", {}).get(
+                name, {"processed": 0, "errors": 0, "time_avg": 0.0})
+        processed = stage["processed"] - previous["processed"]
+        total = (stage["time_avg"] * stage["processed"] -
+                 previous["time_avg"] * previous["processed"])
+        stages[name] = {
+            "processed": processed,
+            "errors": stage["errors"] - previous["errors"],
+            "queued": stage["queued"],
+            "time_avg_ms": total / processed * 1000 if processed else 0.0,
+        }
+    return {
+        "rejected": (after["pipeline"]["rejected"] -
+                     before.get("pipeline", {}).get("rejected", 0)),
+        "drained": drained,
+        "stages": stages,
+    }
+
+
+def wait_drained(args, timeout):
+    """
+    Waits for the aggregator's pipeline queues to be empty
+
+    Returns:
+        the last `/stats`, and whether the queues were drained
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        stats = fetch_stats(args)
+        if not stats or "pipeline" not in stats:
+            return stats, True
+        queued = sum(stage["queued"]
+                     for stage in stats["pipeline"]["stages"].values())
+        if queued == 0:
+            return stats, True
+        if time.monotonic() > deadline:
+            return stats, False
+        time.sleep(0.2)
+
+
+def run_device(index, args, image, stop_at, results):
+    """
+    Simulates a device until `stop_at` (time.monotonic)
+    """
+    client = Client(args.host, str(args.port), "loadgen-" + str(index),
+                    str(index), encoded=args.encoded)
+    client.timeout = args.timeout
+    if args.server:
+        client.movenet, client.category = synthetic_outputs(index)
+    try:
+        client.gen_credintals()
+        client.share_secret()
+    except (ConnectionError, requests.RequestException):
+        with results.lock:
+            results.handshake_failures += 1
+        return
+
+    interval = 1 / args.fps
+    # spread the devices over the first interval
+    next_at = time.monotonic() + random.uniform(0, interval)
+    while next_at < stop_at:
+        now = time.monotonic()
+        if next_at > now:
+            time.sleep(next_at - now)
+        client.read_data(frame=image)
+        start = time.perf_counter()
+        try:
+            outcome = client.send_data().status_code
+        except requests.RequestException as e:
+            outcome = type(e).__name__
+        results.record(time.perf_counter() - start, outcome)
+
+        next_at += interval + random.uniform(0, args.think)
+        if next_at < time.monotonic():
+            # behind schedule: send right away instead of bursting to
+            # catch up
+            with results.lock:
+                results.late += 1
+            next_at = time.monotonic()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--devices", type=int, default=4)
+    parser.add_argument("--fps", type=float, default=5,
+                        help="frames per second sent by each device")
+    parser.add_argument("--think", type=float, default=0.0,
+                        help="maximum random pause (s) added between frames")
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--sizes", nargs="+", default=["480x640"],
+                        help="image sizes as HEIGHTxWIDTH, given to the "
+                        "devices in turn")
+    parser.add_argument("--raw", dest="encoded", action="store_false",
+                        help="send gzip compressed pixels instead of JPEG")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--server", action="store_true",
+                        help="the target is the server (port 8080): send "
+                        "synthetic MoveNet and classifier outputs with the "
+                        "frames as the aggregator does")
+    parser.add_argument("--stub", action="store_true",
+                        help="start a local stub server on --port (runs in "
+                        "this process, use stub_server.py for heavy loads)")
+    parser.add_argument("--stub-delay", type=float, default=0.0,
+                        help="processing time (s) of the stub per frame")
+    parser.add_argument("--drain", type=float, default=30,
+                        help="seconds to wait for the aggregator to process "
+                        "its queued frames before reading its /stats")
+    parser.add_argument("--output", help="write the JSON report to a file")
+    parser.add_argument("--verbose", action="store_true",
+                        help="keep the info logs of the clients")
+    args = parser.parse_args(argv)
+    # the clients only log their warnings unless asked to be verbose
+    log.setup(None if args.verbose else "WARNING")
+
+    stub = None
+    if args.stub:
+        import stub_server
+        stub = stub_server.serve(args.port, args.stub_delay, args.host)
+
+    sizes = [tuple(int(v) for v in size.split("x")) for size in args.sizes]
+    images = [synthetic_image(height, width) for height, width in sizes]
+    results = Results()
+    # the stub and the server have no pipeline
+    before = None if args.stub or args.server else fetch_stats(args)
+    start = time.monotonic()
+    stop_at = start + args.duration
+    threads = [
+        threading.Thread(target=run_device,
+                         args=(i, args, images[i % len(images)], stop_at,
+                               results),
+                         daemon=True)
+        for i in range(args.devices)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.monotonic() - start
+    if stub is not None:
+        stub.shutdown()
+
+    report = results.report(duration)
+    if before is not None:
+        after, drained = wait_drained(args, args.drain)
+        pipeline = pipeline_report(before, after, drained)
+        if pipeline is not None:
+            # the 202 only mean queued, what the pipeline did with them
+            report["pipeline"] = pipeline
+            uplink = list(pipeline["stages"].values())[-1]
+            report["completed"] = uplink["processed"] - uplink["errors"]
+            report["completed_throughput"] = report["completed"] / duration
+    report.update({
+        "devices": args.devices,
+        "fps": args.fps,
+        "target_throughput": args.devices * args.fps,
+        "sizes": args.sizes,
+        "encoded": args.encoded,
+    })
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
+    return 0 if report["sent"] and not report["handshake_failures"] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,200 @@
+"""
+Logging shared by the tiers: leveled loggers named after the stages, whose
+records are written by a background thread so a slow stdout never blocks a
+request, with debug output sampled and every call site rate limited so the
+logs can stay on at video rates
+"""
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+# DEBUG, INFO, WARNING or ERROR
+LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# "text" or "json" (one object per line)
+FORMAT = os.environ.get("LOG_FORMAT", "text")
+# fraction of the debug records that are kept
+DEBUG_SAMPLE = float(os.environ.get("LOG_DEBUG_SAMPLE", "0.1"))
+# records per second allowed for each call site, 0 to disable the limit
+RATE_LIMIT = float(os.environ.get("LOG_RATE_LIMIT", "10"))
+
+_listener = None
+_lock = threading.Lock()
+
+
+def get_logger(name):
+    """
+    Params:
+        name: name of the stage or component logging (decrypt, inference,
+            uplink, publisher, ...)
+
+    Returns:
+        the logger of that stage
+    """
+    return logging.getLogger(name)
+
+
+class _Summary:
+    """
+    Lazy description of a value, only computed if the record passes the
+    filters
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        value = self.value
+        if hasattr(value, "shape") and hasattr(value, "dtype"):
+            return "<%s shape=%s dtype=%s>" % (type(value).__name__,
+                                               tuple(value.shape), value.dtype)
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return "<%d bytes>" % len(value)
+        if isinstance(value, (list, tuple, dict)):
+            return "<%s of %d>" % (type(value).__name__, len(value))
+        text = str(value)
+        return text if len(text) <= 80 else text[:77] + "..."
+
+
+def summarize(value):
+    """
+    Describes arrays, tensors and buffers by their shape and size instead of
+    their content
+
+    Params:
+        value: value to log
+
+    Returns:
+        an object whose string is the description
+    """
+    return _Summary(value)
+
+
+class SampleFilter(logging.Filter):
+    """
+    Keeps a fraction of the debug records and at most `rate` records per
+    second from each call site, the number of records dropped by the limit is
+    appended to the next one written
+
+    Params:
+        sample: fraction of the debug records kept
+        rate: records per second allowed for each call site, 0 for no limit
+    """
+
+    def __init__(self, sample=1.0, rate=0.0):
+        super().__init__()
+        self.sample = sample
+        self.rate = rate
+        self.lock = threading.Lock()
+        # call site -> (tokens left, last refill, records dropped)
+        self.sites = {}
+
+    def filter(self, record):
+        if record.levelno <= logging.DEBUG and self.sample < 1.0 \
+                and random.random() >= self.sample:
+            return False
+        if self.rate <= 0:
+            return True
+        site = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+        with self.lock:
+            tokens, last, dropped = self.sites.get(site, (self.rate, now, 0))
+            tokens = min(self.rate, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.sites[site] = (tokens, now, dropped + 1)
+                return False
+            self.sites[site] = (tokens - 1, now, 0)
+        record.suppressed = dropped
+        return True
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # the arguments are formatted here, before the request thread can
+        # change them (the filters ran already, dropped records cost
+        # nothing), the traceback is left to the formatters
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        text = super().format(record)
+        trace = getattr(record, "trace", None)
+        if trace:
+            text += " trace=" + trace
+        if getattr(record, "suppressed", 0):
+            text += " (%d similar suppressed)" % record.suppressed
+        return text
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        trace = getattr(record, "trace", None)
+        if trace:
+            entry["trace"] = trace
+        if getattr(record, "suppressed", 0):
+            entry["suppressed"] = record.suppressed
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def setup(level=None, fmt=None, stream=None):
+    """
+    Routes the records of every logger through a queue to a background
+    thread writing them to `stream`, can be called more than once
+
+    Params:
+        level: minimum level, defaults to `LOG_LEVEL`
+        fmt: "text" or "json", defaults to `LOG_FORMAT`
+        stream: where the records are written, defaults to stderr
+    """
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return
+        output = logging.StreamHandler(stream or sys.stderr)
+        output.setFormatter(JsonFormatter() if (fmt or FORMAT) == "json"
+                            else TextFormatter())
+        records = queue.SimpleQueue()
+        handler = _QueueHandler(records)
+        handler.addFilter(SampleFilter(DEBUG_SAMPLE, RATE_LIMIT))
+        root = logging.getLogger()
+        for previous in list(root.handlers):
+            root.removeHandler(previous)
+        root.addHandler(handler)
+        root.setLevel(level or LEVEL)
+        _listener = logging.handlers.QueueListener(records, output)
+        _listener.start()
+        atexit.register(shutdown)
+
+
+def shutdown():
+    """
+    Writes the records left in the queue and stops the background thread
+    """
+    global _listener
+    with _lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        _listener = None
@@ -7,6 +7,10 @@ import numpy as np
 from addons import (get_yaw, rotate_pose, collect_angles)
 from movenet import (use_movenet, use_classifier, load_movenet, load_classifier)
 from client import Client
+from stream import is_video
+from log import get_logger, summarize
+import log
+import sys
 import tensorflow_hub as hub
 
 
@@ -14,6 +18,7 @@ keypoints_name = 'human4d_32'
 ground_truth_angle = 90
 
 app = Flask(__name__)
+logger = get_logger("client")
 
 # Example user credentials
 users = {
@@ -54,7 +59,7 @@ def announce():
 @app.route('/', methods=['GET', 'POST'])
 def establish():
     json_body_request = request.get_json()
-    print("values: ", request.get_json())
+    logger.debug("key exchange request: %s", json_body_request)
     end_pubkey = json_body_request.get("pubkey")
     end_name = json_body_request.get("user")
     global shared_secret
@@ -66,7 +71,7 @@ def establish():
             )
     end_name = f.decrypt(end_name[2:-1].encode())
     users[end_name] = shared_secret
-    print("shared secret: ", shared_secret)
+    logger.info("session established for %s", end_name)
     return {"pubkey": pubkey.__str__()}
 
 
@@ -93,7 +98,7 @@ def process():
     decrypted_data = fernet.decrypt(data[2:-1].encode())
     decompressed = gzip.decompress(decrypted_data)
     data_array = np.frombuffer(decompressed, dtype=np.uint8)
-    print("data array:", data_array)
+    logger.debug("received %s of shape %s", summarize(data_array), shape)
     pose = use_movenet(np.reshape(data_array, shape), model)
     category = use_classifier(pose, classifier)
 
@@ -106,8 +111,17 @@ if __name__ == '__main__':
     print("""
     This File is meant to run on the client side
     """)
-    client = Client("192.168.1.212", "8081", "user", "4", parse_ip=True)
+    log.setup()
+    client = Client("192.168.1.212", "8081", "user", "4", parse_ip=True,
+                    encoded=True)
     client.gen_credintals()
     client.share_secret()
-    client.read_data(parse_path=True)
-    client.send_data()
+    if is_video(sys.argv[1]):
+        # optional third argument: frames per second to sample
+        fps = float(sys.argv[3]) if len(sys.argv) > 3 else 5
+        if not client.send_video(sys.argv[1], fps):
+            exit(1)
+    else:
+        client.read_data(parse_path=True)
+        if not client.send_data().ok:
+            exit(1)
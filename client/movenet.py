@@ -3,10 +3,13 @@ import tensorflow_hub as hub
 import numpy as np
 
 import enum
+from log import get_logger
 """
 This file is meant to test the movenet and pose classifier on the raspberry pi
 """
 
+logger = get_logger("movenet")
+
 
 class BodyPart(enum.Enum):
     """
@@ -64,7 +67,7 @@ def use_movenet(img, movenet):
     outputs = movenet(image)
     # Output is a [1, 1, 17, 3] tensor.
     keypoints_with_scores = outputs['output_0'].numpy()
-    print("keypoints_with_scores: ", keypoints_with_scores)
+    logger.debug("keypoints with scores: %s", keypoints_with_scores)
     return keypoints_with_scores
 
 
@@ -219,5 +222,5 @@ def use_classifier(keypoints_with_scores, classifier):
     # person_from_keypoint(keypoints_with_scores, 256, 256)
     keypoints = extract_keypoints(keypoints_with_scores)
     preprocesed = preprocess(keypoints)
-    print("using classifier")
+    logger.debug("using classifier")
     return classify(preprocesed, classifier)
@@ -0,0 +1,63 @@
+"""
+Video file ingestion: decodes a video with ffmpeg into RGB frames sampled at
+a target frame rate, one frame in memory at a time
+"""
+import subprocess
+
+import numpy as np
+
+VIDEO_EXTENSIONS = (".mp4", ".mkv", ".avi", ".mov", ".webm")
+
+
+def is_video(path):
+    return path.lower().endswith(VIDEO_EXTENSIONS)
+
+
+def probe_video(path):
+    """
+    Reads the size of the first video stream of a file
+
+    Returns:
+        (width, height)
+    """
+    output = subprocess.run(
+            ["ffprobe", "-v", "error", "-select_streams", "v:0",
+             "-show_entries", "stream=width,height", "-of", "csv=p=0:s=x",
+             path],
+            capture_output=True, check=True, text=True
+            ).stdout
+    width, height = output.strip().split("x")[:2]
+    return (int(width), int(height))
+
+
+def video_frames(path, fps=5):
+    """
+    Decodes a video file as a generator of frames
+
+    Params:
+        path: path to the video file
+        fps: number of frames per second of video to keep
+
+    Returns:
+        generator of uint8 arrays of shape (height, width, 3)
+    """
+    width, height = probe_video(path)
+    frame_size = width * height * 3
+    # -noautorotate keeps the decoded frames at the probed size
+    process = subprocess.Popen(
+            ["ffmpeg", "-loglevel", "error", "-noautorotate", "-i", path,
+             "-vf", "fps=" + str(fps), "-f", "rawvideo", "-pix_fmt", "rgb24",
+             "-"],
+            stdout=subprocess.PIPE, bufsize=frame_size
+            )
+    try:
+        while True:
+            buffer = process.stdout.read(frame_size)
+            if len(buffer) < frame_size:
+                return
+            yield np.frombuffer(buffer, dtype=np.uint8).reshape(
+                    (height, width, 3))
+    finally:
+        process.stdout.close()
+        process.kill()
+        process.wait()
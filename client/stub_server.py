@@ -0,0 +1,102 @@
+"""
+Stand-in for the aggregator (or the server) speaking the same `/key`, `/`
+and `/publish` protocol, so the load generator can run fully locally
+
+It negotiates the secrets and decrypts the frames like the real services,
+then waits `delay` seconds instead of running the models.
+
+    python stub_server.py [port] [delay]
+"""
+import base64
+import logging
+import sys
+import threading
+import time
+
+from cryptography.fernet import Fernet, InvalidToken
+from flask import Flask, request
+from pyDH import DiffieHellman
+from werkzeug.serving import make_server
+
+from frame import unpack_frame, FrameError
+
+app = Flask(__name__)
+# seconds spent "processing" each frame
+delay = 0.0
+# encrypted user id (as sent by the devices) -> Fernet of its secret
+sessions = {}
+lock = threading.Lock()
+counters = {"frames": 0, "markers": 0, "rejected": 0}
+
+d1 = DiffieHellman()
+pubkey = d1.gen_public_key()
+
+
+@app.route('/key', methods=['GET'])
+def announce():
+    return {"pubkey": pubkey.__str__()}
+
+
+@app.route('/', methods=['GET', 'POST'])
+def establish():
+    json_body_request = request.get_json()
+    shared_secret = d1.gen_shared_key(int(json_body_request.get("pubkey")))
+    fernet = Fernet(base64.b64encode(shared_secret[:32].encode()))
+    token = json_body_request.get("user")[2:-1].encode()
+    fernet.decrypt(token)
+    with lock:
+        sessions[token] = fernet
+    return {"pubkey": pubkey.__str__()}
+
+
+@app.route('/publish', methods=['GET', 'POST'])
+def process():
+    try:
+        frame = unpack_frame(request.get_data())
+    except FrameError as e:
+        return "Malformed frame: " + str(e), 400
+    if frame.marker:
+        with lock:
+            counters["markers"] += 1
+        return "OK"
+    fernet = sessions.get(frame.user)
+    try:
+        if fernet is None:
+            raise InvalidToken
+        fernet.decrypt(frame.data)
+    except InvalidToken:
+        with lock:
+            counters["rejected"] += 1
+        return "Unknown session", 401
+    time.sleep(delay)
+    with lock:
+        counters["frames"] += 1
+    return {"trace": frame.trace}
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    with lock:
+        return dict(counters, sessions=len(sessions))
+
+
+def serve(port=8081, processing_delay=0.0, host='127.0.0.1'):
+    """
+    Starts the stub in a background thread
+
+    Returns:
+        the werkzeug server (call `shutdown()` to stop it)
+    """
+    global delay
+    delay = processing_delay
+    # no access log line per frame
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server(host, port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8081
+    app.run(debug=False, port=port, host='0.0.0.0', threaded=True)
@@ -6,6 +6,10 @@ import paho.mqtt.client as mqtt
 from math import exp
 from numpy import interp
 
+from log import get_logger
+
+logger = get_logger("scoring")
+
 
 def yaw_angle(direction):
     """
@@ -54,14 +58,72 @@ def create_yaw_rotation_matrix(yaw_angle_radians):
                      [0,  0, 1]])
 
 def rotate_pose(points, yaw_angle_degrees):
-  yaw_angle_radians = np.deg2rad(yaw_angle_degrees)
-  rotation_matrix = create_yaw_rotation_matrix(yaw_angle_radians)
-  res = []
-  for point in points[0]:
-    temp_point = [point[0], point[2], point[1]]
-    rotated_point = rotate_points(temp_point, rotation_matrix)[0]
-    res.append([rotated_point[0], rotated_point[2], rotated_point[1]])
-  return np.array([res])
+  """
+  Rotates the first pose of `points` (shape (1, 32, 3)) around the vertical
+  axis, see `rotate_poses`
+  """
+  return rotate_poses(points[:1], [yaw_angle_degrees])
+
+def get_yaws(poses):
+    """
+    Batched `get_yaw`: yaw angle of the hips (right hip -> left hip) of each
+    pose
+
+    Args:
+      poses: numpy array of shape (N, 32, 3)
+
+    Returns:
+      array of shape (N,) of yaw angles in degrees
+    """
+    poses = np.asarray(poses)
+    direction = (poses[:, HUMAN4D32.LHIP.value] -
+                 poses[:, HUMAN4D32.RHIP.value])
+    return np.degrees(np.arctan2(direction[:, 0], direction[:, 2]))
+
+# swaps the y and z axes
+_AXIS_SWAP = [0, 2, 1]
+
+def rotate_poses(poses, yaw_angles_degrees):
+    """
+    Rotates N poses around their vertical axis with a single matmul
+
+    The y/z axis swap done around the yaw rotation is folded into the
+    rotation matrices, so each pose is multiplied by one (3, 3) matrix.
+
+    Args:
+      poses: numpy array of shape (N, 32, 3)
+      yaw_angles_degrees: array of shape (N,) of rotation angles
+
+    Returns:
+      the rotated poses, of shape (N, 32, 3)
+    """
+    yaws = np.deg2rad(np.asarray(yaw_angles_degrees, dtype=np.float64))
+    c, s = np.cos(yaws), np.sin(yaws)
+    rotations = np.zeros((len(yaws), 3, 3))
+    rotations[:, 0, 0] = c
+    rotations[:, 0, 1] = -s
+    rotations[:, 1, 0] = s
+    rotations[:, 1, 1] = c
+    rotations[:, 2, 2] = 1
+    # row vectors are multiplied by (swap . R . swap)^T
+    transforms = np.swapaxes(rotations, 1, 2)[:, _AXIS_SWAP][:, :, _AXIS_SWAP]
+    return np.matmul(np.asarray(poses), transforms)
+
+def canonicalize_poses(poses, target_yaw=90.0):
+    """
+    Normalizes the view of N poses: each pose is rotated around its vertical
+    axis so its hips have the yaw `target_yaw` (90 puts the hips along the x
+    axis, i.e. facing the camera)
+
+    Args:
+      poses: numpy array of shape (N, 32, 3)
+      target_yaw: yaw angle (degrees) of the hips after rotation
+
+    Returns:
+      (canonical poses of shape (N, 32, 3), original yaws of shape (N,))
+    """
+    yaws = get_yaws(poses)
+    return rotate_poses(poses, yaws - target_yaw), yaws
 
 def rotate_points(points, rotation_matrix):
     points = np.atleast_2d(points)
@@ -143,58 +205,60 @@ class HUMAN4D32(Enum):
     LTOE2 = 31
 
 
-def collect_angles(poses):
-    for pose in poses:
-        lelb_angle = extract_angle(pose[HUMAN4D32.LSHO.value],
-                                   pose[HUMAN4D32.LELB.value],
-                                   pose[HUMAN4D32.LWRI.value])
-        relb_angle = extract_angle(pose[HUMAN4D32.RSHO.value],
-                                   pose[HUMAN4D32.RELB.value],
-                                   pose[HUMAN4D32.RWRI.value])
-
-        rknee_angle = extract_angle(pose[HUMAN4D32.RHIP.value],
-                                    pose[HUMAN4D32.RKNE.value],
-                                    pose[HUMAN4D32.RANK.value])
-        lknee_angle = extract_angle(pose[HUMAN4D32.LHIP.value],
-                                    pose[HUMAN4D32.LKNE.value],
-                                    pose[HUMAN4D32.LANK.value])
-
-        lhip_angle = extract_angle(pose[HUMAN4D32.LKNE.value],
-                                    pose[HUMAN4D32.LHIP.value],
-                                    pose[HUMAN4D32.RHIP.value])
-        rhip_angle = extract_angle(pose[HUMAN4D32.RKNE.value],
-                                    pose[HUMAN4D32.RHIP.value],
-                                    pose[HUMAN4D32.LHIP.value])
-
-        hip_angle = extract_angle(pose[HUMAN4D32.LKNE.value],
-                                    pose[HUMAN4D32.PELV.value],
-                                    pose[HUMAN4D32.RKNE.value])
-
-        lshou_vangle = extract_angle(pose[HUMAN4D32.LELB.value],
-                                    pose[HUMAN4D32.LSHO.value],
-                                    pose[HUMAN4D32.SPIN0.value])
-        lshou_hangle = extract_angle(pose[HUMAN4D32.LELB.value],
-                                    pose[HUMAN4D32.LSHO.value],
-                                    pose[HUMAN4D32.NECK.value])
-        rshou_vangle = extract_angle(pose[HUMAN4D32.RELB.value],
-                                    pose[HUMAN4D32.RSHO.value],
-                                    pose[HUMAN4D32.SPIN0.value])
-        rshou_hangle = extract_angle(pose[HUMAN4D32.RELB.value],
-                                    pose[HUMAN4D32.RSHO.value],
-                                    pose[HUMAN4D32.NECK.value])
+# Angles measured on a pose, as (name, a, b, c) where the angle is the one at
+# `b` between the segments `b -> a` and `b -> c`; the order is the order of
+# the columns of `joint_angles` and of the keys of `collect_angles`
+ANGLES = (
+    ("lelb", HUMAN4D32.LSHO, HUMAN4D32.LELB, HUMAN4D32.LWRI),
+    ("relb", HUMAN4D32.RSHO, HUMAN4D32.RELB, HUMAN4D32.RWRI),
+    ("lknee", HUMAN4D32.LHIP, HUMAN4D32.LKNE, HUMAN4D32.LANK),
+    ("rknee", HUMAN4D32.RHIP, HUMAN4D32.RKNE, HUMAN4D32.RANK),
+    ("lhip", HUMAN4D32.LKNE, HUMAN4D32.LHIP, HUMAN4D32.RHIP),
+    ("rhip", HUMAN4D32.RKNE, HUMAN4D32.RHIP, HUMAN4D32.LHIP),
+    ("spread", HUMAN4D32.LKNE, HUMAN4D32.PELV, HUMAN4D32.RKNE),
+    ("hlshoulder", HUMAN4D32.LELB, HUMAN4D32.LSHO, HUMAN4D32.SPIN0),
+    ("hrshoulder", HUMAN4D32.LELB, HUMAN4D32.LSHO, HUMAN4D32.NECK),
+    ("vlshoulder", HUMAN4D32.RELB, HUMAN4D32.RSHO, HUMAN4D32.SPIN0),
+    ("vrshoulder", HUMAN4D32.RELB, HUMAN4D32.RSHO, HUMAN4D32.NECK),
+)
+ANGLE_NAMES = [name for name, _, _, _ in ANGLES]
+_ANGLE_INDEX = np.array([[a.value, b.value, c.value]
+                         for _, a, b, c in ANGLES])
+
+
+def _joint_angles(poses):
+    poses = np.asarray(poses)
+    a = poses[:, _ANGLE_INDEX[:, 0]]
+    b = poses[:, _ANGLE_INDEX[:, 1]]
+    c = poses[:, _ANGLE_INDEX[:, 2]]
+    ba = a - b
+    bc = c - b
+    dot_product = np.sum(ba * bc, axis=-1)
+    magnitudes = (np.sqrt(np.sum(ba * ba, axis=-1)) *
+                  np.sqrt(np.sum(bc * bc, axis=-1)))
+    return np.degrees(np.arccos(dot_product / magnitudes))
+
+
+def joint_angles(poses):
+    """
+    Computes all the `ANGLES` of a batch of poses in one pass
+
+    Args:
+        poses: array of shape (N, 32, 3) of `HUMAN4D32` keypoints
 
+    Returns:
+        array of shape (N, len(ANGLES)) of float32 angles in degrees
+    """
+    return _joint_angles(poses).astype(np.float32)
+
+
+def collect_angles(poses):
+    """
+    Collects the angles of the last pose of `poses` as a json object
+    """
+    angles = _joint_angles(poses)[-1]
     return json.dumps({
-      "lelb": round(lelb_angle),
-      "relb": round(relb_angle),
-      "lknee": round(lknee_angle),
-      "rknee": round(rknee_angle),
-      "lhip": round(lhip_angle),
-      "rhip": round(rhip_angle),
-      "spread": round(hip_angle),
-      "hlshoulder": round(lshou_vangle),
-      "hrshoulder": round(lshou_hangle),
-      "vlshoulder": round(rshou_vangle),
-      "vrshoulder": round(rshou_hangle),
+        name: round(float(angle)) for name, angle in zip(ANGLE_NAMES, angles)
     })
 
 
@@ -284,6 +348,12 @@ def topicFeedback(clientid: str, deviceid: str):
 # each coefficient for angle of each pose represnt how importent the angle
 # is for the pose, each one should range between 2 and 0 where 2 holds
 # the most significant angle and 0 the least significant angle
+# keys of the reference json files and of `coefficients`, in the order of
+# `ANGLES`
+REFERENCE_KEYS = ["lelb", "relb", "lknee", "rknee", "lhip", "rhip",
+                  "spread_ang", "hlshoulder", "hrshoulder", "vlshoulder",
+                  "vrshoulder"]
+
 coefficients = {
     "Dog": {
         "lelb": 0.75,
@@ -383,42 +453,35 @@ def angle_difference(angle1, angle2):
     return min(abs(angle1 - angle2), 360 - abs(angle1 - angle2))
 
 
-def calculate_diffs(pose_name, pose_angles):
-    diffs = {}
-    print("Pose angles:", pose_angles)
-    print("Pose angles type:", type(pose_angles))
+def calculate_diffs(pose_name, pose_angles, references):
+    """
+    Calculates the difference between the pose angles and the reference
+    angles of the pose
+
+    Args:
+      pose_name: position name
+      pose_angles: json object (output of `collect_angles`)
+      references: the `ReferenceTable`
+
+    Returns:
+      dict of angle difference per `REFERENCE_KEYS` key
+    """
     pose_angles = json.loads(pose_angles)
-    with open("venv/json/"+pose_name+".json") as truth:
-        o = json.load(truth)
-
-        diffs["lelb"] = angle_difference(o.get("lelb"), pose_angles.get("lelb"))
-        diffs["relb"] = angle_difference(o.get("relb"), pose_angles.get("relb"))
-        diffs["lknee"] = angle_difference(o.get("lknee"), pose_angles.get("lknee"))
-        diffs["rknee"] = angle_difference(o.get("rknee"), pose_angles.get("rknee"))
-        diffs["lhip"] = angle_difference(o.get("lhip"), pose_angles.get("lhip"))
-        diffs["rhip"] = angle_difference(o.get("rhip"), pose_angles.get("rhip"))
-        diffs["spread_ang"] = angle_difference(o.get("spread_ang"),
-                                               pose_angles.get("spread"))
-        diffs["hlshoulder"] = angle_difference(o.get("hlshoulder"),
-                                               pose_angles.get("hlshoulder"))
-        diffs["hrshoulder"] = angle_difference(o.get("hrshoulder"),
-                                               pose_angles.get("hrshoulder"))
-        diffs["vlshoulder"] = angle_difference(o.get("vlshoulder"),
-                                               pose_angles.get("vlshoulder"))
-        diffs["vrshoulder"] = angle_difference(o.get("vrshoulder"),
-                                               pose_angles.get("vrshoulder"))
-        return diffs
-
-
-def map_coef(pose_name, key):
+    table, pose_id = references.lookup(pose_name)
+    diffs = {}
+    for key, name, truth in zip(REFERENCE_KEYS, ANGLE_NAMES,
+                                table.angles[pose_id]):
+        diffs[key] = angle_difference(truth, pose_angles.get(name))
+    return diffs
+
+
+def map_coef(pose_name, key, references):
     """
     Returns:
       value between 0 and 1
     """
-    thing = coefficients.get(pose_name)
-    coef = thing.get(key)
-    high = max(thing.values())
-    return coef / high
+    table, pose_id = references.lookup(pose_name)
+    return table.mapped[pose_id, REFERENCE_KEYS.index(key)]
 
 
 def calculate_score(diff):
@@ -448,16 +511,17 @@ def calculate_score(diff):
         return interp(v, [25, 45], [0.40, 0.0])
 
 
-def evaluate_diffs(pose_name, diffs):
+def evaluate_diffs(pose_name, diffs, references):
+    table, pose_id = references.lookup(pose_name)
+    weights = table.weights[pose_id]
     evaluated = []
-    for key, value in diffs.items():
-        evaluated.append(calculate_score(value) *
-                         coefficients.get(pose_name).get(key))
-    print(evaluated)
+    for i, key in enumerate(REFERENCE_KEYS):
+        evaluated.append(calculate_score(diffs[key]) * weights[i])
+    logger.debug("weighted scores: %s", evaluated)
     return (sum(evaluated) / 11)
 
 
-def evaluate_pose(pose_angles, pose_name):
+def evaluate_pose(pose_angles, pose_name, references):
     """
     This evaluates a posture based on the extracted angles from the
     `collect_angles` function and outputs a score that represents how
@@ -467,16 +531,21 @@ def evaluate_pose(pose_angles, pose_name):
         pose_name: position name
         pose_angles: json object that represent position
                     angles (output of `collect_angles`)
+        references: the `ReferenceTable` holding the pose references
 
     Returns:
         Score representative of how 'good' the position is, this score
         that ranges between 0 and 1
     """
-    print("pose name:", pose_name)
+    logger.debug("pose name: %s", pose_name)
     if pose_name == "NoPose" or pose_name is None:
         return 0.0
-    diffs = calculate_diffs(pose_name, pose_angles)
-    return evaluate_diffs(pose_name, diffs)
+    _, pose_id = references.lookup(pose_name)
+    if pose_id is None:
+        logger.warning("no reference for pose: %s", pose_name)
+        return 0.0
+    diffs = calculate_diffs(pose_name, pose_angles, references)
+    return evaluate_diffs(pose_name, diffs, references)
 
 
 def get_pose_name(arr):
@@ -488,9 +557,8 @@ def get_pose_name(arr):
             (got from the request 'category')
     """
 
-    print(arr)
     max_index = max(enumerate(arr[0]), key=lambda x: x[1])[0]
-    print("max index:", max_index)
+    logger.debug("classifier output: %s, max index: %d", arr, max_index)
     match max_index:
         case 0:
             return "Chair"
@@ -0,0 +1,107 @@
+"""
+Asyncio serving mode of the server: the same `/key`, `/` and `/publish`
+endpoints as main.py, with decryption, inference and scoring offloaded to a
+thread pool so slow or idle connections don't hold a thread each
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from aiohttp import web
+
+import main
+import metrics
+from log import get_logger
+
+# threads running the crypto and inference stages, MeTRAbs calls are still
+# grouped by the batcher
+workers = int(os.environ.get("WORKERS", "16"))
+logger = get_logger("server")
+
+
+async def run(fn, *args):
+    """
+    Runs a blocking function in the executor
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
+
+
+async def announce(request):
+    return web.json_response(main.announce_key())
+
+
+async def establish(request):
+    body = await request.json()
+    # the Diffie-Hellman modexp is too slow to run on the event loop
+    return web.json_response(await run(main.establish_session, body))
+
+
+async def process(request):
+    start = time.perf_counter()
+    response = await handle(request)
+    metrics.requests_total.inc(status=response.status)
+    metrics.request_seconds.observe(time.perf_counter() - start)
+    return response
+
+
+async def handle(request):
+    data = await request.read()
+    try:
+        job = await run(main.decode_frame, data)
+        if job is None:
+            return web.Response(text="OK")
+        # publishing only enqueues on the MQTT publisher, it does not block
+        content = await run(main.evaluate_frame, job)
+    except main.RequestError as e:
+        logger.warning("refused a frame (%d): %s", e.status, e)
+        return web.Response(text=str(e), status=e.status)
+    if content is None:
+        # nobody detected
+        return web.Response(status=204)
+    return web.Response(body=content, content_type="application/json")
+
+
+async def metrics_endpoint(request):
+    return web.Response(body=metrics.registry.render(),
+                        headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
+async def trace(request):
+    body, status = main.trace_report(request.match_info["trace"])
+    return web.json_response(body, status=status)
+
+
+async def readiness(request):
+    body, status = main.readiness()
+    return web.json_response(body, status=status)
+
+
+async def on_startup(app):
+    asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=workers))
+
+
+def make_app():
+    app = web.Application(client_max_size=64 * 1024 * 1024)
+    app.router.add_get('/key', announce)
+    app.router.add_route('*', '/', establish)
+    app.router.add_route('*', '/publish', process)
+    app.router.add_get('/ready', readiness)
+    app.router.add_get('/metrics', metrics_endpoint)
+    app.router.add_get('/trace/{trace}', trace)
+    app.on_startup.append(on_startup)
+    return app
+
+
+if __name__ == '__main__':
+    print("""
+    Asyncio version of main.py, meant to run on the VPS/Server to recive data
+    from other clients process them, and publish them under the specified
+    topics
+    """)
+    main.setup()
+    try:
+        web.run_app(make_app(), port=8080, host='0.0.0.0')
+    finally:
+        main.teardown()
@@ -0,0 +1,102 @@
+"""
+Registry of the MeTRAbs backends of the server, selected by name in the
+configuration
+
+A backend exposes `detect_poses_batched(images, intrinsic_matrix=...,
+skeleton=...)` returning, for each image, the "boxes", "poses3d" and
+"poses2d" arrays like the MeTRAbs SavedModel. MeTRAbs' detector, crop and
+skeleton conversion only exist as a TF SavedModel function, so there is no
+TFLite or ONNX Runtime backend here (see the aggregator's backends.py for
+MoveNet and the classifier).
+"""
+import threading
+import time
+
+import numpy as np
+
+METRABS_BACKENDS = {}
+
+
+def register(registry, name):
+    """
+    Decorator registering a loader `fn(path, **options)` under `name`
+    """
+    def decorator(fn):
+        registry[name] = fn
+        return fn
+    return decorator
+
+
+def load_metrabs_backend(name, path, **options):
+    """
+    Loads MeTRAbs with the backend registered as `name`
+
+    Params:
+        name: one of `METRABS_BACKENDS`
+        path: path to the model, as expected by the backend
+        options: backend options (e.g. `delay`)
+    """
+    loader = METRABS_BACKENDS.get(name)
+    if loader is None:
+        raise ValueError("Unknown metrabs backend " + repr(name) +
+                         ", available: " + ", ".join(sorted(METRABS_BACKENDS)))
+    return loader(path, **options)
+
+
+class StubMetrabs:
+    """
+    Deterministic MeTRAbs stand-in for performance tests: one person per
+    image, a fixed pose moved by the mean of the image and projected with
+    the given intrinsics, after `delay` seconds per call
+
+    Params:
+        joints: number of joints of the skeleton (32 for human4d_32)
+        delay: seconds spent per call, to emulate the model cost
+    """
+
+    def __init__(self, joints=32, delay=0.0):
+        rng = np.random.default_rng(0)
+        # millimeters, about 3m in front of the camera
+        self.pose = (rng.normal(0, 300, (joints, 3)) +
+                     [0, 0, 3000]).astype(np.float32)
+        self.delay = delay
+        self.lock = threading.Lock()
+
+    def detect_poses_batched(self, images, intrinsic_matrix=None,
+                             skeleton=None):
+        images = np.asarray(images)
+        count, height, width = images.shape[:3]
+        if intrinsic_matrix is None:
+            focal = max(height, width)
+            intrinsic_matrix = np.tile(
+                    np.array([[focal, 0, width / 2], [0, focal, height / 2],
+                              [0, 0, 1]], dtype=np.float32), (count, 1, 1))
+        shift = images.reshape(count, -1).mean(axis=1) / 255 * 100
+        boxes, poses3d, poses2d = [], [], []
+        for i in range(count):
+            pose = self.pose + np.float32(shift[i])
+            projected = pose @ np.asarray(intrinsic_matrix[i]).T
+            pose2d = projected[:, :2] / projected[:, 2:]
+            x0, y0 = pose2d.min(axis=0)
+            x1, y1 = pose2d.max(axis=0)
+            boxes.append(np.array([[x0, y0, x1 - x0, y1 - y0, 0.99]],
+                                  dtype=np.float32))
+            poses3d.append(pose[np.newaxis])
+            poses2d.append(pose2d[np.newaxis].astype(np.float32))
+        if self.delay:
+            # one model call at a time, like the real model on one device
+            with self.lock:
+                time.sleep(self.delay)
+        return {"boxes": boxes, "poses3d": poses3d, "poses2d": poses2d}
+
+
+@register(METRABS_BACKENDS, "savedmodel")
+def _savedmodel_metrabs(path, delay=0.0):
+    import tensorflow_hub as hub
+
+    return hub.load(path)  # Takes about 5 minutes
+
+
+@register(METRABS_BACKENDS, "stub")
+def _stub_metrabs(path, delay=0.0):
+    return StubMetrabs(delay=delay)
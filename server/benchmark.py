@@ -0,0 +1,103 @@
+"""
+Per-stage benchmark of the server: decoding, gzip, Fernet, MeTRAbs, the
+angles, the scoring and the serialization of the MQTT payloads
+
+    python benchmark.py --output report.json
+    python benchmark.py --baseline report.json --only metrabs score
+"""
+import functools
+import gzip
+import json
+import os
+import sys
+
+import numpy as np
+import tensorflow as tf
+from cryptography.fernet import Fernet
+
+from addons import ANGLE_NAMES, canonicalize_poses, collect_angles
+from backends import load_metrabs_backend
+from detection import detect_batch
+from references import ReferenceTable
+from scoring import pose_ids, score_poses
+from timing import main, synthetic_image
+
+keypoints_name = 'human4d_32'
+metrabs_backend = os.environ.get("METRABS_BACKEND", "savedmodel")
+model_path = os.environ.get("METRABS_MODEL", './venv/models/metrabs_s_256/')
+
+
+@functools.lru_cache(maxsize=None)
+def load_model():
+    return load_metrabs_backend(metrabs_backend, model_path)
+
+
+def synthetic_poses(count, seed=0):
+    """
+    Random poses of shape (count, 32, 3) around a standing height (mm)
+    """
+    rng = np.random.default_rng(seed)
+    return rng.normal(0, 400, (count, 32, 3)).astype(np.float32)
+
+
+def build_stages(sizes, batches):
+    """
+    Returns:
+        list of (name, fn, items) stages
+    """
+    stages = []
+    fernet = Fernet(Fernet.generate_key())
+    for height, width in sizes:
+        size = f"{height}x{width}"
+        image = synthetic_image(height, width)
+        jpeg = tf.io.encode_jpeg(image).numpy()
+        compressed = gzip.compress(image.tobytes())
+        token = fernet.encrypt(compressed)
+        stages += [
+            (f"decode/{size}",
+             lambda jpeg=jpeg: tf.io.decode_image(
+                 jpeg, channels=3, expand_animations=False).numpy(), 1),
+            (f"gunzip/{size}",
+             lambda compressed=compressed: gzip.decompress(compressed), 1),
+            (f"fernet_decrypt/{size}",
+             lambda token=token: fernet.decrypt(token), 1),
+        ]
+        for batch in batches:
+            items = [(image, None)] * batch
+            stages.append((f"metrabs/{size}/b{batch}",
+                           lambda items=items: detect_batch(
+                               load_model(), items, keypoints_name), batch))
+
+    references = ReferenceTable("venv/json").current
+    for batch in batches:
+        poses = synthetic_poses(batch)
+        angles = [list(json.loads(collect_angles(pose[np.newaxis])).values())
+                  for pose in poses]
+        ids = pose_ids([references.names[i % len(references.names)]
+                        for i in range(batch)], references)
+        poses2d = np.random.default_rng(0).random((batch, 1, 1, 17, 3))
+        stages += [
+            (f"canonicalize/b{batch}",
+             lambda poses=poses: canonicalize_poses(poses), batch),
+            (f"collect_angles/b{batch}",
+             lambda poses=poses: [collect_angles(pose[np.newaxis])
+                                  for pose in poses], batch),
+            (f"score/b{batch}",
+             lambda angles=angles, ids=ids: score_poses(angles, ids,
+                                                        references), batch),
+            # the three payloads published per frame
+            (f"serialize/b{batch}",
+             lambda poses=poses, poses2d=poses2d, angles=angles: [
+                 (json.dumps({"pose3D": pose[np.newaxis].tolist()}),
+                  json.dumps({"pose2D": pose2d.tolist()}),
+                  json.dumps({"score": 0.5,
+                              "angles": json.dumps(dict(zip(ANGLE_NAMES,
+                                                            values)))}))
+                 for pose, pose2d, values in zip(poses, poses2d, angles)],
+             batch),
+        ]
+    return stages
+
+
+if __name__ == '__main__':
+    sys.exit(main(build_stages))
@@ -0,0 +1,82 @@
+"""
+MeTRAbs detection on batches of frames, shared by the in-process batcher and
+the worker processes
+"""
+import numpy as np
+
+# field of view assumed for the full frames (MeTRAbs' default)
+default_fov_degrees = 55
+
+
+def intrinsic_matrix(shape, crop=None):
+    """
+    Camera intrinsics of an image, assuming MeTRAbs' default field of view
+    for the full frame
+
+    For a person crop, the principal point is moved by the crop offset and
+    everything is scaled by the crop scale, so the 3D poses come out in the
+    camera coordinates of the full frame.
+
+    Params:
+        shape: shape of the image given to MeTRAbs
+        crop: (full height, full width, x offset, y offset, scale) or None
+
+    Returns:
+        float32 array of shape (3, 3)
+    """
+    if crop is None:
+        height, width, x0, y0, scale = shape[0], shape[1], 0, 0, 1.0
+    else:
+        height, width, x0, y0, scale = crop
+    focal = max(height, width) / (
+            np.tan(np.radians(default_fov_degrees) / 2) * 2)
+    return np.array([
+        [focal * scale, 0, (width / 2 - x0) * scale],
+        [0, focal * scale, (height / 2 - y0) * scale],
+        [0, 0, 1],
+        ], dtype=np.float32)
+
+
+def detect_batch(model, items, skeleton):
+    """
+    Runs MeTRAbs once per group of same-sized images, since
+    `detect_poses_batched` takes a dense [N, H, W, 3] batch (the aggregator
+    snaps the person crops to a few square sizes so they share groups)
+
+    Params:
+        model: the loaded MeTRAbs model
+        items: list of (image array, crop or None)
+        skeleton: name of the MeTRAbs skeleton to predict
+
+    Returns:
+        list of predictions (same keys as `detect_poses`) in the same order,
+        with the 2D results of crops mapped back to the full frame
+    """
+    results = [None] * len(items)
+    groups = {}
+    for i, (img, _) in enumerate(items):
+        groups.setdefault(img.shape, []).append(i)
+
+    for indices in groups.values():
+        batch = np.stack([items[i][0] for i in indices])
+        intrinsics = np.stack([intrinsic_matrix(items[i][0].shape,
+                                                items[i][1])
+                               for i in indices])
+        pred = model.detect_poses_batched(batch, intrinsic_matrix=intrinsics,
+                                          skeleton=skeleton)
+        for j, i in enumerate(indices):
+            result = {
+                    key: np.asarray(pred[key][j])
+                    for key in ("boxes", "poses3d", "poses2d")
+                    }
+            crop = items[i][1]
+            if crop is not None:
+                _, _, x0, y0, scale = crop
+                offset = np.array([x0, y0], dtype=np.float32)
+                result["poses2d"] = result["poses2d"] / scale + offset
+                boxes = result["boxes"].copy()
+                boxes[:, :2] = boxes[:, :2] / scale + offset
+                boxes[:, 2:4] = boxes[:, 2:4] / scale
+                result["boxes"] = boxes
+            results[i] = result
+    return results
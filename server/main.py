@@ -1,32 +1,92 @@
 from flask import Flask, request
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken
 import base64
 import gzip
+import zlib
 from pyDH import DiffieHellman
 import numpy as np
-import paho.mqtt.client as mqtt
+from publisher import Publisher
+from batcher import Batcher
+from workers import WorkerPool, Unavailable
+from detection import detect_batch
+from backends import load_metrabs_backend
+from references import ReferenceTable
+from tokens import TokenTable
+from scoring import score_poses, pose_ids
 import json
+import os
+import threading
+from collections import OrderedDict
+import time
 # from paho.mqtt.client import CallbackAPIVersion
-from addons import (evaluate_pose, get_yaw, rotate_pose,
+from addons import (ANGLE_NAMES, canonicalize_poses,
                     collect_angles, topic3D,
                     topicFeedback, topic2D, get_pose_name)
-import tensorflow_hub as hub
+import tensorflow as tf
+from frame import unpack_frame, new_trace_id, FrameError
+from metrics import span
+from log import get_logger
+import log
+import metrics
 
 keypoints_name = 'human4d_32'
 ground_truth_angle = 90
+# concurrent frames are grouped into one MeTRAbs call of at most
+# `max_batch_size` images, the first one waiting at most `max_batch_wait`s
+max_batch_size = int(os.environ.get("MAX_BATCH_SIZE", "8"))
+max_batch_wait = float(os.environ.get("MAX_BATCH_WAIT", "0.02"))
+# rotate the 3D poses so the hips face the camera before publishing them
+normalize_view = os.environ.get("NORMALIZE_VIEW", "1") == "1"
+# MeTRAbs runs in `INFERENCE_WORKERS` processes fed through shared memory
+# when set, else in this process
+inference_workers = int(os.environ.get("INFERENCE_WORKERS", "0"))
+# MeTRAbs backend (one of `METRABS_BACKENDS`), the stub spends
+# `STUB_DELAY` seconds per call instead of running the model
+metrabs_backend = os.environ.get("METRABS_BACKEND", "savedmodel")
+model_path = os.environ.get("METRABS_MODEL", './venv/models/metrabs_s_256/')
+backend_options = {"delay": float(os.environ.get("STUB_DELAY", "0"))}
+
+# the model is loaded in the background by `setup`, frames are refused
+# until `ready` is set
+ready = threading.Event()
+load_error = None
+# sides of the square person crops forwarded by the aggregators (their
+# `CROP_SIDES`)
+crop_sides = [int(side) for side in
+              os.environ.get("CROP_SIDES", "256 384 512").split()]
+# shapes of the frames MeTRAbs is run on once before `ready` is set, so the
+# first requests don't pay the tracing cost (full frames and person crops)
+warmup_shapes = [(480, 640, 3)] + [(side, side, 3) for side in crop_sides]
 
 app = Flask(__name__)
-
-users = {}
-
-
-def calculate_score(processed_image, category):
+logger = get_logger("server")
+session_log = get_logger("session")
+scoring_log = get_logger("scoring")
+publish_log = get_logger("publish")
+
+# point these to a local broker (e.g. mosquitto) for testing
+publisher = Publisher(os.environ.get("MQTT_HOST", "mqtt.eclipseprojects.io"),
+                      int(os.environ.get("MQTT_PORT", "1883")))
+# encrypted user id (as sent by the aggregator) -> (user id, secret), each
+# aggregator session keeps its own secret
+sessions = TokenTable(int(os.environ.get("MAX_SESSIONS", "1024")),
+                      float(os.environ.get("SESSION_TTL", "3600")))
+# (user, device) -> last published (pose3D, score, pose2D, category,
+# response), republished for the repeat frames of the devices that did not
+# move, at most `max_results` devices are kept
+last_results = OrderedDict()
+last_results_lock = threading.Lock()
+max_results = 4096
+
+
+def calculate_score(processed_image, category, trace=None):
     """
     Calculate pose score with additional info
 
     Params:
         processed_img: the output of processed_img
         category: pose category
+        trace: trace id of the frame, added to the payload
 
     Returns:
         the calculated score with additional info
@@ -37,19 +97,20 @@ def calculate_score(processed_image, category):
     """
     # TODO: Stuff goes here later
     angles = processed_image.get("angles")
-    print('angles', angles)
-    print('angles type', type(angles))
+    scoring_log.debug("angles: %s", angles, extra={"trace": trace})
     pose_name = get_pose_name(category)
-    evaluation = evaluate_pose(angles, pose_name)
+    table = references.current
+    values = json.loads(angles)
+    evaluation = float(score_poses([[values[name] for name in ANGLE_NAMES]],
+                                   pose_ids([pose_name], table), table)[0])
 
-    return json.dumps({
+    result = {
             "score": evaluation,
             "angles": angles,
-            })
-
-
-def on_connect(client, userdata, flags, reason_code, properties):
-    print(f"Connected with result code {reason_code}")
+            }
+    if trace is not None:
+        result["trace"] = trace
+    return json.dumps(result)
 
 
 def publish_results(deviceid, userid, pose3D, score, pose2D, category):
@@ -67,36 +128,35 @@ def publish_results(deviceid, userid, pose3D, score, pose2D, category):
     Returns:
      Nothing
     """
-    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-    client.on_connect = on_connect
-    client.on_publish = print("message sent!")
-    client.connect("mqtt.eclipseprojects.io", 1883, 60)
-
-    client.loop_start()
     topic3d = topic3D(userid, deviceid)
-    print("publishing 3D Pose")
-    client.publish(topic=topic3d, payload=pose3D, qos=1)
-    print("3D pose published on", topic3d)
+    publish_log.debug("publishing 3D Pose on %s", topic3d)
+    publisher.publish(topic=topic3d, payload=pose3D, qos=1)
 
     topic2d = topic2D(userid, deviceid)
-    print("publishing 2D Pose")
-    client.publish(topic=topic2d, payload=pose2D, qos=1)
-    print("2D pose published on", topic2d)
+    publish_log.debug("publishing 2D Pose on %s", topic2d)
+    publisher.publish(topic=topic2d, payload=pose2D, qos=1)
 
     topicfeedback = topicFeedback(userid, deviceid)
-    print("publishing feedback on", topicfeedback)
-    client.publish(topic=topicfeedback, payload=score, qos=1)
-    print("feedback published")
-    client.loop_stop()
+    publish_log.debug("publishing feedback on %s", topicfeedback)
+    publisher.publish(topic=topicfeedback, payload=score, qos=1)
+
+
+def detect_poses(items):
+    """
+    Runs MeTRAbs in this process on a batch of (image array, crop or None)
+    """
+    return detect_batch(model, items, keypoints_name)
 
 
-def process_img(img):
+def process_img(img, crop=None):
     """
     Processes the image and returns the 3D poses plus the angles
     in a json object
 
     Params:
         img: the image array
+        crop: (full height, full width, x offset, y offset, scale) when `img`
+            is a person crop of the full frame
 
     Returns:
         json object of format
@@ -104,10 +164,15 @@ def process_img(img):
             "pose3D": [<pose>],
             "angles": [<angle1>, <angle2>, <angleN>],
         }
+        or None if nobody was detected
     """
-    pred = model.detect_poses(img, skeleton=keypoints_name)
-    yaw = get_yaw(pred['poses3d'])
-    rotated = rotate_pose(pred['poses3d'], 0)
+    pred = batcher((img, crop))
+    # only the first detected person is evaluated
+    rotated = np.asarray(pred['poses3d'])[:1]
+    if len(rotated) == 0:
+        return None
+    if normalize_view:
+        rotated, _ = canonicalize_poses(rotated)
     angles = collect_angles(rotated)
     result = {
             "pose3D": rotated,
@@ -115,78 +180,389 @@ def process_img(img):
             }
     return result
 
-def get_pose3d(processed_img):
-    return json.dumps({
+def get_pose3d(processed_img, trace=None):
+    result = {
         "pose3D": processed_img.get("pose3D").tolist()
-        })
+        }
+    if trace is not None:
+        result["trace"] = trace
+    return json.dumps(result)
 
-def get_pose2d(pose2D):
-    return json.dumps({
-        "pose2D": pose2D
-        })
+def get_pose2d(pose2D, trace=None):
+    result = {
+        "pose2D": pose2D.tolist()
+        }
+    if trace is not None:
+        result["trace"] = trace
+    return json.dumps(result)
 
 
-@app.route('/key', methods=['GET'])
-def announce():
+class RequestError(Exception):
+    """
+    Error answered to the sender of a request with the given HTTP status
+    """
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def check_ready():
+    """
+    Refuses the frames while the model is loading
+    """
+    if not ready.is_set():
+        raise RequestError("Model is loading", 503)
+
+
+def readiness():
+    """
+    Returns:
+        (body, status) of the `/ready` endpoint
+    """
+    if ready.is_set():
+        return ({"ready": True}, 200)
+    body = {"ready": False}
+    if load_error is not None:
+        body["error"] = load_error
+    return (body, 503)
+
+
+def announce_key():
     return {"pubkey": pubkey.__str__()}
 
-@app.route('/', methods=['GET', 'POST'])
-def establish():
-    json_body_request = request.get_json()
-    print("values: ", request.get_json())
+
+def establish_session(json_body_request):
+    """
+    Derives the shared secret of an aggregator from its public key
+    """
+    session_log.debug("key exchange request: %s", json_body_request)
     end_pubkey = json_body_request.get("pubkey")
     end_name = json_body_request.get("user")
-    global shared_secret
     shared_secret = d1.gen_shared_key(int(end_pubkey))
     f = Fernet(
             base64.b64encode(
                 shared_secret[:32].encode()
                 )
             )
-    end_name = f.decrypt(end_name[2:-1].encode())
-    users[end_name] = shared_secret
-    print("shared secret: ", shared_secret)
+    token = end_name[2:-1].encode()
+    end_name = f.decrypt(token)
+    sessions.add(token, end_name, shared_secret)
+    session_log.info("session established for %s", end_name)
     return {"pubkey": pubkey.__str__()}
 
 
+def decode_frame(data):
+    """
+    Parses and decrypts a received frame
+
+    Params:
+        data: the request body (a frame envelope)
+
+    Returns:
+        the job of the frame as a dict, or None for the stream markers
+    """
+    try:
+        frame = unpack_frame(data)
+    except FrameError as e:
+        raise RequestError("Malformed frame: " + str(e), 400)
+    device = frame.device
+    shape = frame.shape
+    if frame.marker:
+        logger.info("stream %s marker %s from device %s", frame.stream[0],
+                    frame.stream[2], device, extra={"trace": frame.trace})
+        return None
+    check_ready()
+    # frames from older aggregators get their trace here
+    trace = frame.trace or new_trace_id()
+    logger.debug("category: %s", frame.category, extra={"trace": trace})
+
+    # the aggregator keeps its session between frames, so the user is looked
+    # up by its token instead of the last negotiated secret
+    session = sessions.get(frame.user)
+    if session is None:
+        raise RequestError("Unknown session", 401)
+
+    user, secret = session
+    user = str(user)[2:-1]
+    fernet = Fernet(base64.b64encode(secret[:32].encode()))
+    with span("decrypt", trace):
+        try:
+            decrypted_data = fernet.decrypt(frame.data)
+        except InvalidToken:
+            raise RequestError("Invalid session key", 401)
+        if frame.repeat:
+            # the (empty) body only proves the session key
+            return {
+                    "frame": frame,
+                    "user": user,
+                    "device": device,
+                    "trace": trace,
+                    "repeat": True,
+                    }
+        if frame.movenet is None or frame.category is None:
+            # optional in the envelope, but added by the aggregator to every
+            # frame it forwards
+            raise RequestError("Frame without the MoveNet and classifier "
+                               "outputs", 400)
+        try:
+            if frame.content_type is not None:
+                array = tf.io.decode_image(decrypted_data, channels=3,
+                                           expand_animations=False).numpy()
+            else:
+                decompressed = gzip.decompress(decrypted_data)
+                array = np.reshape(np.frombuffer(decompressed,
+                                                 dtype=frame.dtype), shape)
+        except tf.errors.InvalidArgumentError:
+            raise RequestError("Undecodable image", 400)
+        except (OSError, EOFError, zlib.error):
+            raise RequestError("Malformed gzip body", 400)
+        except ValueError:
+            raise RequestError("Image does not match the frame shape", 400)
+    # checked here rather than in MeTRAbs, where a bad frame would fail the
+    # other frames of its batch
+    if array.dtype != np.uint8 or array.ndim != 3 or array.shape[2] != 3 \
+            or array.size == 0:
+        raise RequestError("Image must be a uint8 array of shape "
+                           "(height, width, 3)", 400)
+    if frame.crop is not None and not frame.crop[4] > 0:
+        raise RequestError("Crop scale must be positive", 400)
+    return {
+            "frame": frame,
+            "user": user,
+            "device": device,
+            "image": array,
+            "trace": trace,
+            }
+
+
+def evaluate_frame(job):
+    """
+    Runs MeTRAbs and the scoring on a job and publishes the results
+
+    Returns:
+        the published payloads as a json object (bytes), or None if nobody
+        was detected in the frame
+    """
+    if job.get("repeat"):
+        return repeat_results(job)
+    frame = job["frame"]
+    trace = job["trace"]
+    category = frame.category
+    key = (job["user"], job["device"])
+    with span("inference", trace):
+        try:
+            processed_img = process_img(job["image"], frame.crop)
+        except Unavailable as e:
+            raise RequestError(str(e), 503)
+    if processed_img is None:
+        # nothing to score or publish, and the results of the previous
+        # person must not be repeated
+        logger.debug("nobody detected", extra={"trace": trace})
+        with last_results_lock:
+            last_results.pop(key, None)
+        return None
+    with span("scoring", trace):
+        pose3D = get_pose3d(processed_img, trace)
+        pose2D = get_pose2d(frame.movenet, trace)
+        score = calculate_score(processed_img, category, trace)
+    with span("publish", trace):
+        publish_results(job["device"], job["user"], pose3D, score, pose2D,
+                        category)
+    # the published payloads are returned too
+    response = ('{"pose3D": ' + pose3D + ', "pose2D": ' + pose2D +
+                ', "feedback": ' + score + '}').encode()
+    with last_results_lock:
+        last_results[key] = (pose3D, score, pose2D, category, response)
+        last_results.move_to_end(key)
+        while len(last_results) > max_results:
+            last_results.popitem(last=False)
+    return response
+
+
+def repeat_results(job):
+    """
+    Republishes the last results of a device that did not move, without
+    running MeTRAbs
+
+    Returns:
+        the republished payloads as a json object (bytes)
+    """
+    key = (job["user"], job["device"])
+    with last_results_lock:
+        results = last_results.get(key)
+        if results is not None:
+            last_results.move_to_end(key)
+    if results is None:
+        # e.g. the server restarted, the aggregator forwards the next frame
+        raise RequestError("No result to repeat", 409)
+    pose3D, score, pose2D, category, response = results
+    with span("publish", job["trace"]):
+        publish_results(job["device"], job["user"], pose3D, score, pose2D,
+                        category)
+    return response
+
+
+def publish_frame(data):
+    """
+    Handles a received frame from end to end
+
+    Returns:
+        (body, status, headers), 204 if nobody was detected
+    """
+    job = decode_frame(data)
+    if job is None:
+        return ("OK", 200, {})
+    content = evaluate_frame(job)
+    if content is None:
+        return ("", 204, {})
+    return (content, 200, {"Content-Type": "application/json"})
+
+
+@app.route('/key', methods=['GET'])
+def announce():
+    return announce_key()
+
+@app.route('/', methods=['GET', 'POST'])
+def establish():
+    return establish_session(request.get_json())
+
+
 @app.route('/publish', methods=['GET', 'POST'])
 def process():
     """
     Recives data to publish under the MQTT server
     """
-    json_body_request = request.get_json()
-    data = json_body_request.get("data")
-    user = json_body_request.get("user")
-    device = str(json_body_request.get("device"))
-    shape = eval(json_body_request.get("shape"))
-    pose2D = json_body_request.get("movenet")
-    category = eval(json_body_request.get("category"))
-    print("category:", category)
-    print("category data type:", type(category))
-
-    if shared_secret == b'':
-        exit(1)
-    else:
-        f = Fernet(
-                base64.b64encode(
-                    shared_secret[:32].encode()
-                    )
-                )
-        user = f.decrypt(user[2:-1].encode())
+    start = time.perf_counter()
+    try:
+        response = publish_frame(request.get_data())
+    except RequestError as e:
+        logger.warning("refused a frame (%d): %s", e.status, e)
+        response = (str(e), e.status)
+    metrics.requests_total.inc(status=response[1])
+    metrics.request_seconds.observe(time.perf_counter() - start)
+    return response
 
-    secret = users.get(user)
-    user = str(user)[2:-1]
-    fernet = Fernet(base64.b64encode(secret[:32].encode()))
-    decrypted_data = fernet.decrypt(data[2:-1].encode())
-    decompressed = gzip.decompress(decrypted_data)
-    array = np.reshape(np.frombuffer(decompressed, dtype=np.uint8), shape)
 
-    processed_img = process_img(array)
-    pose3D = get_pose3d(processed_img)
-    pose2D = get_pose2d(pose2D)
-    score = calculate_score(processed_img, category)
-    publish_results(device, user, pose3D, score, pose2D, category)
-    return "Hi"
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return (metrics.registry.render(), 200,
+            {"Content-Type": metrics.CONTENT_TYPE})
+
+
+def trace_report(trace):
+    """
+    Returns:
+        (body, status) of the `/trace/<trace id>` endpoint: the stages
+        recorded for the frame, 404 if none is left
+    """
+    recorded = metrics.trace_spans(trace)
+    if not recorded:
+        return ({"trace": trace, "error": "Unknown trace"}, 404)
+    return ({"trace": trace, "spans": recorded}, 200)
+
+
+@app.route('/trace/<trace>', methods=['GET'])
+def trace_endpoint(trace):
+    return trace_report(trace)
+
+
+def warm_up():
+    """
+    Runs MeTRAbs on blank frames of each of the `warmup_shapes`, alone then
+    as a full batch
+    """
+    for shape in warmup_shapes:
+        blank = np.zeros(shape, dtype=np.uint8)
+        batcher((blank, None))
+        futures = [batcher.submit((blank, None))
+                   for _ in range(max_batch_size)]
+        for future in futures:
+            future.result()
+
+
+def load_model():
+    """
+    Loads and warms up MeTRAbs, then sets `ready`
+    """
+    global model, batcher, load_error
+    try:
+        if inference_workers > 0:
+            # each worker loads its own copy of the model
+            batcher = WorkerPool(metrabs_backend, model_path,
+                                 backend_options, keypoints_name,
+                                 inference_workers, max_batch_size).start()
+        else:
+            model = load_metrabs_backend(metrabs_backend, model_path,
+                                         **backend_options)
+            batcher = Batcher(detect_poses, max_batch_size,
+                              max_batch_wait).start()
+        warm_up()
+    except Exception as e:
+        load_error = repr(e)
+        logger.exception("failed to load the model")
+        return
+    logger.info("model loaded")
+    ready.set()
+
+
+@app.route('/ready', methods=['GET'])
+def readiness_probe():
+    return readiness()
+
+
+def inference_queue_depth():
+    """
+    Returns:
+        number of frames waiting for MeTRAbs
+    """
+    if not ready.is_set():
+        return 0
+    if inference_workers > 0:
+        return batcher.stats()["pending"]
+    return batcher.queue.qsize()
+
+
+def register_gauges():
+    """
+    Exposes the queue depths and the publisher counters on `/metrics`
+    """
+    metrics.registry.gauge("inference_queue_depth",
+                           "Frames waiting for MeTRAbs",
+                           fn=inference_queue_depth)
+    metrics.registry.gauge("mqtt_queue_depth",
+                           "Messages waiting for the MQTT publisher",
+                           fn=lambda: publisher.queue.qsize())
+    metrics.registry.gauge(
+            "mqtt_messages", "MQTT publisher counters", ("state",),
+            fn=lambda: {(state,): value
+                        for state, value in publisher.stats().items()
+                        if state in ("enqueued", "dropped", "published",
+                                     "delivered", "failed", "inflight",
+                                     "reconnects")})
+
+
+def setup():
+    """
+    Starts the background components, the model is loaded in the background
+    """
+    global references, d1, pubkey
+    log.setup()
+    references = ReferenceTable("venv/json").start()
+    d1 = DiffieHellman()
+    pubkey = d1.gen_public_key()
+    publisher.start()
+    register_gauges()
+    threading.Thread(target=load_model, daemon=True).start()
+
+
+def teardown():
+    """
+    Stops the background components
+    """
+    publisher.stop()
+    if ready.is_set():
+        batcher.stop()
 
 
 if __name__ == '__main__':
@@ -194,7 +570,6 @@ if __name__ == '__main__':
     This file meant to run on the VPS/Server to recive data from other clients
     process them, and publish them under the specified topics
     """)
-    model = hub.load('./venv/models/metrabs_s_256/')  # Takes about 5 minutes
-    d1 = DiffieHellman()
-    pubkey = d1.gen_public_key()
+    setup()
     app.run(debug=False, port=8080, host='0.0.0.0')
+    teardown()
@@ -0,0 +1,213 @@
+"""
+Prometheus metrics (text exposition format) and per-stage spans of the
+frames, rendered on the `/metrics` endpoint
+"""
+import bisect
+import collections
+import contextlib
+import threading
+import time
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names, values, extra=""):
+    pairs = ['%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                          .replace('"', '\\"').replace('\n', '\\n'))
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """
+    A metric family, one value (or histogram) per combination of labels
+
+    Params:
+        name: metric name
+        help: description shown in the exposition
+        labels: names of the labels
+    """
+    kind = "untyped"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labels)
+
+    def samples(self):
+        """
+        Returns:
+            list of (name suffix, label values, extra label, value)
+        """
+        with self.lock:
+            return [("", key, "", value) for key, value in
+                    sorted(self.values.items())]
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+        for suffix, key, extra, value in self.samples():
+            lines.append("%s%s%s %s" % (self.name, suffix,
+                                        _labels(self.labels, key, extra),
+                                        repr(float(value))))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A gauge set explicitly, or read from `fn` (returning a number, or a dict
+    of label values tuple -> number) at each scrape
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, labels=(), fn=None):
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+    def samples(self):
+        if self.fn is None:
+            return super().samples()
+        values = self.fn()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [("", key, "", value) for key, value in
+                sorted(values.items())]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # one count per bucket, then +Inf, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) \
+                    + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            items = sorted((key, list(counts))
+                           for key, counts in self.values.items())
+        for key, counts in items:
+            total = 0
+            for bound, count in zip(self.buckets + (float("inf"),),
+                                    counts[:-1]):
+                total += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                samples.append(("_bucket", key, 'le="%s"' % le, total))
+            samples.append(("_sum", key, "", counts[-1]))
+            samples.append(("_count", key, "", total))
+        return samples
+
+
+class Registry:
+    """
+    The metrics of a service
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), fn=None):
+        return self.register(Gauge(name, help, labels, fn))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        """
+        Returns:
+            the metrics in the Prometheus text format
+        """
+        with self.lock:
+            metrics = list(self.metrics)
+        return "\n".join(metric.render() for metric in metrics) + "\n"
+
+
+registry = Registry()
+stage_seconds = registry.histogram(
+        "stage_duration_seconds", "Time spent in each stage of a frame",
+        ("stage",))
+stage_errors = registry.counter(
+        "stage_errors_total", "Frames that failed in each stage", ("stage",))
+requests_total = registry.counter(
+        "requests_total", "Handled /publish requests by status", ("status",))
+request_seconds = registry.histogram(
+        "request_duration_seconds", "Time spent handling /publish requests")
+
+# the last spans of the traced frames, as (trace id, stage, start time,
+# duration), served by `/trace/<trace id>`
+spans = collections.deque(maxlen=1024)
+
+
+@contextlib.contextmanager
+def span(stage, trace=None):
+    """
+    Times a stage of a frame, recording its duration and its errors
+
+    Params:
+        stage: name of the stage (decrypt, inference, uplink, ...)
+        trace: trace id of the frame
+    """
+    start = time.time()
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        stage_errors.inc(stage=stage)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, stage=stage)
+        if trace is not None:
+            spans.append((trace, stage, start, elapsed))
+
+
+def trace_spans(trace):
+    """
+    Returns:
+        the recorded spans of a trace as a list of dicts
+    """
+    return [{"stage": stage, "start": start, "duration": duration}
+            for span_trace, stage, start, duration in list(spans)
+            if span_trace == trace]
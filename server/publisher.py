@@ -0,0 +1,190 @@
+"""
+Long-lived MQTT publisher, replacing the per-frame connect / loop_start /
+loop_stop done by `publish_results`
+"""
+import queue
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from log import get_logger
+
+logger = get_logger("publisher")
+
+
+class Publisher:
+    """
+    Publishes messages to a MQTT broker from a background thread over one
+    persistent connection
+
+    Params:
+        host: the broker host
+        port: the broker port
+        max_queue: size of the outbound queue, publishes beyond it are dropped
+        max_inflight: maximum number of unacknowledged QoS>0 messages
+        min_backoff: first reconnect delay in seconds
+        max_backoff: maximum reconnect delay in seconds
+    """
+
+    def __init__(self, host="mqtt.eclipseprojects.io", port=1883,
+                 max_queue=1024, max_inflight=32, min_backoff=1,
+                 max_backoff=30, keepalive=60):
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.inflight = threading.BoundedSemaphore(max_inflight)
+        self.connected = threading.Event()
+        self.running = False
+
+        # mid -> (time the message was enqueued, qos), guarded by `lock`.
+        # `on_publish` may fire before `publish` returns, those acks are kept
+        # in `early_acks` until the mid is recorded
+        self.pending = {}
+        self.early_acks = set()
+        self.lock = threading.RLock()
+        self.counters = {
+            "enqueued": 0,
+            "dropped": 0,
+            "published": 0,
+            "delivered": 0,
+            "failed": 0,
+            "reconnects": 0,
+            "latency_total": 0.0,
+            "latency_max": 0.0,
+        }
+
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        self.client.on_connect = self._on_connect
+        self.client.on_disconnect = self._on_disconnect
+        self.client.on_publish = self._on_publish
+        self.client.reconnect_delay_set(min_delay=min_backoff,
+                                        max_delay=max_backoff)
+        self.client.max_inflight_messages_set(max_inflight)
+        self.client.max_queued_messages_set(max_queue)
+        self.worker = threading.Thread(target=self._run, daemon=True)
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        logger.info("connected with result code %s", reason_code)
+        if not reason_code.is_failure:
+            self.connected.set()
+
+    def _on_disconnect(self, client, userdata, flags, reason_code,
+                       properties):
+        self.connected.clear()
+        if self.running:
+            # paho's network loop reconnects with the configured backoff
+            logger.warning("disconnected with result code %s", reason_code)
+            with self.lock:
+                self.counters["reconnects"] += 1
+
+    def _on_publish(self, client, userdata, mid, reason_code, properties):
+        # called by paho's network thread while it holds its own message
+        # lock, so `lock` must never be held around `client.publish`
+        with self.lock:
+            message = self.pending.pop(mid, None)
+            if message is None:
+                self.early_acks.add(mid)
+                return
+            self._delivered(*message)
+
+    def _delivered(self, enqueued, qos):
+        # called with `lock` held
+        latency = time.monotonic() - enqueued
+        self.counters["delivered"] += 1
+        self.counters["latency_total"] += latency
+        self.counters["latency_max"] = max(self.counters["latency_max"],
+                                           latency)
+        if qos > 0:
+            self.inflight.release()
+
+    def start(self):
+        """
+        Connects to the broker and starts the publishing thread
+        """
+        self.running = True
+        self.client.connect_async(self.host, self.port, self.keepalive)
+        self.client.loop_start()
+        self.worker.start()
+
+    def stop(self, timeout=5):
+        """
+        Flushes the queue (waiting at most `timeout` seconds) and disconnects
+        """
+        deadline = time.monotonic() + timeout
+        while (not self.queue.empty() or self.pending) and \
+                time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.running = False
+        self.queue.put(None)
+        self.worker.join(timeout=1)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+    def publish(self, topic, payload, qos=1):
+        """
+        Enqueues a message without blocking
+
+        Returns:
+            False if the queue is full and the message was dropped
+        """
+        try:
+            self.queue.put_nowait((topic, payload, qos, time.monotonic()))
+        except queue.Full:
+            with self.lock:
+                self.counters["dropped"] += 1
+            logger.warning("outbound queue full, dropped a message on %s",
+                           topic)
+            return False
+        with self.lock:
+            self.counters["enqueued"] += 1
+        return True
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            topic, payload, qos, enqueued = item
+            self.connected.wait()
+            if qos > 0:
+                # bounds the number of messages waiting for their ack
+                self.inflight.acquire()
+            info = self.client.publish(topic=topic, payload=payload, qos=qos)
+            # QoS>0 messages not acked yet are resent by paho on reconnect,
+            # QoS 0 ones are lost without a connection
+            queued = info.rc == mqtt.MQTT_ERR_SUCCESS or \
+                (qos > 0 and info.rc == mqtt.MQTT_ERR_NO_CONN)
+            with self.lock:
+                if not queued:
+                    self.counters["failed"] += 1
+                    if qos > 0:
+                        self.inflight.release()
+                else:
+                    # counted as delivered on their ack (or once written to
+                    # the socket for QoS 0)
+                    self.counters["published"] += 1
+                    if info.mid in self.early_acks:
+                        self.early_acks.discard(info.mid)
+                        self._delivered(enqueued, qos)
+                    else:
+                        self.pending[info.mid] = (enqueued, qos)
+            if not queued:
+                logger.warning("failed to publish on %s (%s)", topic,
+                               mqtt.error_string(info.rc))
+
+    def stats(self):
+        """
+        Returns:
+            the delivery and latency counters plus the current queue depth
+            and number of in-flight messages
+        """
+        with self.lock:
+            stats = dict(self.counters)
+            stats["inflight"] = len(self.pending)
+        stats["queued"] = self.queue.qsize()
+        delivered = stats["delivered"]
+        stats["latency_avg"] = (stats["latency_total"] / delivered
+                                if delivered else 0.0)
+        return stats
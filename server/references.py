@@ -0,0 +1,120 @@
+"""
+Reference angles and coefficients of the supported poses, compiled once into
+arrays so scoring does no file I/O
+"""
+import json
+import os
+import threading
+
+import numpy as np
+
+from addons import REFERENCE_KEYS, coefficients
+from log import get_logger
+
+logger = get_logger("references")
+
+
+class References:
+    """
+    An immutable snapshot of the reference table
+
+    Attributes:
+        names: pose names, indexed by pose id
+        ids: pose name -> pose id
+        angles: array of shape (poses, len(REFERENCE_KEYS)) of the
+            reference angles
+        weights: array of the same shape of the pose coefficients
+        mapped: the weights divided by the highest weight of their pose
+            (see `map_coef`)
+        mtimes: json file -> modification time it was read at
+    """
+
+    def __init__(self, names, angles, weights, mtimes):
+        self.names = names
+        self.ids = {name: i for i, name in enumerate(names)}
+        self.angles = angles
+        self.weights = weights
+        self.mapped = weights / weights.max(axis=1, keepdims=True)
+        self.mtimes = mtimes
+
+
+class ReferenceTable:
+    """
+    Reference table built from the `<pose>.json` files of a directory and the
+    `coefficients`, reloaded atomically when one of the files changes
+
+    Params:
+        directory: directory holding the `<pose>.json` files
+        interval: seconds between two checks of the files modification times
+    """
+
+    def __init__(self, directory="venv/json", interval=5.0):
+        self.directory = directory
+        self.interval = interval
+        self.current = self._compile(self._mtimes())
+        self.stopped = threading.Event()
+        self.watcher = threading.Thread(target=self._watch, daemon=True)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + ".json")
+
+    def _mtimes(self):
+        mtimes = {}
+        for name in coefficients:
+            try:
+                mtimes[name] = os.stat(self._path(name)).st_mtime_ns
+            except FileNotFoundError:
+                continue
+        return mtimes
+
+    def _compile(self, mtimes):
+        names = sorted(mtimes)
+        angles = np.zeros((len(names), len(REFERENCE_KEYS)))
+        weights = np.zeros((len(names), len(REFERENCE_KEYS)))
+        for i, name in enumerate(names):
+            with open(self._path(name)) as truth:
+                o = json.load(truth)
+            angles[i] = [o[key] for key in REFERENCE_KEYS]
+            weights[i] = [coefficients[name][key] for key in REFERENCE_KEYS]
+        return References(names, angles, weights, mtimes)
+
+    def reload(self):
+        """
+        Rebuilds the table if a json file was added, removed or modified
+
+        Returns:
+            True if the table was swapped
+        """
+        mtimes = self._mtimes()
+        if mtimes == self.current.mtimes:
+            return False
+        try:
+            references = self._compile(mtimes)
+        except (OSError, ValueError, KeyError) as e:
+            # e.g. a file caught while being written, retried on next check
+            logger.warning("keeping the previous reference table: %s", e)
+            return False
+        # a single reference assignment, readers see the old or new table
+        self.current = references
+        logger.info("reference table reloaded: %s", references.names)
+        return True
+
+    def _watch(self):
+        while not self.stopped.wait(self.interval):
+            self.reload()
+
+    def start(self):
+        self.watcher.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def lookup(self, pose_name):
+        """
+        Returns:
+            (references snapshot, pose id) or (snapshot, None) if the pose
+            has no reference
+        """
+        references = self.current
+        return references, references.ids.get(pose_name)
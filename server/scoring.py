@@ -0,0 +1,71 @@
+"""
+Array based pose scoring, scoring many frames at once with the same results
+as `evaluate_pose`
+"""
+import numpy as np
+
+from addons import calculate_score
+
+# `calculate_score` is flat past 45 degrees, so the rounded differences only
+# need a table of 46 scores
+MAX_DIFF = 45
+SCORE_TABLE = np.array([calculate_score(diff)
+                        for diff in range(MAX_DIFF + 1)])
+
+# breakpoints of the piecewise linear `calculate_score`, used when the
+# differences are not whole degrees
+SCORE_BREAKS = [0, 5, 10, 15, 20, 25, 45]
+SCORE_VALUES = [1, 0.90, 0.80, 0.70, 0.50, 0.40, 0.0]
+
+
+def pose_ids(pose_names, references):
+    """
+    Maps pose names to their ids in the reference table
+
+    Args:
+        pose_names: list of pose names (output of `get_pose_name`)
+        references: a `References` snapshot
+
+    Returns:
+        array of shape (N,) of pose ids, -1 for poses without a reference
+    """
+    return np.array([references.ids.get(name, -1) for name in pose_names],
+                    dtype=np.int64)
+
+
+def score_poses(angles, ids, references):
+    """
+    Scores N poses with one gather and reduce
+
+    Args:
+        angles: array of shape (N, 11) of rounded angles, in the order of
+            `ANGLES` (the values of `collect_angles`)
+        ids: array of shape (N,) of pose ids (output of `pose_ids`)
+        references: a `References` snapshot
+
+    Returns:
+        array of shape (N,) of scores, equal to `evaluate_pose` for each
+        pose (0.0 for poses without a reference)
+    """
+    angles = np.asarray(angles, dtype=np.float64)
+    ids = np.asarray(ids)
+    if len(references.names) == 0:
+        return np.zeros(len(ids))
+    known = ids >= 0
+    safe_ids = np.where(known, ids, 0)
+
+    diffs = np.abs(references.angles[safe_ids] - angles)
+    diffs = np.minimum(diffs, 360 - diffs)
+    diffs = np.minimum(diffs, MAX_DIFF)
+    if np.all(diffs == np.floor(diffs)):
+        scores = SCORE_TABLE[diffs.astype(np.int64)]
+    else:
+        scores = np.interp(diffs, SCORE_BREAKS, SCORE_VALUES)
+    weighted = scores * references.weights[safe_ids]
+
+    # summed column by column, in the order `evaluate_diffs` sums them, so
+    # the results are the same to the last bit
+    total = np.zeros(len(ids))
+    for column in range(weighted.shape[1]):
+        total = total + weighted[:, column]
+    return np.where(known, total / 11, 0.0)
@@ -21,7 +21,7 @@ pkgs.mkShell {
     echo "welcome to ur shell environement"
     python -m venv venv 
     source ./venv/bin/activate
-    pip install paho-mqtt pyDH tensorflow tensorflow_hub tensorrt --upgrade
+    pip install paho-mqtt pyDH tensorflow tensorflow_hub tensorrt aiohttp --upgrade
     mkdir ./venv/models
     test -f ./venv/models/metrabs_s_256/saved_model.pb && echo "model already installed!" || (
 		    echo "loading the 'metrabs_s_256' model..." &&
@@ -0,0 +1,171 @@
+"""
+Minimal MQTT 3.1.1 broker to run the server and the load tests fully
+locally (no persistence, no retained messages, no authentication)
+
+Publishes are acknowledged (QoS 1 and 2) and forwarded at QoS 0 to the
+matching subscribers; the number of received messages is printed
+periodically.
+
+    python stub_broker.py [port]
+    MQTT_HOST=127.0.0.1 MQTT_PORT=1883 python main.py
+"""
+import asyncio
+import struct
+import sys
+import time
+
+CONNECT = 1
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+UNSUBSCRIBE = 10
+PINGREQ = 12
+DISCONNECT = 14
+
+
+def matches(pattern, topic):
+    """
+    Checks a topic against a subscription filter (with + and # wildcards)
+    """
+    pattern = pattern.split("/")
+    topic = topic.split("/")
+    for i, level in enumerate(pattern):
+        if level == "#":
+            return True
+        if i >= len(topic) or (level != "+" and level != topic[i]):
+            return False
+    return len(pattern) == len(topic)
+
+
+def _string(data, offset):
+    (length,) = struct.unpack_from("!H", data, offset)
+    offset += 2
+    return data[offset:offset + length].decode(), offset + length
+
+
+def _packet(kind, flags, body):
+    header = bytearray([kind << 4 | flags])
+    length = len(body)
+    while True:
+        byte = length % 128
+        length //= 128
+        header.append(byte | 0x80 if length else byte)
+        if not length:
+            return bytes(header) + body
+
+
+class Broker:
+
+    def __init__(self):
+        # writer -> list of topic filters
+        self.subscriptions = {}
+        self.received = 0
+        self.forwarded = 0
+
+    async def _read_packet(self, reader):
+        first = (await reader.readexactly(1))[0]
+        length, shift = 0, 0
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        return first >> 4, first & 0x0F, await reader.readexactly(length)
+
+    def _publish(self, flags, body, writer):
+        topic, offset = _string(body, 0)
+        qos = (flags >> 1) & 0x03
+        if qos:
+            packet_id = body[offset:offset + 2]
+            offset += 2
+            if qos == 1:
+                writer.write(_packet(PUBACK, 0, packet_id))
+            else:
+                writer.write(_packet(PUBREC, 0, packet_id))
+        self.received += 1
+        payload = body[offset:]
+        message = _packet(PUBLISH, 0,
+                          struct.pack("!H", len(topic.encode()))
+                          + topic.encode() + payload)
+        for subscriber, filters in list(self.subscriptions.items()):
+            if any(matches(pattern, topic) for pattern in filters):
+                subscriber.write(message)
+                self.forwarded += 1
+
+    def _subscribe(self, body, writer):
+        packet_id = body[:2]
+        offset = 2
+        granted = bytearray()
+        while offset < len(body):
+            pattern, offset = _string(body, offset)
+            requested = body[offset]
+            offset += 1
+            self.subscriptions.setdefault(writer, []).append(pattern)
+            # messages are only forwarded at QoS 0
+            granted.append(min(requested, 0))
+        writer.write(_packet(9, 0, packet_id + bytes(granted)))
+
+    def _unsubscribe(self, body, writer):
+        packet_id = body[:2]
+        offset = 2
+        filters = self.subscriptions.get(writer, [])
+        while offset < len(body):
+            pattern, offset = _string(body, offset)
+            if pattern in filters:
+                filters.remove(pattern)
+        writer.write(_packet(11, 0, packet_id))
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                kind, flags, body = await self._read_packet(reader)
+                if kind == CONNECT:
+                    # session not present, connection accepted
+                    writer.write(_packet(2, 0, b"\x00\x00"))
+                elif kind == PUBLISH:
+                    self._publish(flags, body, writer)
+                elif kind == PUBREL:
+                    writer.write(_packet(PUBCOMP, 0, body[:2]))
+                elif kind in (PUBACK, PUBREC, PUBCOMP):
+                    pass
+                elif kind == SUBSCRIBE:
+                    self._subscribe(body, writer)
+                elif kind == UNSUBSCRIBE:
+                    self._unsubscribe(body, writer)
+                elif kind == PINGREQ:
+                    writer.write(_packet(13, 0, b""))
+                elif kind == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.subscriptions.pop(writer, None)
+            writer.close()
+
+    async def report(self, interval=5.0):
+        last, last_time = 0, time.monotonic()
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            print(f"received {self.received} messages "
+                  f"({(self.received - last) / (now - last_time):.1f}/s), "
+                  f"forwarded {self.forwarded}, "
+                  f"{len(self.subscriptions)} subscribers")
+            last, last_time = self.received, now
+
+
+async def serve(port=1883, host="0.0.0.0"):
+    broker = Broker()
+    server = await asyncio.start_server(broker.handle, host, port)
+    print("stub broker listening on", host, port)
+    async with server:
+        await asyncio.gather(server.serve_forever(), broker.report())
+
+
+if __name__ == '__main__':
+    asyncio.run(serve(int(sys.argv[1]) if len(sys.argv) > 1 else 1883))
@@ -0,0 +1,158 @@
+"""
+Binary frame envelope: round trips with each extension, and buffers that
+must be refused
+
+    python -m unittest test_frame
+"""
+import base64
+import struct
+import unittest
+
+import numpy as np
+
+import frame
+from frame import FrameError, new_trace_id, pack_frame, unpack_frame
+
+# stand-ins for the Fernet tokens, only their base64 encoding matters here
+USER = base64.urlsafe_b64encode(b"user token")
+DATA = base64.urlsafe_b64encode(b"\x00\x01encrypted image\xff")
+SHAPE = (480, 640, 3)
+
+
+class FrameTest(unittest.TestCase):
+
+    def round_trip(self, **kwargs):
+        buffer = pack_frame(DATA, SHAPE, USER, "device-1", **kwargs)
+        result = unpack_frame(buffer)
+        self.assertEqual(result.data, DATA)
+        self.assertEqual(result.shape, SHAPE)
+        self.assertEqual(result.dtype, np.uint8)
+        self.assertEqual(result.user, USER)
+        self.assertEqual(result.device, "device-1")
+        return result
+
+    def test_plain(self):
+        result = self.round_trip()
+        self.assertEqual(result.tensors, {})
+        self.assertIsNone(result.stream)
+        self.assertIsNone(result.content_type)
+        self.assertIsNone(result.crop)
+        self.assertIsNone(result.trace)
+        self.assertFalse(result.repeat)
+
+    def test_tensors(self):
+        movenet = np.random.rand(1, 1, 17, 3).astype(np.float32)
+        category = np.array([[0.25, 0.75]])
+        result = self.round_trip(movenet=movenet, category=category)
+        np.testing.assert_array_equal(result.movenet, movenet)
+        self.assertEqual(result.movenet.dtype, np.float32)
+        np.testing.assert_array_equal(result.category, category)
+        self.assertEqual(result.category.dtype, np.float64)
+
+    def test_stream(self):
+        result = self.round_trip(stream=(7, 42, frame.STREAM_FRAME))
+        self.assertEqual(result.stream, (7, 42, frame.STREAM_FRAME))
+        self.assertFalse(result.marker)
+        result = self.round_trip(stream=(7, 0, frame.STREAM_END))
+        self.assertTrue(result.marker)
+
+    def test_content_type(self):
+        result = self.round_trip(content_type="image/jpeg")
+        self.assertEqual(result.content_type, "image/jpeg")
+
+    def test_crop(self):
+        result = self.round_trip(crop=(1080, 1920, 300, 120, 0.5))
+        self.assertEqual(result.crop, (1080, 1920, 300, 120, 0.5))
+
+    def test_trace(self):
+        trace = new_trace_id()
+        result = self.round_trip(trace=trace)
+        self.assertEqual(result.trace, trace)
+
+    def test_repeat(self):
+        self.assertTrue(self.round_trip(repeat=True).repeat)
+
+    def test_all_extensions(self):
+        trace = new_trace_id()
+        result = self.round_trip(
+                movenet=np.ones((1, 1, 17, 3), dtype=np.float32),
+                stream=(1, 2, frame.STREAM_FRAME), content_type="image/png",
+                crop=(480, 640, 10, 20, 2.0), trace=trace, repeat=True)
+        self.assertEqual(result.stream, (1, 2, frame.STREAM_FRAME))
+        self.assertEqual(result.content_type, "image/png")
+        self.assertEqual(result.crop, (480, 640, 10, 20, 2.0))
+        self.assertEqual(result.trace, trace)
+        self.assertTrue(result.repeat)
+
+    def test_truncated(self):
+        buffer = pack_frame(DATA, SHAPE, USER, "device-1",
+                            movenet=np.ones((1, 1, 17, 3), dtype=np.float32),
+                            stream=(1, 2, frame.STREAM_FRAME),
+                            content_type="image/jpeg",
+                            crop=(480, 640, 10, 20, 2.0),
+                            trace=new_trace_id())
+        # every prefix, down to a partial header
+        for length in range(len(buffer)):
+            with self.assertRaises(FrameError):
+                unpack_frame(buffer[:length])
+
+    def test_trailing_bytes(self):
+        buffer = pack_frame(DATA, SHAPE, USER, "device-1")
+        with self.assertRaises(FrameError):
+            unpack_frame(buffer + b"\x00")
+
+    def corrupt_header(self, index, value):
+        buffer = bytearray(pack_frame(DATA, SHAPE, USER, "device-1"))
+        buffer[index] = value
+        return bytes(buffer)
+
+    def test_bad_magic(self):
+        with self.assertRaises(FrameError):
+            unpack_frame(self.corrupt_header(0, ord("X")))
+
+    def test_bad_version(self):
+        with self.assertRaises(FrameError):
+            unpack_frame(self.corrupt_header(2, frame.VERSION + 1))
+
+    def test_unknown_flags(self):
+        with self.assertRaises(FrameError):
+            unpack_frame(self.corrupt_header(3, 0x80))
+
+    def test_bad_dtype(self):
+        with self.assertRaises(FrameError):
+            unpack_frame(self.corrupt_header(4, 0xff))
+
+    def test_bad_tensor(self):
+        buffer = bytearray(pack_frame(
+                DATA, SHAPE, USER, "device-1",
+                movenet=np.ones((1, 1, 17, 3), dtype=np.float32)))
+        # dtype code of the tensor, after the header, shape, user and device
+        offset = frame._HEADER.size + 4 * len(SHAPE) + len(USER) + 8 + 1
+        buffer[offset] = 0xff
+        with self.assertRaises(FrameError):
+            unpack_frame(bytes(buffer))
+
+    def test_bad_device(self):
+        buffer = pack_frame(DATA, SHAPE, USER, "device-1")
+        offset = frame._HEADER.size + 4 * len(SHAPE) + len(USER)
+        buffer = buffer[:offset] + b"\xff" + buffer[offset + 1:]
+        with self.assertRaises(FrameError):
+            unpack_frame(buffer)
+
+    def test_unsupported_dtype(self):
+        with self.assertRaises(FrameError):
+            pack_frame(DATA, SHAPE, USER, "device-1", dtype=np.complex64)
+        with self.assertRaises(FrameError):
+            pack_frame(DATA, SHAPE, USER, "device-1",
+                       movenet=np.ones(3, dtype=np.float16))
+
+    def test_header_layout(self):
+        buffer = pack_frame(DATA, SHAPE, USER, "device-1",
+                            trace=new_trace_id())
+        magic, version, flags = struct.unpack_from("!2sBB", buffer)
+        self.assertEqual((magic, version), (frame.MAGIC, frame.VERSION))
+        self.assertEqual(flags, frame.FLAG_TRACE)
+
+
+if __name__ == '__main__':
+    unittest.main()
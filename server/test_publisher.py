@@ -0,0 +1,109 @@
+"""
+Publisher against the stub broker, with enough QoS 1 messages in flight for
+the broker's acks to race `client.publish`
+
+    python -m unittest test_publisher
+"""
+import asyncio
+import threading
+import time
+import unittest
+
+from publisher import Publisher
+from stub_broker import Broker
+
+
+class StubBroker:
+    """
+    Runs the stub broker on a free local port in a background event loop
+    """
+
+    def __init__(self):
+        self.broker = Broker()
+        self.loop = asyncio.new_event_loop()
+        self.started = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.server = self.loop.run_until_complete(
+                asyncio.start_server(self.broker.handle, "127.0.0.1", 0))
+        self.port = self.server.sockets[0].getsockname()[1]
+        self.started.set()
+        self.loop.run_forever()
+
+    def start(self):
+        self.thread.start()
+        self.started.wait()
+        return self
+
+    async def _shutdown(self):
+        self.server.close()
+        tasks = [task for task in asyncio.all_tasks()
+                 if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.loop.stop()
+
+    def stop(self):
+        asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop)
+        self.thread.join(timeout=5)
+        self.loop.close()
+
+
+class PublisherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.broker = StubBroker().start()
+
+    def tearDown(self):
+        self.broker.stop()
+
+    def test_acks_racing_publish(self):
+        messages = 20000
+        publisher = Publisher("127.0.0.1", self.broker.port,
+                              max_queue=messages, max_inflight=1000)
+        result = {}
+
+        def run():
+            for i in range(messages):
+                publisher.publish("test/race", b"%d" % i)
+            deadline = time.monotonic() + 60
+            while publisher.stats()["delivered"] < messages and \
+                    time.monotonic() < deadline:
+                time.sleep(0.05)
+            result.update(publisher.stats())
+
+        publisher.start()
+        # a deadlock between the publishing thread and paho's network
+        # thread blocks `publish` and `stats` forever
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(timeout=90)
+        self.assertFalse(thread.is_alive(), "the publisher deadlocked")
+        publisher.stop(timeout=1)
+        self.assertEqual(result["delivered"], messages)
+        self.assertEqual(result["failed"], 0)
+        self.assertEqual(result["inflight"], 0)
+        self.assertEqual(publisher.early_acks, set())
+
+    def test_qos0(self):
+        publisher = Publisher("127.0.0.1", self.broker.port)
+        publisher.start()
+        try:
+            for i in range(500):
+                publisher.publish("test/qos0", b"%d" % i, qos=0)
+            deadline = time.monotonic() + 10
+            while publisher.stats()["delivered"] < 500 and \
+                    time.monotonic() < deadline:
+                time.sleep(0.05)
+            stats = publisher.stats()
+        finally:
+            publisher.stop(timeout=1)
+        self.assertEqual(stats["delivered"], 500)
+        self.assertEqual(stats["inflight"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
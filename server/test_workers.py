@@ -0,0 +1,60 @@
+"""
+Worker pool on the stub backend, with a worker killed while frames are in
+flight
+
+    python -m unittest test_workers
+"""
+import time
+import unittest
+
+import numpy as np
+
+from workers import WorkerPool
+
+
+class WorkerPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        # one frame per call, so each worker holds several frames queued
+        self.pool = WorkerPool("stub", None, {"delay": 1.5}, "human4d_32",
+                               workers=2, max_batch_size=1, slots=4,
+                               slot_size=64 * 64 * 3).start()
+
+    def tearDown(self):
+        self.pool.stop()
+
+    def wait_for(self, condition, timeout=60):
+        deadline = time.monotonic() + timeout
+        while not condition() and time.monotonic() < deadline:
+            time.sleep(0.05)
+        return condition()
+
+    def test_worker_death(self):
+        frame = (np.zeros((64, 64, 3), dtype=np.uint8), None)
+        futures = [self.pool.submit(frame) for _ in range(4)]
+        workers = [self.pool.pending[task_id][2]
+                   for task_id in sorted(self.pool.pending)]
+        self.assertEqual(sorted(workers), [0, 0, 1, 1])
+        self.pool.processes[0].kill()
+
+        for future, worker in zip(futures, workers):
+            if worker == 0:
+                with self.assertRaises(RuntimeError):
+                    future.result(timeout=30)
+            else:
+                # the frames of the other worker are not failed with it
+                self.assertIn("poses3d", future.result(timeout=30))
+        self.assertTrue(self.wait_for(
+                lambda: self.pool.stats()["free_slots"] == 4))
+
+        self.assertTrue(self.wait_for(
+                lambda: self.pool.stats()["workers"] == 2))
+        self.assertEqual(self.pool.stats()["restarts"], 1)
+        futures = [self.pool.submit(frame) for _ in range(6)]
+        for future in futures:
+            self.assertIn("poses3d", future.result(timeout=30))
+        self.assertEqual(self.pool.stats()["free_slots"], 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,391 @@
+"""
+Process pool running MeTRAbs in several worker processes, each holding its
+own copy of the model, so inference is not bound to one interpreter
+
+Frames are copied once into shared memory slots, only their shape, dtype and
+crop go through the task queue. The (small) predictions come back over a
+pipe.
+
+Each worker has its own task queue and result pipe, so a worker that dies
+(even while holding a queue lock) only takes its own frames with it.
+"""
+import multiprocessing as mp
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+
+import numpy as np
+
+import log
+
+logger = log.get_logger("inference")
+
+
+def _serve(backend, model_path, options, skeleton, slot_names, tasks, results,
+           max_batch_size):
+    """
+    Worker process: loads the model then runs the queued frames, grouping
+    the ones already waiting into batches of at most `max_batch_size`
+    """
+    from backends import load_metrabs_backend
+    from detection import detect_batch
+
+    # spawned workers start with logging unconfigured
+    log.setup()
+    slots = [shared_memory.SharedMemory(name=name) for name in slot_names]
+    try:
+        model = load_metrabs_backend(backend, model_path, **options)
+    except Exception as e:
+        logger.exception("failed to load the model")
+        results.send((None, "error", repr(e)))
+        for slot in slots:
+            slot.close()
+        return
+    results.send((None, "ready", None))
+
+    stopping = False
+    while not stopping:
+        task = tasks.get()
+        if task is None:
+            break
+        batch = [task]
+        while len(batch) < max_batch_size:
+            try:
+                task = tasks.get_nowait()
+            except queue.Empty:
+                break
+            if task is None:
+                # finish the batch, then exit
+                stopping = True
+                break
+            batch.append(task)
+
+        items = []
+        for _, slot, shape, dtype, crop, image in batch:
+            if slot is not None:
+                image = np.ndarray(shape, dtype=dtype, buffer=slots[slot].buf)
+            items.append((image, crop))
+        try:
+            predictions = detect_batch(model, items, skeleton)
+        except Exception:
+            if len(batch) > 1:
+                logger.warning("batch of %d frames failed, running them one "
+                               "by one", len(batch))
+            # one bad frame must not fail the others
+            for task, item in zip(batch, items):
+                try:
+                    prediction = detect_batch(model, [item], skeleton)[0]
+                except Exception as e:
+                    logger.exception("frame failed")
+                    results.send((task[0], None, repr(e)))
+                else:
+                    results.send((task[0], prediction, None))
+        else:
+            for task, prediction in zip(batch, predictions):
+                results.send((task[0], prediction, None))
+        # the views have to be released before the slots are reused
+        del items
+
+    for slot in slots:
+        slot.close()
+
+
+class Unavailable(RuntimeError):
+    """
+    No inference worker has the model loaded (they all died and are
+    loading it again)
+    """
+
+
+class WorkerPool:
+    """
+    Same interface as `Batcher` (`submit` / `__call__` on (image, crop)),
+    running the detection in `workers` processes
+
+    A frame goes to the worker with the fewest frames in flight. When a
+    worker dies, only its frames fail, their slots are freed and the worker
+    is started again.
+
+    Params:
+        backend: the MeTRAbs backend (one of `METRABS_BACKENDS`)
+        model_path: path of the MeTRAbs model loaded by each worker
+        options: options of the backend
+        skeleton: name of the MeTRAbs skeleton to predict
+        workers: number of worker processes
+        max_batch_size: maximum number of frames per MeTRAbs call
+        slots: number of shared memory slots, i.e. frames in flight
+            (defaults to two batches per worker)
+        slot_size: size of a slot in bytes, bigger frames are pickled
+            through the task queue instead
+        load_timeout: seconds `start` waits for the workers to load the
+            model
+    """
+
+    def __init__(self, backend, model_path, options, skeleton, workers=2,
+                 max_batch_size=8, slots=None, slot_size=1920 * 1080 * 3,
+                 load_timeout=600):
+        self.load_timeout = load_timeout
+        # TensorFlow does not survive a fork, the workers start fresh
+        self.context = mp.get_context("spawn")
+        self.slot_size = slot_size
+        self.slots = [
+                shared_memory.SharedMemory(create=True, size=slot_size)
+                for _ in range(slots or workers * max_batch_size * 2)
+                ]
+        self.free = queue.Queue()
+        for i in range(len(self.slots)):
+            self.free.put(i)
+        self.args = (backend, model_path, options, skeleton,
+                     [slot.name for slot in self.slots])
+        self.max_batch_size = max_batch_size
+
+        # task id -> (future, slot, worker index)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.items = 0
+        self.inline = 0
+        self.restarts = 0
+        self.running = False
+        self.closing = False
+        self.processes = [None] * workers
+        self.tasks = [None] * workers
+        # read end of each worker's result pipe, None once it is closed
+        self.results = [None] * workers
+        # frames in flight on each worker, None while it loads the model
+        self.load = [None] * workers
+        # workers whose model failed to load, not started again
+        self.broken = set()
+        self.collector = threading.Thread(target=self._collect, daemon=True)
+
+    def _start_worker(self, index):
+        previous = self.tasks[index]
+        if previous is not None:
+            # the frames left in it are failed already
+            previous.cancel_join_thread()
+            previous.close()
+        self.tasks[index] = self.context.Queue()
+        reader, writer = self.context.Pipe(duplex=False)
+        self.results[index] = reader
+        self.processes[index] = self.context.Process(
+                target=_serve,
+                args=self.args + (self.tasks[index], writer,
+                                  self.max_batch_size),
+                daemon=True)
+        self.processes[index].start()
+        # the worker holds the only write end left, its exit closes the pipe
+        writer.close()
+
+    def _receive(self, timeout):
+        """
+        Waits for the messages of the workers
+
+        Returns:
+            list of (worker index, message)
+        """
+        readers = {reader: index for index, reader in enumerate(self.results)
+                   if reader is not None}
+        messages = []
+        for reader in wait(list(readers), timeout):
+            index = readers[reader]
+            try:
+                messages.append((index, reader.recv()))
+            except (EOFError, OSError):
+                # the worker exited, `_check_workers` starts it again
+                reader.close()
+                self.results[index] = None
+        return messages
+
+    def start(self):
+        """
+        Starts the workers and waits for all of them to load the model
+
+        Raises:
+            RuntimeError: a worker failed to load the model or exited
+            TimeoutError: the workers took more than `load_timeout` seconds
+        """
+        for index in range(len(self.processes)):
+            self._start_worker(index)
+        deadline = time.monotonic() + self.load_timeout
+        loaded = 0
+        while loaded < len(self.processes):
+            messages = self._receive(timeout=1.0)
+            for index, (_, state, error) in messages:
+                if state == "error":
+                    self._abort()
+                    raise RuntimeError("an inference worker failed to load "
+                                       "the model: " + error)
+                self.load[index] = 0
+                loaded += 1
+            if messages:
+                continue
+            exited = [process.exitcode for process in self.processes
+                      if not process.is_alive()]
+            if exited:
+                self._abort()
+                raise RuntimeError("an inference worker exited with code %s "
+                                   "while loading the model" % exited[0])
+            if time.monotonic() > deadline:
+                self._abort()
+                raise TimeoutError("the inference workers did not load the "
+                                   "model in %ss" % self.load_timeout)
+        self.running = True
+        self.collector.start()
+        return self
+
+    def _abort(self):
+        for process in self.processes:
+            process.terminate()
+            process.join()
+        for slot in self.slots:
+            slot.close()
+            slot.unlink()
+
+    def stop(self):
+        self.running = False
+        for tasks in self.tasks:
+            tasks.put(None)
+        for process in self.processes:
+            process.join()
+        # the workers are gone, the collector reads what is left and exits
+        self.closing = True
+        self.collector.join()
+        for slot in self.slots:
+            slot.close()
+            slot.unlink()
+
+    def submit(self, item):
+        """
+        Queues an (image, crop) item, blocking while all the slots are in
+        use
+
+        Returns:
+            a `Future` resolved with the item's prediction
+
+        Raises:
+            Unavailable: no worker has the model loaded
+        """
+        image, crop = item
+        image = np.ascontiguousarray(image)
+        future = Future()
+        if all(load is None for load in self.load):
+            raise Unavailable("no inference worker is running")
+        if image.nbytes <= self.slot_size:
+            slot = self.free.get()
+            view = np.ndarray(image.shape, dtype=image.dtype,
+                              buffer=self.slots[slot].buf)
+            view[...] = image
+            del view
+            task = (slot, image.shape, image.dtype.str, crop, None)
+        else:
+            slot = None
+            task = (None, None, None, crop, image)
+        with self.lock:
+            ready = [index for index, load in enumerate(self.load)
+                     if load is not None]
+            if not ready:
+                # every worker died while this frame waited for a slot
+                if slot is not None:
+                    self.free.put(slot)
+                raise Unavailable("no inference worker is running")
+            index = min(ready, key=self.load.__getitem__)
+            self.load[index] += 1
+            task_id = self.next_id
+            self.next_id += 1
+            self.pending[task_id] = (future, slot, index)
+            self.items += 1
+            if slot is None:
+                self.inline += 1
+            # queued under the lock, so a worker found dead has all its
+            # frames in `pending`
+            self.tasks[index].put((task_id,) + task)
+        return future
+
+    def __call__(self, item):
+        """
+        Queues an item and waits for its prediction
+        """
+        return self.submit(item).result()
+
+    def _collect(self):
+        checked = time.monotonic()
+        while True:
+            closing = self.closing
+            if self.running and time.monotonic() - checked >= 1.0:
+                checked = time.monotonic()
+                self._check_workers()
+            messages = self._receive(timeout=0 if closing else 1.0)
+            if closing and not messages:
+                return
+            for index, (task_id, prediction, error) in messages:
+                if task_id is None:
+                    self._worker_state(index, prediction, error)
+                else:
+                    self._resolve(task_id, prediction, error)
+
+    def _resolve(self, task_id, prediction, error):
+        with self.lock:
+            future, slot, index = self.pending.pop(task_id,
+                                                   (None, None, None))
+            if future is not None and self.load[index] is not None:
+                self.load[index] -= 1
+        if future is None:
+            # failed with its dead worker, which freed the slot
+            return
+        if slot is not None:
+            self.free.put(slot)
+        if error is not None:
+            future.set_exception(RuntimeError(error))
+        else:
+            future.set_result(prediction)
+
+    def _worker_state(self, index, state, error):
+        if state == "ready":
+            logger.info("inference worker %d started again", index)
+            with self.lock:
+                self.load[index] = 0
+        else:
+            # a model that failed to load would fail again
+            logger.error("inference worker %d failed to load the model: %s",
+                         index, error)
+            with self.lock:
+                self.broken.add(index)
+
+    def _check_workers(self):
+        for index, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            with self.lock:
+                if index in self.broken:
+                    continue
+                failed = [task_id for task_id, (_, _, worker)
+                          in self.pending.items() if worker == index]
+                failed = [self.pending.pop(task_id) for task_id in failed]
+                self.load[index] = None
+                self.restarts += 1
+            logger.error("inference worker %d died (exit code %s), failing "
+                         "its %d frames", index, process.exitcode,
+                         len(failed))
+            if self.results[index] is not None:
+                self.results[index].close()
+                self.results[index] = None
+            self._start_worker(index)
+            for future, slot, _ in failed:
+                # nothing writes to the slots of a dead worker
+                if slot is not None:
+                    self.free.put(slot)
+                future.set_exception(RuntimeError("an inference worker died"))
+
+    def stats(self):
+        with self.lock:
+            return {
+                "workers": sum(load is not None for load in self.load),
+                "restarts": self.restarts,
+                "items": self.items,
+                "inline": self.inline,
+                "pending": len(self.pending),
+                "free_slots": self.free.qsize(),
+            }